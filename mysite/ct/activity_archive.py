@@ -0,0 +1,124 @@
+'''archival of closed ActivityLog partitions to compressed files.
+
+An ActivityLog partition (FSM name x course x term) is closed once its
+term is no longer among the CT_ACTIVITY_KEEP_TERMS most recent terms
+and no FSMState still uses it.  archive_partition() writes its
+ActivityEvents to a gzipped JSON-lines file in CT_ACTIVITY_ARCHIVE_DIR
+(first line describes the ActivityLog, then one line per event),
+deletes them from the database and marks the ActivityLog archived;
+restore_partition() reverses this.  Archive files older than
+CT_ACTIVITY_ARCHIVE_DAYS are deleted by expire_archives().'''
+
+import glob
+import gzip
+import json
+import os
+import re
+import time
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from ct.activity_log import dump_time, load_time
+from ct.models import ActivityLog, ActivityEvent, FSMState, get_recent_terms
+
+EVENT_FIELDS = ('pk', 'user_id', 'nodeName', 'unitLesson_id', 'exitEvent')
+
+
+def get_archive_dir():
+    return getattr(settings, 'CT_ACTIVITY_ARCHIVE_DIR', 'activity_archive')
+
+def get_closed_partitions(keepTerms=None):
+    'queryset of unarchived ActivityLogs ready for archiving'
+    if keepTerms is None:
+        keepTerms = getattr(settings, 'CT_ACTIVITY_KEEP_TERMS', 2)
+    return ActivityLog.objects.filter(archived__isnull=True) \
+        .exclude(term__in=get_recent_terms(keepTerms)) \
+        .exclude(pk__in=FSMState.objects.filter(activity__isnull=False)
+                 .values('activity'))
+
+def archive_path(activity, archiveDir):
+    name = re.sub(r'[^\w.-]', '_', activity.fsmName)
+    return os.path.join(archiveDir, '%s-%s-%d.jsonl.gz'
+                        % (activity.term, name, activity.pk))
+
+def dump_time_or_none(t):
+    return t and dump_time(t)
+
+def load_time_or_none(s):
+    return s and load_time(s)
+
+def archive_partition(activity, archiveDir=None):
+    '''move activity's events to a gzipped JSON-lines file, and mark it
+    archived.  Returns (path, number of events).'''
+    if archiveDir is None:
+        archiveDir = get_archive_dir()
+    if not os.path.isdir(archiveDir):
+        os.makedirs(archiveDir)
+    path = archive_path(activity, archiveDir)
+    with transaction.atomic():
+        events = ActivityEvent.objects.filter(activity=activity).order_by('pk')
+        n = 0
+        ofile = gzip.open(path + '.tmp', 'wb')
+        try:
+            ofile.write(json.dumps(dict(pk=activity.pk,
+                fsmName=activity.fsmName, course_id=activity.course_id,
+                term=activity.term,
+                startTime=dump_time_or_none(activity.startTime),
+                endTime=dump_time_or_none(activity.endTime))) + '\n')
+            for e in events.iterator():
+                d = dict([(k, getattr(e, k)) for k in EVENT_FIELDS])
+                d['startTime'] = dump_time_or_none(e.startTime)
+                d['endTime'] = dump_time_or_none(e.endTime)
+                ofile.write(json.dumps(d) + '\n')
+                n += 1
+        finally:
+            ofile.close()
+        os.rename(path + '.tmp', path) # only complete archives are visible
+        FSMState.objects.filter(activityEvent__activity=activity) \
+                        .update(activityEvent=None) # don't cascade to states
+        events.delete()
+        activity.archived = timezone.now()
+        activity.save()
+    return path, n
+
+def read_archive(path):
+    'return (ActivityLog dict, generator of event dicts) from archive file'
+    ifile = gzip.open(path, 'rb')
+    header = json.loads(ifile.readline())
+    def events():
+        try:
+            for line in ifile:
+                d = json.loads(line)
+                d['startTime'] = load_time_or_none(d['startTime'])
+                d['endTime'] = load_time_or_none(d['endTime'])
+                yield d
+        finally:
+            ifile.close()
+    return header, events()
+
+def restore_partition(path):
+    'reload archived events into the db, and mark their ActivityLog live'
+    header, events = read_archive(path)
+    with transaction.atomic():
+        activity = ActivityLog.objects.get(pk=header['pk'])
+        ActivityEvent.objects.bulk_create([ActivityEvent(activity=activity,
+                                                         **d) for d in events])
+        activity.archived = None
+        activity.save()
+    return activity
+
+def expire_archives(days=None, archiveDir=None):
+    'delete archive files older than days; return list of deleted paths'
+    if days is None:
+        days = getattr(settings, 'CT_ACTIVITY_ARCHIVE_DAYS', None)
+    if days is None: # keep forever
+        return []
+    if archiveDir is None:
+        archiveDir = get_archive_dir()
+    cutoff = time.time() - days * 86400.
+    l = []
+    for path in glob.glob(os.path.join(archiveDir, '*.jsonl.gz')):
+        if os.path.getmtime(path) < cutoff:
+            os.remove(path)
+            l.append(path)
+    return l
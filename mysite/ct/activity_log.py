@@ -0,0 +1,282 @@
+'''FSM node entry / exit logging to ActivityEvent, with optional
+write-behind buffering.
+
+FSMState.log_entry() records entry to a node in the FSMState's own
+data, so repeated renders of the same node are detected without a
+query.  By default it also INSERTs an ActivityEvent, which
+transition() completes on exit.
+
+With CT_ACTIVITY_BUFFER = True, nothing is written on entry.  On
+exit, transition() hands the completed event to this process's
+ActivityEventBuffer, which appends it to a local journal file and
+writes buffered events with one bulk_create() once
+CT_ACTIVITY_BUFFER_SIZE events or CT_ACTIVITY_BUFFER_SECONDS have
+accumulated.  Each buffer journals to its own activity-<pid>-<id>.jsonl,
+so a restarted worker that reuses a crashed worker's pid never appends
+to (or truncates) the dead worker's journal.  Journals left behind by a
+crashed process are loaded by recover() (run automatically when a
+buffer starts, or via manage.py flush_activity_journal).'''
+
+import atexit
+import errno
+import glob
+import json
+import os
+import threading
+import uuid
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+ENTRY_KEY = 'activityEntry' # FSMState data key for pending node entry
+FIELDS = ('activity_id', 'user_id', 'nodeName', 'unitLesson_id',
+          'startTime', 'endTime', 'exitEvent')
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def dump_time(t):
+    return t.astimezone(timezone.utc).strftime(TIME_FORMAT)
+
+def load_time(s):
+    return datetime.strptime(s, TIME_FORMAT).replace(tzinfo=timezone.utc)
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM # exists, but not ours to signal
+    return True
+
+def get_journal_pid(path):
+    'pid of the process that wrote journal path, or None'
+    try: # activity-<pid>-<id>.jsonl, or activity-<pid>.jsonl
+        return int(os.path.basename(path)[9:-6].split('-')[0])
+    except ValueError:
+        return None
+
+
+class ActivityEventBuffer(object):
+    'queue of completed ActivityEvents, journaled to a local file'
+    def __init__(self, journalDir, maxEvents=100, maxAge=10., fsync=False):
+        self.journalDir = journalDir
+        self.maxEvents = maxEvents
+        self.maxAge = maxAge
+        self.fsync = fsync
+        self.lock = threading.RLock()
+        self.pending = []
+        self.timer = None
+        if not os.path.isdir(journalDir):
+            os.makedirs(journalDir)
+        self.journalPath = os.path.join(journalDir, 'activity-%d-%s.jsonl'
+                                        % (os.getpid(), uuid.uuid4().hex[:12]))
+        self.journal = None
+    def add(self, **kwargs):
+        'queue one completed ActivityEvent, given as field values'
+        record = dict([(k, kwargs[k]) for k in FIELDS])
+        record['startTime'] = dump_time(record['startTime'])
+        record['endTime'] = dump_time(record['endTime'])
+        with self.lock:
+            if self.journal is None:
+                self.journal = open(self.journalPath, 'a')
+            self.journal.write(json.dumps(record) + '\n')
+            self.journal.flush()
+            if self.fsync:
+                os.fsync(self.journal.fileno())
+            self.pending.append(record)
+            if len(self.pending) >= self.maxEvents:
+                self.flush()
+            elif self.timer is None: # flush within maxAge even if idle
+                self.timer = threading.Timer(self.maxAge, self._timed_flush)
+                self.timer.daemon = True
+                self.timer.start()
+    def _timed_flush(self):
+        try:
+            self.flush()
+        finally:
+            connection.close() # this thread's own db connection
+    def flush(self):
+        'write all pending events with bulk_create, then reset the journal'
+        with self.lock:
+            if self.timer is not None:
+                if self.timer is not threading.current_thread():
+                    self.timer.cancel()
+                self.timer = None
+            if not self.pending:
+                return 0
+            write_records(self.pending)
+            n = len(self.pending)
+            self.pending = []
+            self.journal.close() # events now in db: start a new journal
+            self.journal = open(self.journalPath, 'w')
+            return n
+    def recover(self, includeLive=False):
+        '''load journals left by dead processes (or all other processes
+        if includeLive) into the db, skipping events already written.
+        A journal with our pid but not our name was left by an earlier
+        process that had the same pid, so is always recovered.'''
+        n = 0
+        for path in glob.glob(os.path.join(self.journalDir,
+                                           'activity-*.jsonl')):
+            if path == self.journalPath:
+                continue
+            pid = get_journal_pid(path)
+            if pid is None:
+                continue
+            if not includeLive and pid != os.getpid() and pid_alive(pid):
+                continue
+            n += recover_journal(path)
+        return n
+
+def read_journal(path):
+    'list of records in journal, ignoring a partially written last line'
+    l = []
+    with open(path) as ifile:
+        for line in ifile:
+            try:
+                l.append(json.loads(line))
+            except ValueError:
+                continue
+    return l
+
+def find_existing(records, window):
+    '''set of indexes of records already in the db: an ActivityEvent
+    with the same activity, user, node, UnitLesson and exit event, that
+    ended within window seconds.  Live logging stamps startTime at page
+    render and the event log at the entering transition, but both stamp
+    the exit.  One query per call.'''
+    from ct.models import ActivityEvent
+    if not records:
+        return set()
+    ends = [load_time(r['endTime']) for r in records]
+    delta = timedelta(seconds=window)
+    existing = {} # key -> [endTime]
+    for row in ActivityEvent.objects.filter(
+            activity__in=set([r['activity_id'] for r in records]),
+            endTime__range=(min(ends) - delta, max(ends) + delta)) \
+          .values_list('activity', 'user', 'nodeName', 'unitLesson',
+                       'exitEvent', 'endTime'):
+        existing.setdefault(row[:5], []).append(row[5])
+    found = set()
+    for i, r in enumerate(records):
+        l = existing.get((r['activity_id'], r['user_id'], r['nodeName'],
+                          r['unitLesson_id'], r['exitEvent']), ())
+        for j, t in enumerate(l):
+            if abs(t - ends[i]) <= delta:
+                del l[j] # each row matches only one record
+                found.add(i)
+                break
+    return found
+
+def write_records(records, skipExisting=False):
+    '''bulk_create ActivityEvents from journal records, optionally
+    skipping those already in the db (see find_existing())'''
+    from ct.models import ActivityEvent
+    skip = ()
+    if skipExisting:
+        skip = find_existing(records, getattr(settings,
+                            'CT_ACTIVITY_MATCH_SECONDS', 1.))
+    events = []
+    for i, r in enumerate(records):
+        if i in skip:
+            continue # flushed before the journal was reset, or logged live
+        events.append(ActivityEvent(activity_id=r['activity_id'],
+                                    user_id=r['user_id'],
+                                    nodeName=r['nodeName'],
+                                    unitLesson_id=r['unitLesson_id'],
+                                    startTime=load_time(r['startTime']),
+                                    endTime=load_time(r['endTime']),
+                                    exitEvent=r['exitEvent']))
+    if events:
+        with transaction.atomic():
+            ActivityEvent.objects.bulk_create(events)
+    return len(events)
+
+def recover_journal(path):
+    'write a stale journal\'s events to the db and remove it'
+    n = write_records(read_journal(path), skipExisting=True)
+    os.remove(path)
+    return n
+
+
+_buffer = None
+_bufferLock = threading.Lock()
+
+def get_buffer():
+    'this process\'s ActivityEventBuffer, or None if buffering is off'
+    global _buffer
+    if _buffer is None and getattr(settings, 'CT_ACTIVITY_BUFFER', False):
+        with _bufferLock:
+            if _buffer is None:
+                b = ActivityEventBuffer(getattr(settings,
+                        'CT_ACTIVITY_JOURNAL_DIR', 'activity_journal'),
+                        getattr(settings, 'CT_ACTIVITY_BUFFER_SIZE', 100),
+                        getattr(settings, 'CT_ACTIVITY_BUFFER_SECONDS', 10.),
+                        getattr(settings, 'CT_ACTIVITY_JOURNAL_FSYNC', False))
+                b.recover()
+                atexit.register(b.flush)
+                _buffer = b
+    return _buffer
+
+def reset():
+    'flush and discard this process\'s buffer (e.g. after settings change)'
+    global _buffer
+    with _bufferLock:
+        if _buffer is not None:
+            _buffer.flush()
+            if _buffer.journal is not None:
+                _buffer.journal.close()
+            _buffer = None
+
+def log_node_entry(state, user):
+    '''record entry to state.fsmNode, unless already recorded.  The
+    entry is cached in state data, so repeat renders of the same node
+    cost no queries.  Saves state.'''
+    d = state.load_json_data()
+    entry = d.get(ENTRY_KEY)
+    if entry is None and state.activityEvent_id: # logged before caching
+        entry = dict(nodeName=state.activityEvent.nodeName)
+    if entry and entry['nodeName'] == state.fsmNode.name:
+        return # already logged
+    if not state.activity_id: # partition by the course being studied
+        from ct.models import ActivityLog
+        state.activity = ActivityLog.get_or_create(state.fsmNode.fsm.name,
+                                                   d.get('course'))
+    now = timezone.now()
+    if get_buffer() is None: # write event now; exit will update it
+        from ct.models import ActivityEvent
+        ae = ActivityEvent(activity_id=state.activity_id, user=user,
+                           nodeName=state.fsmNode.name,
+                           unitLesson_id=state.unitLesson_id, startTime=now)
+        ae.save()
+        state.activityEvent = ae # after save(), so activityEvent_id is set
+    d[ENTRY_KEY] = dict(nodeName=state.fsmNode.name, user_id=user.pk,
+                        unitLesson_id=state.unitLesson_id,
+                        startTime=dump_time(now))
+    state.save_json_data()
+
+def log_node_exit(state, eventName):
+    '''record exit from state's logged node, if any: update its
+    ActivityEvent, or queue the completed event if it was buffered.
+    Caller must save state afterwards.'''
+    d = state.load_json_data()
+    entry = d.pop(ENTRY_KEY, None)
+    if entry:
+        state.save_json_data(doSave=False)
+    if state.activityEvent_id: # written at entry
+        state.activityEvent.log_exit_event(eventName)
+        state.activityEvent = None
+        return
+    if not entry:
+        return
+    kwargs = dict(activity_id=state.activity_id, user_id=entry['user_id'],
+                  nodeName=entry['nodeName'],
+                  unitLesson_id=entry['unitLesson_id'],
+                  startTime=load_time(entry['startTime']),
+                  endTime=timezone.now(), exitEvent=eventName)
+    buffer = get_buffer()
+    if buffer is not None:
+        buffer.add(**kwargs)
+    else: # buffering turned off since entry: write it now
+        from ct.models import ActivityEvent
+        ActivityEvent(**kwargs).save()
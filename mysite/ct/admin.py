@@ -1,9 +1,19 @@
 from django.contrib import admin
 import ct.models
+from ct.forms import LessonTextForm
+
+
+class LessonAdminForm(LessonTextForm):
+    class Meta:
+        model = ct.models.Lesson
+        exclude = ('textBlob',)
+
+class LessonAdmin(admin.ModelAdmin):
+    form = LessonAdminForm
 
 admin.site.register(ct.models.Concept)
 admin.site.register(ct.models.ConceptGraph)
-admin.site.register(ct.models.Lesson)
+admin.site.register(ct.models.Lesson, LessonAdmin)
 admin.site.register(ct.models.ConceptLink)
 admin.site.register(ct.models.UnitLesson)
 admin.site.register(ct.models.Unit)
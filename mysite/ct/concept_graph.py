@@ -0,0 +1,201 @@
+'''in-memory index of ConceptGraph edges for fast multi-hop queries.
+
+Concepts are mapped to dense integer indexes, and each relationship
+keeps forward and reverse adjacency lists as arrays of those indexes,
+so closure queries never touch the database.  The index is loaded
+once per process by get_concept_graph(), and ConceptGraph post_save /
+post_delete signals (including cascade deletes) apply committed
+changes to it incrementally.  A change made inside a transaction
+could still be rolled back, so instead it discards the index: until
+that transaction ends, this thread queries a private index loaded
+with its own uncommitted edges, and the shared index is reloaded once
+the transaction is over (deletes always run inside one).  Other
+processes only see changes after their own reload().'''
+
+from array import array
+import threading
+from django.db import connection
+
+
+class ConceptGraphIndex(object):
+    'adjacency-list index of all ConceptGraph edges'
+    def __init__(self, edges=()):
+        'edges: iterable of (edge pk, fromConcept pk, toConcept pk, rel)'
+        self.lock = threading.RLock()
+        self.index = {} # concept pk -> dense int
+        self.ids = array('l') # dense int -> concept pk
+        self.forward = {} # relationship -> list of array of dense ints
+        self.reverse = {}
+        self.edges = {} # edge pk -> (from int, to int, relationship)
+        for t in edges:
+            self.add_edge(*t)
+    @classmethod
+    def load(klass):
+        'build index from all ConceptGraph rows in one query'
+        from ct.models import ConceptGraph
+        return klass(ConceptGraph.objects.values_list('pk', 'fromConcept',
+                                            'toConcept', 'relationship'))
+    def _get_index(self, conceptID):
+        try:
+            return self.index[conceptID]
+        except KeyError:
+            i = self.index[conceptID] = len(self.ids)
+            self.ids.append(conceptID)
+            for adjacency in self.forward.values() + self.reverse.values():
+                adjacency.append(array('l'))
+            return i
+    def _adjacency(self, d, relationship):
+        try:
+            return d[relationship]
+        except KeyError:
+            l = d[relationship] = [array('l') for i in self.ids]
+            return l
+    def add_edge(self, edgeID, fromID, toID, relationship):
+        'add (or replace) edge edgeID'
+        with self.lock:
+            if edgeID in self.edges:
+                self.remove_edge(edgeID)
+            i = self._get_index(fromID)
+            j = self._get_index(toID)
+            self._adjacency(self.forward, relationship)[i].append(j)
+            self._adjacency(self.reverse, relationship)[j].append(i)
+            self.edges[edgeID] = (i, j, relationship)
+    def remove_edge(self, edgeID):
+        'remove edge edgeID if present'
+        with self.lock:
+            try:
+                i, j, relationship = self.edges.pop(edgeID)
+            except KeyError:
+                return
+            self.forward[relationship][i].remove(j)
+            self.reverse[relationship][j].remove(i)
+    def _closure(self, d, relationship, conceptID):
+        'set of concept pks reachable from conceptID (excluding itself)'
+        try:
+            start = self.index[conceptID]
+            adjacency = d[relationship]
+        except KeyError:
+            return set()
+        seen = bytearray(len(self.ids))
+        seen[start] = 1
+        stack = [start]
+        out = set()
+        while stack:
+            for j in adjacency[stack.pop()]:
+                if not seen[j]:
+                    seen[j] = 1
+                    stack.append(j)
+                    out.add(self.ids[j])
+        return out
+    def get_prerequisites(self, conceptID, relationship=None):
+        'transitive closure of concepts that conceptID depends on'
+        from ct.models import ConceptGraph
+        with self.lock:
+            return self._closure(self.forward,
+                                 relationship or ConceptGraph.DEPENDS,
+                                 conceptID)
+    def get_dependents(self, conceptID, relationship=None):
+        'transitive closure of concepts that depend on conceptID'
+        from ct.models import ConceptGraph
+        with self.lock:
+            return self._closure(self.reverse,
+                                 relationship or ConceptGraph.DEPENDS,
+                                 conceptID)
+    def get_error_models(self, conceptID, includePrerequisites=True,
+                         relationship=None):
+        'error model concepts for conceptID and (optionally) its prerequisites'
+        from ct.models import ConceptGraph
+        with self.lock:
+            concepts = [conceptID]
+            if includePrerequisites:
+                concepts += self._closure(self.forward, ConceptGraph.DEPENDS,
+                                          conceptID)
+            out = set()
+            adjacency = self.reverse.get(relationship
+                                         or ConceptGraph.MISUNDERSTANDS, ())
+            for conceptID in concepts:
+                try:
+                    i = self.index[conceptID]
+                except KeyError:
+                    continue
+                if adjacency:
+                    out.update([self.ids[j] for j in adjacency[i]])
+            return out
+    def find_cycle(self, relationship=None):
+        'return list of concept pks forming a cycle, or None if acyclic'
+        from ct.models import ConceptGraph
+        with self.lock:
+            adjacency = self.forward.get(relationship or ConceptGraph.DEPENDS)
+            if not adjacency:
+                return None
+            n = len(self.ids)
+            state = bytearray(n) # 0: new, 1: on current path, 2: done
+            for start in range(n):
+                if state[start]:
+                    continue
+                path = [start]
+                iters = [iter(adjacency[start])]
+                state[start] = 1
+                while iters:
+                    for j in iters[-1]:
+                        if state[j] == 1: # back edge closes a cycle
+                            return [self.ids[k]
+                                    for k in path[path.index(j):]]
+                        elif not state[j]:
+                            state[j] = 1
+                            path.append(j)
+                            iters.append(iter(adjacency[j]))
+                            break
+                    else: # all successors done
+                        state[path.pop()] = 2
+                        iters.pop()
+            return None
+
+
+_conceptGraph = None
+_loadLock = threading.Lock()
+_pending = threading.local() # this thread changed edges in a transaction
+
+def get_concept_graph():
+    '''get this process\'s ConceptGraphIndex, loading it on first use
+    (or, inside a transaction that changed edges, a private index that
+    includes those uncommitted changes)'''
+    global _conceptGraph
+    sync()
+    if getattr(_pending, 'changed', False): # still in that transaction
+        return ConceptGraphIndex.load()
+    if _conceptGraph is None:
+        with _loadLock:
+            if _conceptGraph is None:
+                _conceptGraph = ConceptGraphIndex.load()
+    return _conceptGraph
+
+def reload():
+    'discard the cached index so the next query reloads it from the db'
+    global _conceptGraph
+    _conceptGraph = None
+
+def sync(**kwargs):
+    '''once the transaction that changed edges has committed or rolled
+    back, reload the index (also a request_finished receiver)'''
+    if getattr(_pending, 'changed', False) and not connection.in_atomic_block:
+        _pending.changed = False
+        reload() # a thread may have loaded it mid-transaction
+
+def edge_changed(apply):
+    'apply a committed change to the index, or defer an uncommitted one'
+    if connection.in_atomic_block: # may yet be rolled back
+        _pending.changed = True
+        reload()
+    elif _conceptGraph is not None:
+        apply(_conceptGraph)
+
+def edge_saved(sender, instance, **kwargs):
+    'post_save receiver: add a saved ConceptGraph edge to the index'
+    edge_changed(lambda g: g.add_edge(instance.pk, instance.fromConcept_id,
+                                      instance.toConcept_id,
+                                      instance.relationship))
+
+def edge_deleted(sender, instance, **kwargs):
+    'post_delete receiver: remove a deleted ConceptGraph edge from the index'
+    edge_changed(lambda g: g.remove_edge(instance.pk))
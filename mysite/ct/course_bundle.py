@@ -0,0 +1,387 @@
+'''Course bundles: export a whole course to one gzipped JSON-lines file,
+and import it into another deployment.
+
+A bundle holds a header line, then one record per row, in dependency
+order: the Concepts and Lessons (every version of each lesson tree)
+used by the course, ConceptGraph and ConceptLink edges among them,
+the Course, its Units and CourseUnits, UnitLesson trees (parents
+first) and, optionally, Responses and StudentErrors.  Each record is
+{"model": name, "pk": old pk, "fields": {attname: value}}.  Lesson
+text is stored inline.  Instructor user links are stored as
+usernames; student authors are replaced by anonymous numbers.
+
+Both sides stream: the exporter reads rows in pk-ordered chunks and
+writes them as it goes, and the importer bulk-inserts each batch of
+records, remapping foreign keys through per-model dicts of
+old pk -> new pk.  Memory is bounded by the number of rows, not
+their contents.'''
+
+import gzip
+import itertools
+import json
+import uuid
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime, parse_date
+from ct.models import *
+
+FORMAT = 'ct-course-bundle'
+VERSION = 1
+CHUNK_SIZE = 500 # ids per IN (...) clause, under sqlite's limit
+MODELS = dict([(klass.__name__, klass) for klass in
+               (Concept, Lesson, ConceptGraph, ConceptLink, Course, Unit,
+                CourseUnit, UnitLesson, Response, StudentError)])
+ANONYMOUS = (Response, StudentError) # author is a student
+SKIP_FKS = ('textBlob_id', 'activity_id') # not carried across deployments
+
+
+def chunks(l, n=CHUNK_SIZE):
+    for i in range(0, len(l), n):
+        yield l[i:i + n]
+
+def iter_objects(klass, pks, *related):
+    'rows of klass with these pks, in pk order, one chunk at a time'
+    for chunk in chunks(sorted(pks)):
+        for o in klass.objects.filter(pk__in=chunk).select_related(*related) \
+                              .order_by('pk'):
+            yield o
+
+def tree_order(ulParents):
+    'UnitLesson pks ordered parents first, from {pk:parent pk}'
+    children = {}
+    level = []
+    for pk, parentID in ulParents.items():
+        if parentID in ulParents:
+            children.setdefault(parentID, []).append(pk)
+        else:
+            level.append(pk)
+    l = []
+    while level:
+        level.sort()
+        l += level
+        level = list(itertools.chain(*[children.get(pk, ())
+                                       for pk in level]))
+    return l
+
+
+class CourseBundleWriter(object):
+    'write one course bundle, as a gzipped JSON-lines stream'
+    def __init__(self, path):
+        self.ofile = gzip.open(path, 'wb')
+        self.counts = {}
+        self.usernames = {} # user ID -> username
+        self.anonIDs = {} # student user ID -> anonymous number
+    def close(self):
+        self.ofile.close()
+    def write_line(self, d):
+        self.ofile.write(json.dumps(d, cls=DjangoJSONEncoder,
+                                    sort_keys=True) + '\n')
+    def get_username(self, userID):
+        try:
+            return self.usernames[userID]
+        except KeyError:
+            pass
+        self.usernames[userID] = User.objects.filter(pk=userID) \
+          .values_list('username', flat=True)[0]
+        return self.usernames[userID]
+    def write(self, o):
+        'write one row, with user links made portable'
+        klass = o.__class__
+        fields = {}
+        for f in klass._meta.fields:
+            if f.primary_key or f.attname in SKIP_FKS:
+                continue
+            v = getattr(o, f.attname)
+            if f.rel and f.rel.to is User and v is not None:
+                if klass in ANONYMOUS and f.name == 'author':
+                    v = self.anonIDs.setdefault(v, len(self.anonIDs) + 1)
+                else:
+                    v = self.get_username(v)
+            fields[f.attname] = v
+        if klass is Lesson: # from select_related() blob, not one by one
+            fields['text'] = o.textBlob_id and o.textBlob.get_text() or None
+        self.write_line(dict(model=klass.__name__, pk=o.pk, fields=fields))
+        self.counts[klass.__name__] = self.counts.get(klass.__name__, 0) + 1
+
+def export_course(course, path, includeResponses=False):
+    '''write course, its courselets and their lessons, concepts and
+    (if includeResponses) anonymized student data to bundle file path.
+    Returns dict of row counts by model name.'''
+    unitIDs = list(course.courseunit_set.values_list('unit', flat=True))
+    ulParents = dict(UnitLesson.objects.filter(unit__in=unitIDs)
+                     .values_list('pk', 'parent'))
+    lessonIDs = set(UnitLesson.objects.filter(unit__in=unitIDs)
+                    .values_list('lesson', flat=True))
+    lessonIDs.discard(None)
+    treeIDs = set()
+    for chunk in chunks(list(lessonIDs)):
+        treeIDs.update(Lesson.objects.filter(pk__in=chunk)
+                       .values_list('treeID', flat=True))
+    for chunk in chunks([t for t in treeIDs if t is not None]):
+        lessonIDs.update(Lesson.objects.filter(treeID__in=chunk)
+                         .values_list('pk', flat=True))
+    conceptIDs = set()
+    for chunk in chunks(list(lessonIDs)):
+        conceptIDs.update(Lesson.objects.filter(pk__in=chunk,
+                    concept__isnull=False).values_list('concept', flat=True))
+        conceptIDs.update(ConceptLink.objects.filter(lesson__in=chunk)
+                          .values_list('concept', flat=True))
+    writer = CourseBundleWriter(path)
+    try:
+        writer.write_line(dict(format=FORMAT, version=VERSION,
+                               course=course.title,
+                               responses=includeResponses))
+        for o in iter_objects(Concept, conceptIDs):
+            writer.write(o)
+        for o in iter_objects(Lesson, lessonIDs, 'textBlob'): # parents first
+            writer.write(o)
+        for chunk in chunks(sorted(conceptIDs)):
+            for o in ConceptGraph.objects.filter(fromConcept__in=chunk) \
+                                         .order_by('pk'):
+                if o.toConcept_id in conceptIDs:
+                    writer.write(o)
+        for chunk in chunks(sorted(lessonIDs)):
+            for o in ConceptLink.objects.filter(lesson__in=chunk) \
+                                        .order_by('pk'):
+                writer.write(o)
+        writer.write(course)
+        for o in iter_objects(Unit, unitIDs):
+            writer.write(o)
+        for o in course.courseunit_set.order_by('pk'):
+            writer.write(o)
+        for chunk in chunks(tree_order(ulParents)):
+            objs = UnitLesson.objects.in_bulk(chunk)
+            for pk in chunk:
+                writer.write(objs[pk])
+        if includeResponses:
+            responseIDs = set()
+            for r in Response.objects.filter(course=course,
+                    unitLesson__unit__in=unitIDs).order_by('pk').iterator():
+                if r.lesson_id in lessonIDs and (r.parent_id is None
+                                                 or r.parent_id in responseIDs):
+                    writer.write(r)
+                    responseIDs.add(r.pk)
+            for se in StudentError.objects.filter(response__course=course) \
+                                          .order_by('pk').iterator():
+                if se.response_id in responseIDs \
+                  and se.errorModel_id in ulParents:
+                    writer.write(se)
+    finally:
+        writer.close()
+    return writer.counts
+
+
+class CourseBundleImporter(object):
+    '''import a course bundle, creating new rows with bulk INSERTs.
+    Instructor links go to the user with the same username, if any,
+    else to author; anonymous students become new users named
+    <prefix>_<number>.'''
+    def __init__(self, path, author, batchSize=500, title=None):
+        self.path = path
+        self.author = author
+        self.batchSize = batchSize
+        self.title = title
+        self.pkMaps = dict([(name, {}) for name in MODELS])
+        self.users = {} # username -> user ID
+        self.anonUsers = {} # anonymous number -> new user ID
+        self.treeMap = {} # old Lesson treeID -> new treeID
+        self.lessonTrees = {} # new Lesson pk -> old treeID
+        self.counts = {}
+        self.course = None
+        self.pending = [] # (old pk, fields) of current model
+        self.pendingModel = None
+    def run(self):
+        'import the bundle; returns the new Course'
+        ifile = gzip.open(self.path, 'rb')
+        try:
+            header = json.loads(ifile.readline())
+            if header.get('format') != FORMAT or header['version'] > VERSION:
+                raise ValueError('%s is not a course bundle (version <= %d)'
+                                 % (self.path, VERSION))
+            self.prefix = self.get_prefix()
+            with transaction.atomic():
+                for line in ifile:
+                    record = json.loads(line)
+                    self.add(record['model'], record['pk'], record['fields'])
+                self.flush()
+                self.finish()
+        finally:
+            ifile.close()
+        return self.course
+    def get_prefix(self):
+        'username prefix for this import\'s students, used by no user yet'
+        while True: # pks can be reused, so not derived from Course pk
+            prefix = 'bundle_' + uuid.uuid4().hex[:10]
+            if not User.objects.filter(username__startswith=prefix + '_') \
+                               .exists():
+                return prefix
+    def add(self, name, pk, fields):
+        'queue one record, first writing any batch it depends on'
+        if name not in MODELS:
+            raise ValueError('unknown model in bundle: %s' % name)
+        if name != self.pendingModel:
+            self.flush()
+            if self.pendingModel == 'Lesson':
+                self.map_trees()
+            self.pendingModel = name
+        elif len(self.pending) >= self.batchSize \
+          or self.needs_flush(MODELS[name], fields):
+            self.flush()
+        self.pending.append((pk, fields))
+    def needs_flush(self, klass, fields):
+        'does this record refer to a row of its own model not yet written?'
+        pkMap = self.pkMaps[klass.__name__]
+        for f in klass._meta.fields:
+            if f.rel and f.rel.to is klass and fields.get(f.attname) \
+              is not None and fields[f.attname] not in pkMap:
+                return True
+    def get_user(self, username):
+        'ID of user with this username on this deployment, else author'
+        try:
+            return self.users[username]
+        except KeyError:
+            pass
+        try:
+            self.users[username] = User.objects.get(username=username).pk
+        except User.DoesNotExist:
+            self.users[username] = self.author.pk
+        return self.users[username]
+    def add_students(self, anonIDs):
+        'create users for anonymous students not yet seen, enrolled'
+        anonIDs = sorted(set(anonIDs) - set(self.anonUsers))
+        if not anonIDs:
+            return
+        password = make_password(None)
+        users = [User(username='%s_%d' % (self.prefix, i), password=password)
+                 for i in anonIDs]
+        pks = bulk_insert(User, users, username__startswith=self.prefix + '_')
+        self.anonUsers.update(zip(anonIDs, pks))
+        Role.objects.bulk_create([Role(course=self.course, user_id=pk,
+                                       role=Role.ENROLLED) for pk in pks])
+        self._count('User', len(pks))
+    def make_obj(self, klass, fields):
+        'unsaved klass instance from record fields, with keys remapped'
+        d = {}
+        for f in klass._meta.fields:
+            if f.primary_key or f.attname not in fields:
+                continue
+            v = fields[f.attname]
+            if v is None and not f.null:
+                continue # use the field default
+            if f.rel and v is not None:
+                if f.rel.to is User:
+                    if klass in ANONYMOUS and f.name == 'author':
+                        v = self.anonUsers[v]
+                    else:
+                        v = self.get_user(v)
+                elif f.rel.to is Course:
+                    v = self.course.pk
+                else:
+                    try:
+                        v = self.pkMaps[f.rel.to.__name__][v]
+                    except KeyError:
+                        raise ValueError('bundle %s refers to missing %s %d'
+                                         % (klass.__name__,
+                                            f.rel.to.__name__, v))
+            elif isinstance(f, models.DateTimeField) and v is not None:
+                v = parse_datetime(v)
+            elif isinstance(f, models.DateField) and v is not None:
+                v = parse_date(v)
+            d[f.attname] = v
+        if klass is Lesson:
+            d['text'] = fields.get('text')
+            d['treeID'] = None # set by map_trees(), once pks are known
+        elif klass is UnitLesson:
+            d['treeID'] = self.treeMap.get(fields['treeID']) \
+              or self.treeMap.get(self.lessonTrees.get(d['lesson_id'])) \
+              or fields['treeID']
+        elif klass is Course and self.title:
+            d['title'] = self.title
+        return klass(**d)
+    def flush(self):
+        'bulk insert the pending batch of records'
+        if not self.pending:
+            return
+        klass = MODELS[self.pendingModel]
+        if klass in ANONYMOUS:
+            self.add_students([fields['author_id']
+                               for pk, fields in self.pending])
+        objs = [self.make_obj(klass, fields) for pk, fields in self.pending]
+        if klass is Course:
+            objs[0].save()
+            pks = [objs[0].pk]
+            self.course = objs[0]
+            Role(course=self.course, user=self.author,
+                 role=Role.INSTRUCTOR).save()
+        else:
+            pks = bulk_insert(klass, objs)
+        self.pkMaps[klass.__name__].update(zip([t[0] for t in self.pending],
+                                               pks))
+        if klass is Lesson:
+            for (pk, fields), newPK in zip(self.pending, pks):
+                self.lessonTrees[newPK] = fields['treeID']
+        self._count(klass.__name__, len(pks))
+        self.pending = []
+    def map_trees(self):
+        'give imported lessons new treeIDs: the new pk of each tree root'
+        lessonMap = self.pkMaps['Lesson']
+        trees = {}
+        for pk in sorted(self.lessonTrees): # first lesson of a tree
+            trees.setdefault(self.lessonTrees[pk], []).append(pk)
+        for oldTree, pks in trees.items():
+            self.treeMap[oldTree] = lessonMap.get(oldTree, pks[0])
+            for chunk in chunks(pks):
+                Lesson.objects.filter(pk__in=chunk) \
+                  .update(treeID=self.treeMap[oldTree])
+    def finish(self):
+        'rebuild derived tables for the imported rows'
+        if self.course is None:
+            raise ValueError('bundle contains no course')
+        lessonIDs = list(self.pkMaps['Lesson'].values())
+        parents = {}
+        for chunk in chunks(lessonIDs):
+            for t in Lesson.objects.filter(Q(pk__in=chunk) &
+                    (Q(parent__isnull=False) | Q(mergeParent__isnull=False))) \
+                    .values_list('pk', 'parent', 'mergeParent'):
+                parents[t[0]] = t[1:]
+        LessonLineage.objects.bulk_create([LessonLineage(ancestor_id=a,
+                                            descendant_id=pk, depth=depth)
+                                           for (a, pk), depth
+                                           in get_lineage_rows(parents).items()],
+                                          batch_size=self.batchSize)
+        if self.anonUsers:
+            self.add_task_status()
+        from ct import concept_graph
+        concept_graph.reload() # bulk_create bypassed ConceptGraph.save()
+    def add_task_status(self):
+        'StudentTaskStatus rows for imported responses'
+        errorStatus = {}
+        for se in StudentError.objects.filter(response__course=self.course) \
+                                      .values('response', 'status'):
+            errorStatus.setdefault(se['response'], []).append(se['status'])
+        ulUnits = dict(UnitLesson.objects.filter(
+            unit__courseunit__course=self.course).values_list('pk', 'unit'))
+        responses = Response.objects.filter(course=self.course) \
+          .order_by('author', 'unitLesson') \
+          .values('pk', 'author', 'unitLesson', 'kind', 'selfeval', 'status')
+        statuses = []
+        for (userID, ulID), rlist in itertools.groupby(responses.iterator(),
+                            lambda r:(r['author'], r['unitLesson'])):
+            statuses.append(StudentTaskStatus(user_id=userID,
+                            unitLesson_id=ulID, unit_id=ulUnits[ulID],
+                            **get_task_flags(list(rlist), errorStatus)))
+            if len(statuses) >= self.batchSize:
+                StudentTaskStatus.objects.bulk_create(statuses)
+                statuses = []
+        StudentTaskStatus.objects.bulk_create(statuses)
+    def _count(self, name, n):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+def import_course(path, author, batchSize=500, title=None):
+    'import course bundle file path; returns (new Course, row counts)'
+    importer = CourseBundleImporter(path, author, batchSize, title)
+    course = importer.run()
+    return course, importer.counts
@@ -1,4 +1,5 @@
 from django.core.urlresolvers import reverse
+import hashlib
 
 
 pathKwargs = dict(
@@ -80,3 +81,7 @@ def reverse_path_args(target, path, **kwargs):
     for k in arglist: # use only the right kwargs for this target
         reverseArgs[k] = pathKwargs[k]
     return reverse(target, kwargs=reverseArgs)
+
+def text_hash(text):
+    'content address (SHA-1 hex) of a unicode text'
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
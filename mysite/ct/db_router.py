@@ -0,0 +1,85 @@
+'''Send reads from listing / analytics views to a read replica.
+
+Views decorated with @use_replica read from the CT_REPLICA_DB alias
+(if it is configured in DATABASES) when handling GET requests; all
+other reads, and all writes, use the default database.
+
+Read-your-writes: ReplicaStickinessMiddleware records the time of
+each session's last write (any POST, or any db write during the
+request), and for CT_REPLICA_STICKY_SECONDS afterwards that session
+reads only from the default database, so students immediately see
+their own Response.  Within a request, the first write also switches
+its remaining reads back to the default database.  Models listed in
+CT_REPLICA_PRIMARY_MODELS (FSM state) are always read from default.'''
+
+import functools
+import threading
+import time
+from django.conf import settings
+
+SESSION_KEY = 'ct_db_write' # time of this session's last write
+SAFE_METHODS = ('GET', 'HEAD')
+
+_state = threading.local()
+
+
+def get_replica():
+    'replica db alias, or None if no replica is configured'
+    alias = getattr(settings, 'CT_REPLICA_DB', 'replica')
+    if alias in settings.DATABASES:
+        return alias
+
+def is_sticky(request):
+    'True if this session wrote recently, so must read its own writes'
+    try:
+        t = request.session.get(SESSION_KEY)
+    except AttributeError: # no session
+        return False
+    return t is not None and time.time() - t < \
+      getattr(settings, 'CT_REPLICA_STICKY_SECONDS', 30)
+
+def use_replica(view):
+    'decorator: let GET requests to view read from the replica'
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if request.method not in SAFE_METHODS or is_sticky(request) \
+          or not get_replica():
+            return view(request, *args, **kwargs)
+        _state.useReplica = True
+        try:
+            return view(request, *args, **kwargs)
+        finally:
+            _state.useReplica = False
+    return wrapper
+
+
+class ReplicaRouter(object):
+    'route reads to CT_REPLICA_DB inside @use_replica views'
+    def db_for_read(self, model, **hints):
+        if getattr(_state, 'useReplica', False) and \
+          model._meta.model_name not in getattr(settings,
+                'CT_REPLICA_PRIMARY_MODELS', ('fsmstate', 'activityevent')):
+            return get_replica()
+    def db_for_write(self, model, **hints):
+        _state.useReplica = False # read our own writes from here on
+        _state.wrote = True
+        return 'default'
+    def allow_relation(self, obj1, obj2, **hints):
+        return True # replica holds the same rows
+    def allow_migrate(self, db, model):
+        if db == get_replica():
+            return False # replicated from default, not migrated
+
+
+class ReplicaStickinessMiddleware(object):
+    'after a write, keep the session on the default database for a while'
+    def process_request(self, request):
+        _state.useReplica = False
+        _state.wrote = False
+    def process_response(self, request, response):
+        if (request.method not in SAFE_METHODS
+            or getattr(_state, 'wrote', False)) \
+          and hasattr(request, 'session') and get_replica():
+            request.session[SESSION_KEY] = time.time()
+        _state.wrote = False
+        return response
@@ -0,0 +1,87 @@
+'''Suggest likely error models for novel (unclassified) student errors.
+
+For one question, an NgramIndex is built over its error models (title
+plus text) and over the responses students have already classified
+under each error model, so an error model matches answers phrased the
+way students actually phrase them.  All novel responses for the
+question are scored against it in one batched pass, and each error
+model is ranked by its best matching entry.
+
+Suggestions are kept in the Django cache under a key stamped with the
+question's latest Response, StudentError and error model, so they are
+recomputed only after new responses or classifications arrive.'''
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Max, Count
+from ct.phrase_index import NgramIndex
+
+CACHE_PREFIX = 'ct.error_suggest'
+
+
+def get_stamp(ul):
+    'string that changes whenever ul gets new responses or classifications'
+    from ct.models import Response, StudentError
+    r = Response.objects.filter(unitLesson=ul).aggregate(Max('pk'),
+                                                         Count('pk'))
+    se = StudentError.objects.filter(response__unitLesson=ul) \
+      .aggregate(Max('pk'), Count('pk'))
+    em = ul.get_errors().aggregate(Max('pk'), Count('pk'))
+    return '%s.%s.%s.%s.%s.%s' % (r['pk__max'], r['pk__count'],
+                                  se['pk__max'], se['pk__count'],
+                                  em['pk__max'], em['pk__count'])
+
+def get_entries(ul):
+    'list of (error model UL pk, text) to index for question ul'
+    from ct.models import StudentError
+    entries = []
+    emIDs = set()
+    for em in ul.get_errors().select_related('lesson__textBlob'):
+        emIDs.add(em.pk)
+        entries.append((em.pk, em.lesson.title + '\n' + em.lesson.text))
+    for emID, text in StudentError.objects.filter(response__unitLesson=ul,
+            errorModel__in=emIDs).values_list('errorModel', 'response__text'):
+        entries.append((emID, text))
+    return entries
+
+def rank_error_models(index, texts, k=3, minScore=0.1):
+    '''for each text, list of up to k (score, error model pk), best
+    first, scoring each error model by its best matching entry'''
+    results = []
+    for matches in index.search_many(texts, len(index), minScore):
+        best = {}
+        for score, emID in matches: # already sorted best first
+            best.setdefault(emID, score)
+        results.append(sorted([(s, emID) for emID, s in best.items()],
+                              reverse=True)[:k])
+    return results
+
+def suggest_errors(ul, responses, k=None, minScore=None):
+    '''dict of response pk -> list of up to k (score, error model UL),
+    best first, for responses to question ul.  Cached until ul gets
+    new responses or classifications.'''
+    if k is None:
+        k = getattr(settings, 'CT_ERROR_SUGGEST_COUNT', 3)
+    if minScore is None:
+        minScore = getattr(settings, 'CT_ERROR_SUGGEST_MIN_SCORE', 0.1)
+    responses = list(responses)
+    key = '%s.%d.%d.%s.%s' % (CACHE_PREFIX, ul.pk, k, minScore,
+                              get_stamp(ul))
+    d = cache.get(key) or {} # response pk -> [(score, em pk)]
+    todo = [r for r in responses if r.pk not in d]
+    if todo: # score all new responses in one pass
+        entries = get_entries(ul)
+        if entries:
+            index = NgramIndex(entries)
+            results = rank_error_models(index, [r.text for r in todo],
+                                        k, minScore)
+        else:
+            results = [[] for r in todo]
+        for r, l in zip(todo, results):
+            d[r.pk] = l
+        cache.set(key, d, getattr(settings, 'CT_ERROR_SUGGEST_TIMEOUT',
+                                  24 * 3600))
+    errorModels = dict([(em.pk, em) for em in ul.get_errors()
+                        .select_related('lesson')])
+    return dict([(r.pk, [(s, errorModels[emID]) for s, emID in d[r.pk]
+                         if emID in errorModels]) for r in responses])
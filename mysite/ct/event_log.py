@@ -0,0 +1,209 @@
+'''append-only log of every FSM transition, for research clickstreams.
+
+With CT_EVENT_LOG_DIR set, FSMState.transition() appends one JSON line
+per transition to a segment file in that directory (one writer per
+process; a new segment is started when the current one exceeds
+CT_EVENT_LOG_SEGMENT_BYTES).  Nothing is written to the database.
+Each record is a compact JSON object with sorted keys:
+
+  t      transition time (seconds since the epoch, UTC)
+  user   user ID
+  state  FSMState ID
+  fsm    FSM name
+  node   node being exited
+  edge   edge (event) name
+  to     node entered
+  log    True if entry to that node is logged (its doLogging)
+  ul     UnitLesson ID, or null
+  course Course ID in the FSMState data, or null
+
+read_events() scans segments via mmap, and load_activity_events()
+backfills ActivityEvent from them (manage.py load_event_log).'''
+
+import glob
+import heapq
+import json
+import mmap
+import os
+import threading
+import time
+from datetime import datetime
+from django.conf import settings
+from django.utils import timezone
+
+
+class EventLogWriter(object):
+    'appends transition records to size-limited segment files'
+    def __init__(self, logDir, segmentBytes=64 * 1024 * 1024):
+        self.logDir = logDir
+        self.segmentBytes = segmentBytes
+        self.lock = threading.Lock()
+        self.ofile = None
+        self.fsmNames = {} # fsm ID -> name, saves a query per transition
+        if not os.path.isdir(logDir):
+            os.makedirs(logDir)
+    def _new_segment(self):
+        if self.ofile is not None:
+            self.ofile.close()
+        path = os.path.join(self.logDir, 'events-%s-%d.jsonl' %
+                            (datetime.utcnow().strftime('%Y%m%d%H%M%S%f'),
+                             os.getpid()))
+        self.ofile = open(path, 'a')
+    def write(self, record):
+        'append one record (dict) to the current segment'
+        line = json.dumps(record, sort_keys=True, separators=(',', ':'))
+        with self.lock:
+            if self.ofile is None or self.ofile.tell() >= self.segmentBytes:
+                self._new_segment()
+            self.ofile.write(line + '\n')
+            self.ofile.flush()
+    def fsm_name(self, fsmNode):
+        try:
+            return self.fsmNames[fsmNode.fsm_id]
+        except KeyError:
+            name = self.fsmNames[fsmNode.fsm_id] = fsmNode.fsm.name
+            return name
+    def close(self):
+        with self.lock:
+            if self.ofile is not None:
+                self.ofile.close()
+                self.ofile = None
+
+
+_writer = None
+_writerLock = threading.Lock()
+
+def get_writer():
+    'this process\'s EventLogWriter, or None if CT_EVENT_LOG_DIR not set'
+    global _writer
+    logDir = getattr(settings, 'CT_EVENT_LOG_DIR', None)
+    if _writer is None and logDir:
+        with _writerLock:
+            if _writer is None:
+                _writer = EventLogWriter(logDir,
+                    getattr(settings, 'CT_EVENT_LOG_SEGMENT_BYTES',
+                            64 * 1024 * 1024))
+    return _writer
+
+def reset():
+    'close and discard this process\'s writer (e.g. after settings change)'
+    global _writer
+    with _writerLock:
+        if _writer is not None:
+            _writer.close()
+            _writer = None
+
+def get_course_id(state):
+    'ID of the course in state\'s data, without loading its other objects'
+    try:
+        return state._data_dict['course'].pk
+    except (AttributeError, KeyError):
+        pass
+    if not state.data:
+        return None
+    return json.loads(state.data).get('course_Course_id')
+
+def log_transition(state, fromNode, edgeName):
+    'append record of state\'s transition from fromNode, if logging is on'
+    writer = get_writer()
+    if writer is None:
+        return
+    writer.write(dict(t=time.time(), user=state.user_id, state=state.pk,
+                      fsm=writer.fsm_name(fromNode), node=fromNode.name,
+                      edge=edgeName, to=state.fsmNode.name,
+                      log=state.fsmNode.doLogging, ul=state.unitLesson_id,
+                      course=get_course_id(state)))
+
+
+def list_segments(logDir):
+    'segment paths in order of creation'
+    return sorted(glob.glob(os.path.join(logDir, 'events-*.jsonl')))
+
+def read_segment(path, fsmName=None, since=None):
+    '''generate records from one segment, via mmap.  If fsmName, only
+    that FSM's records are decoded; if since, only records with t >= since.'''
+    if os.path.getsize(path) == 0:
+        return
+    match = None
+    if fsmName: # cheap substring test before decoding each line
+        match = '"fsm":%s' % json.dumps(fsmName)
+    with open(path, 'rb') as ifile:
+        m = mmap.mmap(ifile.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            i = 0
+            end = m.size()
+            while i < end:
+                j = m.find('\n', i)
+                if j < 0: # partial last line from a crashed writer
+                    break
+                line = m[i:j]
+                i = j + 1
+                if match and match not in line:
+                    continue
+                try:
+                    r = json.loads(line)
+                except ValueError:
+                    continue
+                if since is None or r['t'] >= since:
+                    yield r
+        finally:
+            m.close()
+
+def read_events(logDir, fsmName=None, since=None):
+    '''generate records from all segments in time order (segments written
+    concurrently by several processes are merged)'''
+    def keyed(i, path):
+        for r in read_segment(path, fsmName, since):
+            yield (r['t'], i, r)
+    streams = [keyed(i, path) for i, path in enumerate(list_segments(logDir))]
+    for t, i, r in heapq.merge(*streams):
+        yield r
+
+def iter_activity_records(events):
+    '''convert transition records to ActivityEvent journal records
+    (see ct.activity_log), pairing each exit from a node with the
+    transition that entered it.  Exits with no recorded entry (e.g.
+    from START), or from nodes that live logging skips (doLogging
+    False), are skipped.'''
+    from ct.activity_log import dump_time
+    entered = {} # state ID -> record that entered its current node
+    for r in events:
+        prev = entered.get(r['state'])
+        entered[r['state']] = r
+        if not prev or prev['to'] != r['node'] or not prev.get('log', True):
+            continue
+        yield dict(fsm=r['fsm'], course=r.get('course'),
+                   user_id=r['user'], nodeName=r['node'],
+                   unitLesson_id=prev['ul'], exitEvent=r['edge'],
+                   startTime=dump_time(timestamp_to_datetime(prev['t'])),
+                   endTime=dump_time(timestamp_to_datetime(r['t'])))
+
+def timestamp_to_datetime(t):
+    return datetime.utcfromtimestamp(t).replace(tzinfo=timezone.utc)
+
+def load_activity_events(logDir, fsmName=None, since=None, batchSize=1000):
+    '''backfill ActivityEvent from the event log, skipping events already
+    in the database (logged live, or by an earlier backfill: matched on
+    their exit, see activity_log.find_existing()).  Returns number of
+    events written.'''
+    from ct.activity_log import write_records, load_time
+    from ct.models import ActivityLog, Course, get_term
+    activities = {} # (fsm name, course ID, term) -> ActivityLog ID
+    n = 0
+    batch = []
+    for r in iter_activity_records(read_events(logDir, fsmName, since)):
+        k = (r.pop('fsm'), r.pop('course'),
+             get_term(load_time(r['startTime'])))
+        try:
+            r['activity_id'] = activities[k]
+        except KeyError: # same partition as live logging would use
+            course = k[1] and Course.objects.filter(pk=k[1]).first()
+            r['activity_id'] = activities[k] = \
+                ActivityLog.get_or_create(k[0], course or None, k[2]).pk
+        batch.append(r)
+        if len(batch) >= batchSize:
+            n += write_records(batch, skipExisting=True)
+            batch = []
+    if batch:
+        n += write_records(batch, skipExisting=True)
+    return n
@@ -202,7 +202,18 @@ class ConceptGraphForm(forms.ModelForm):
         model = ConceptGraph
         fields = ['relationship']
 
-class LessonForm(forms.ModelForm):
+class LessonTextForm(forms.ModelForm):
+    'ModelForm base for Lesson forms: text is a property, not a field'
+    text = forms.CharField(widget=forms.Textarea)
+    def __init__(self, *args, **kwargs):
+        super(LessonTextForm, self).__init__(*args, **kwargs)
+        if self.instance.pk and 'text' not in self.initial:
+            self.initial['text'] = self.instance.text
+    def save(self, commit=True):
+        self.instance.text = self.cleaned_data['text']
+        return super(LessonTextForm, self).save(commit)
+
+class LessonForm(LessonTextForm):
     submitLabel = 'Update'
     url = forms.CharField(required=False)
     changeLog = forms.CharField(required=False, widget=forms.Textarea)
@@ -237,7 +248,7 @@ class ResponseFilterForm(forms.Form):
                 choices=(('', '----'),) + Response.CONF_CHOICES)
 
 
-class ErrorForm(forms.ModelForm):
+class ErrorForm(LessonTextForm):
     submitLabel = 'Update'
     def __init__(self, *args, **kwargs):
         super(ErrorForm, self).__init__(*args, **kwargs)
@@ -249,7 +260,7 @@ class ErrorForm(forms.ModelForm):
         model = Lesson
         fields = ['title', 'text', 'changeLog']
 
-class NewErrorForm(forms.ModelForm):
+class NewErrorForm(LessonTextForm):
     submitLabel = 'Add'
     def __init__(self, *args, **kwargs):
         super(NewErrorForm, self).__init__(*args, **kwargs)
@@ -1,4 +1,5 @@
 from models import FSM, FSMState, FSMBadUserError, FSMStackResumeError
+from ct.profiling import timed
 
 class FSMStack(object):
     'main interface to our current FSM if any'
@@ -17,6 +18,7 @@ class FSMStack(object):
         for e in self.state.fsmNode.outgoing.all(): # detect selection edges
             if e.name.startswith('select_'):
                 setattr(self, e.name, e) # make available to HTML templates
+    @timed('fsm')
     def event(self, request, eventName='next', pageData=None, **kwargs):
         '''top-level interface for passing event to a running FSM instance.
         If FSM handles this event, return a redirect that over-rides
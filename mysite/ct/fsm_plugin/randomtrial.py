@@ -25,7 +25,8 @@ class START(object):
         fsmStack.state.set_data_attr('unit', unit)
         fsmStack.state.title = 'Studying: %s' % unit.title
         logName = 'rt_%s_%d' % (trialName, r) # log for this treatment
-        fsmStack.state.activity = ActivityLog.get_or_create(logName)
+        course = fsmStack.state.load_json_data().get('course')
+        fsmStack.state.activity = ActivityLog.get_or_create(logName, course)
         return node.get_path(fsmStack.state, request, **kwargs)
     next_edge = push_unit_fsm
     _unitAttr = 'testUnit'
@@ -0,0 +1,374 @@
+'''bulk import of legacy socraticqs course data into the current schema.
+
+Replaces the per-row import functions of the old loader.py (which
+target the long-gone Question / CourseQuestion / ErrorModel models).
+SocraticqsImporter reads a legacy socraticqs sqlite database plus the
+courselet CSV files that describe its questions, and creates for each
+courselet a Unit of ORCT question Lessons with their answers and error
+models (as UnitLessons), then the legacy students, their Responses,
+StudentErrors and StudentTaskStatus rows.  Legacy rows are read with
+fetchmany() in batches, users and error models are resolved through
+in-memory maps, and rows are written with bulk INSERTs, one
+transaction per batch.
+
+CSV formats (as for loader.py): the course CSV has rows of
+(courselet CSV file, courselet title); each courselet CSV has rows of
+(rustID, concepts, title, text, explanation, error1, error2, ...),
+concepts being comma-separated concept titles.'''
+
+import codecs
+import csv
+import os.path
+import random
+import sqlite3
+from datetime import datetime
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from ct.models import *
+
+TIME_FORMATS = ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S',
+                '%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S')
+CONFIDENCE_LEVELS = [t[0] for t in Response.CONF_CHOICES] # legacy index
+SELFEVALS = set([t[0] for t in Response.EVAL_CHOICES])
+MAX_SQL_VARS = 500 # ids per IN (...) clause, under sqlite's limit
+
+
+def parse_time(s):
+    'convert a legacy timestamp (string or epoch seconds) to datetime'
+    if s is None:
+        return timezone.now()
+    if isinstance(s, (int, long, float)):
+        return datetime.utcfromtimestamp(s).replace(tzinfo=timezone.utc)
+    for fmt in TIME_FORMATS:
+        try:
+            t = datetime.strptime(s, fmt)
+        except ValueError:
+            continue
+        return timezone.make_aware(t, timezone.get_default_timezone())
+    raise ValueError('unrecognized legacy timestamp: %r' % s)
+
+def split_fullname(fullname):
+    'return (first, last) from "First Last" or "Last, First"'
+    try:
+        firstname, lastname = fullname.split()
+        if firstname[-1] == ',':
+            firstname, lastname = lastname, firstname[:-1]
+    except (ValueError, AttributeError, IndexError):
+        return '', fullname or ''
+    return firstname, lastname
+
+def chunks(l, n=MAX_SQL_VARS):
+    for i in range(0, len(l), n):
+        yield l[i:i + n]
+
+def read_anonymize_csv(csvfile):
+    'load uid -> anonymous username map, if csvfile exists'
+    uidDict = {}
+    if os.path.exists(csvfile):
+        with open(csvfile, 'rb') as ifile:
+            for t in csv.reader(ifile):
+                uidDict[t[0]] = t[1]
+    return uidDict
+
+def write_anonymize_csv(csvfile, uidDict):
+    with open(csvfile, 'wb') as ofile:
+        writer = csv.writer(ofile)
+        for t in sorted(uidDict.items()):
+            writer.writerow(t)
+
+
+class SocraticqsImporter(object):
+    'bulk importer for one legacy socraticqs database into one Course'
+    def __init__(self, dbfile, course, author=None, batchSize=1000,
+                 anonymize=None, log=None):
+        self.conn = sqlite3.connect(dbfile)
+        self.course = course
+        self.author = author or course.addedBy
+        self.batchSize = batchSize
+        self.anonymize = anonymize # path of uid -> anonID csv, or None
+        self.log = log
+        self.counts = {}
+        self.students = {} # legacy uid -> User pk
+        self.questions = [] # list of (legacy qid, question UL pk, lesson pk)
+        self.errorModels = {} # legacy error model id -> UL pk
+    def _count(self, name, n):
+        self.counts[name] = self.counts.get(name, 0) + n
+    def _insert(self, klass, objs, **kwargs):
+        self._count(klass.__name__, len(objs))
+        return bulk_insert(klass, objs, **kwargs)
+    def _create(self, klass, objs):
+        self._count(klass.__name__, len(objs))
+        klass.objects.bulk_create(objs)
+    def _progress(self, msg):
+        if self.log:
+            self.log(msg)
+    def run(self, csvfile):
+        '''import courselets listed in course csvfile and all legacy
+        student data for their questions.  Returns dict of row counts.'''
+        csvdir = os.path.dirname(csvfile)
+        with codecs.open(csvfile, 'r', encoding='utf-8') as ifile:
+            courselets = [t[:2] for t in csv.reader(ifile) if t]
+        for courseletFile, title in courselets:
+            self.import_courselet(os.path.join(csvdir, courseletFile), title)
+        self.import_students()
+        self.import_responses()
+        self.conn.close()
+        from ct import concept_graph
+        concept_graph.reload() # bulk_create bypassed ConceptGraph.save()
+        return self.counts
+
+    def find_question(self, title, errors):
+        'legacy question id matching title (and first error model)'
+        c = self.conn.cursor()
+        rows = ()
+        if errors:
+            c.execute('select q.id from questions q, error_models em '
+                      'where q.title=? and em.explanation=? '
+                      'and q.id=em.question_id group by q.id',
+                      (title, errors[0]))
+            rows = c.fetchall()
+        if len(rows) != 1:
+            c.execute('select id from questions where title=?', (title,))
+            rows = c.fetchall()
+        if len(rows) > 1:
+            raise KeyError('duplicated legacy question title: ' + title)
+        return rows and rows[0][0] or None
+    def get_concepts(self, titles):
+        'dict of title -> Concept pk, creating missing concepts in bulk'
+        d = {}
+        for chunk in chunks(titles):
+            d.update(Concept.objects.filter(title__in=chunk)
+                     .values_list('title', 'pk'))
+        missing = sorted(set(titles) - set(d))
+        for title, pk in zip(missing, self._insert(Concept, [Concept(
+                title=title, addedBy=self.author) for title in missing])):
+            d[title] = pk
+        return d
+    @transaction.atomic
+    def import_courselet(self, csvfile, title):
+        '''create a Unit for one courselet CSV: each question as an ORCT
+        Lesson with its answer and error models (legacy ones if the
+        question is found in the legacy db, else those in the CSV)'''
+        authorID = self.author.pk
+        with codecs.open(csvfile, 'r', encoding='utf-8') as ifile:
+            rows = [t for t in csv.reader(ifile) if len(t) >= 5]
+        c = self.conn.cursor()
+        items = [] # (row, legacy qid, [(legacy em id or None, belief)])
+        for t in rows:
+            qid = self.find_question(t[2], t[5:])
+            if qid:
+                c.execute('select id, belief from error_models '
+                          'where question_id=?', (qid,))
+                errors = c.fetchall()
+            else:
+                errors = [(None, e) for e in t[5:] if e]
+            items.append((t, qid, errors))
+        unit = self.course.create_unit(title, self.author)
+        self._count('Unit', 1)
+        if not items:
+            return unit
+        concepts = self.get_concepts(sorted(set([s.strip()[:100]
+                        for t, qid, errors in items
+                        for s in t[1].split(',') if s.strip()])))
+        emConceptIDs = iter(self._insert(Concept, [Concept(title=belief[:100],
+                                addedBy_id=authorID, isError=True)
+                            for t, qid, errors in items
+                            for emID, belief in errors]))
+        lessons = []
+        emConcepts = [] # concept pk of each error model, in order
+        for t, qid, errors in items: # question, answer, error models
+            lessons.append(Lesson(title=t[2][:100], text=t[3],
+                                  kind=Lesson.ORCT_QUESTION,
+                                  addedBy_id=authorID))
+            lessons.append(Lesson(title='Answer', text=t[4],
+                                  kind=Lesson.ANSWER, addedBy_id=authorID))
+            for emID, belief in errors:
+                emConcepts.append(next(emConceptIDs))
+                lessons.append(Lesson(title=belief[:100], text=belief,
+                                      kind=Lesson.ERROR_MODEL,
+                                      addedBy_id=authorID,
+                                      concept_id=emConcepts[-1]))
+        emConcepts = iter(emConcepts)
+        lessonIDs = self._insert(Lesson, lessons)
+        Lesson.objects.filter(pk__gte=lessonIDs[0], pk__lte=lessonIDs[-1],
+                              treeID=None).update(treeID=F('pk'))
+        questionULs = []
+        i = 0
+        for j, (t, qid, errors) in enumerate(items):
+            questionULs.append(UnitLesson(unit=unit, lesson_id=lessonIDs[i],
+                                          treeID=lessonIDs[i], order=j,
+                                          kind=UnitLesson.COMPONENT,
+                                          addedBy_id=authorID))
+            i += 2 + len(errors)
+        questionIDs = self._insert(UnitLesson, questionULs, unit=unit)
+        childULs = []
+        links = []
+        edges = []
+        i = 0
+        for (t, qid, errors), ulID in zip(items, questionIDs):
+            lessonID = lessonIDs[i]
+            self.questions.append((qid, ulID, lessonID))
+            childULs.append(UnitLesson(unit=unit, lesson_id=lessonIDs[i + 1],
+                                       treeID=lessonIDs[i + 1], parent_id=ulID,
+                                       kind=UnitLesson.ANSWERS,
+                                       addedBy_id=authorID))
+            questionConcepts = [concepts[s.strip()[:100]]
+                                for s in t[1].split(',') if s.strip()]
+            links += [ConceptLink(lesson_id=lessonID, concept_id=conceptID,
+                                  relationship=ConceptLink.TESTS,
+                                  addedBy_id=authorID)
+                      for conceptID in questionConcepts]
+            for k, (emID, belief) in enumerate(errors):
+                emLessonID = lessonIDs[i + 2 + k]
+                childULs.append(UnitLesson(unit=unit, lesson_id=emLessonID,
+                                           treeID=emLessonID, parent_id=ulID,
+                                           kind=UnitLesson.MISUNDERSTANDS,
+                                           addedBy_id=authorID))
+                emConceptID = next(emConcepts)
+                edges += [ConceptGraph(fromConcept_id=emConceptID,
+                                       toConcept_id=conceptID,
+                                       relationship=ConceptGraph.MISUNDERSTANDS,
+                                       addedBy_id=authorID)
+                          for conceptID in questionConcepts]
+            i += 2 + len(errors)
+        childIDs = self._insert(UnitLesson, childULs, unit=unit)
+        self._create(ConceptLink, links)
+        self._create(ConceptGraph, edges)
+        i = 0
+        for t, qid, errors in items: # map legacy error models to ULs
+            i += 1 # skip answer UL
+            for emID, belief in errors:
+                if emID is not None:
+                    self.errorModels[emID] = childIDs[i]
+                i += 1
+        self._progress('courselet %s: %d questions' % (title, len(items)))
+        return unit
+
+    def import_students(self):
+        '''map legacy students to Users (creating missing ones in bulk,
+        with unusable passwords) and enroll them in the course'''
+        c = self.conn.cursor()
+        c.execute('select uid, fullname, username from students')
+        rows = [t for t in c.fetchall() if t[0]]
+        uidDict = {}
+        if self.anonymize:
+            uidDict = read_anonymize_csv(self.anonymize)
+        people = {} # username -> (uid, first, last)
+        for uid, fullname, username in rows:
+            if self.anonymize:
+                try:
+                    username = uidDict[str(uid)]
+                except KeyError:
+                    username = uidDict[str(uid)] = 'user%d' % \
+                               hash(random.random())
+                firstname, lastname = 'Student', username
+            elif not username:
+                continue
+            else:
+                firstname, lastname = split_fullname(fullname)
+            people[username] = (uid, firstname, lastname)
+        if self.anonymize:
+            write_anonymize_csv(self.anonymize, uidDict)
+        userIDs = {}
+        for chunk in chunks(sorted(people)):
+            userIDs.update(User.objects.filter(username__in=chunk)
+                           .values_list('username', 'pk'))
+        missing = sorted(set(people) - set(userIDs))
+        password = make_password(None)
+        for chunk in chunks(missing, self.batchSize):
+            with transaction.atomic():
+                pks = self._insert(User, [User(username=username,
+                                email='unknown', password=password,
+                                first_name=people[username][1][:30],
+                                last_name=people[username][2][:30])
+                                for username in chunk])
+            userIDs.update(zip(chunk, pks))
+        for username, (uid, firstname, lastname) in people.items():
+            self.students[uid] = userIDs[username]
+        enrolled = set(Role.objects.filter(course=self.course,
+                                           role=Role.ENROLLED)
+                       .values_list('user', flat=True))
+        self._create(Role, [Role(course=self.course, user_id=userID,
+                                 role=Role.ENROLLED)
+                            for userID in sorted(set(userIDs.values()))
+                            if userID not in enrolled])
+        self._progress('students: %d (%d new)' % (len(people), len(missing)))
+
+    def import_responses(self):
+        '''stream legacy responses and student errors for imported
+        questions into Response / StudentError / StudentTaskStatus'''
+        questions = dict([(qid, (ulID, lessonID)) for qid, ulID, lessonID
+                          in self.questions if qid])
+        ulUnits = dict(UnitLesson.objects.filter(pk__in=[t[0] for t in
+                        questions.values()]).values_list('pk', 'unit'))
+        responseIDs = {} # (qid, uid) -> Response pk
+        flags = {} # (userID, ulID) -> list of response dicts
+        c = self.conn.cursor()
+        for qids in chunks(sorted(questions)):
+            marks = ','.join('?' * len(qids))
+            c.execute('select question_id, uid, answer, confidence, '
+                      'submit_time, reasons from responses '
+                      'where question_id in (%s) order by id' % marks, qids)
+            while True:
+                rows = c.fetchmany(self.batchSize)
+                if not rows:
+                    break
+                self._write_responses([t for t in rows
+                                       if t[1] in self.students],
+                                      questions, responseIDs, flags)
+        errorStatus = {}
+        for qids in chunks(sorted(questions)):
+            marks = ','.join('?' * len(qids))
+            c.execute('select em.question_id, se.error_id, se.uid, '
+                      'se.submit_time from error_models em, student_errors se '
+                      'where em.question_id in (%s) and em.id=se.error_id '
+                      'order by se.id' % marks, qids)
+            while True:
+                rows = c.fetchmany(self.batchSize)
+                if not rows:
+                    break
+                errors = []
+                for qid, emID, uid, submit_time in rows:
+                    try:
+                        errors.append(StudentError(
+                            response_id=responseIDs[(qid, uid)],
+                            errorModel_id=self.errorModels[emID],
+                            author_id=self.students[uid],
+                            atime=parse_time(submit_time)))
+                    except KeyError: # response or error model not imported
+                        continue
+                    errorStatus.setdefault(errors[-1].response_id,
+                                           []).append(None)
+                with transaction.atomic():
+                    self._create(StudentError, errors)
+                self._progress('student errors: %d'
+                               % self.counts['StudentError'])
+        statuses = [StudentTaskStatus(user_id=userID, unitLesson_id=ulID,
+                                      unit_id=ulUnits[ulID],
+                                      **get_task_flags(rlist, errorStatus))
+                    for (userID, ulID), rlist in flags.items()]
+        for chunk in chunks(statuses, self.batchSize):
+            with transaction.atomic():
+                self._create(StudentTaskStatus, chunk)
+    def _write_responses(self, rows, questions, responseIDs, flags):
+        'bulk insert one batch of legacy response rows'
+        responses = []
+        for qid, uid, answer, confidence, submit_time, reasons in rows:
+            ulID, lessonID = questions[qid]
+            responses.append(Response(lesson_id=lessonID, unitLesson_id=ulID,
+                    course=self.course, author_id=self.students[uid],
+                    text=answer or '', atime=parse_time(submit_time),
+                    confidence=CONFIDENCE_LEVELS[confidence or 0],
+                    selfeval=reasons in SELFEVALS and reasons or None))
+        with transaction.atomic():
+            pks = self._insert(Response, responses)
+        for (qid, uid, answer, confidence, submit_time, reasons), r, pk \
+          in zip(rows, responses, pks):
+            responseIDs[(qid, uid)] = pk # last response wins, as loader.py
+            flags.setdefault((r.author_id, r.unitLesson_id), []).append(
+                dict(pk=pk, kind=r.kind, selfeval=r.selfeval,
+                     status=r.status))
+        self._progress('responses: %d' % self.counts['Response'])
@@ -0,0 +1,47 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from ct import activity_archive
+
+
+class Command(BaseCommand):
+    args = '[archive_file ...]'
+    help = '''Archive closed ActivityLog partitions (terms older than
+    CT_ACTIVITY_KEEP_TERMS, with no running FSM) to gzipped JSON-lines
+    files, deleting their ActivityEvents from the database, then delete
+    archive files older than CT_ACTIVITY_ARCHIVE_DAYS.  With --restore,
+    load the given archive files back into the database instead.'''
+    option_list = BaseCommand.option_list + (
+        make_option('--keep-terms', type='int', default=None,
+                    dest='keepTerms',
+                    help='number of recent terms to keep in the database'),
+        make_option('--dir', default=None,
+                    help='archive directory (default CT_ACTIVITY_ARCHIVE_DIR)'),
+        make_option('--dry-run', action='store_true', default=False,
+                    dest='dryRun', help='just list partitions to archive'),
+        make_option('--restore', action='store_true', default=False,
+                    help='restore the archive files given as arguments'),
+    )
+    def handle(self, *args, **options):
+        if options['restore']:
+            if not args:
+                raise CommandError('--restore needs archive file(s)')
+            for path in args:
+                activity = activity_archive.restore_partition(path)
+                self.stdout.write('restored %s %s (ActivityLog %d)'
+                                  % (activity.fsmName, activity.term,
+                                     activity.pk))
+            return
+        for activity in activity_archive.get_closed_partitions(
+                                                    options['keepTerms']):
+            if options['dryRun']:
+                self.stdout.write('%s %s course=%s (ActivityLog %d)'
+                                  % (activity.fsmName, activity.term,
+                                     activity.course_id, activity.pk))
+                continue
+            path, n = activity_archive.archive_partition(activity,
+                                                         options['dir'])
+            self.stdout.write('%d events -> %s' % (n, path))
+        if not options['dryRun']:
+            for path in activity_archive.expire_archives(
+                                        archiveDir=options['dir']):
+                self.stdout.write('expired %s' % path)
@@ -0,0 +1,196 @@
+from optparse import make_option
+import json
+import random
+import time
+from urlparse import urlparse
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import resolve, reverse
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.contrib.auth.models import User
+from ct.models import *
+from ct.profiling import percentile
+from ct.synthetic import SyntheticDeployment
+
+
+class FlowTimer(object):
+    'test Client wrapper that times every request by url name'
+    def __init__(self, client):
+        self.client = client
+        self.samples = {} # url name -> list of (msec, nquery)
+    def request(self, method, path, data=None):
+        'do one GET / POST, returning redirect path (or None) and response'
+        name = '%s %s' % (method, resolve(path).url_name)
+        with CaptureQueriesContext(connection) as queries:
+            t = time.time()
+            if method == 'POST':
+                response = self.client.post(path, data or {},
+                                            HTTP_REFERER=path) # as browser
+            else:
+                response = self.client.get(path)
+            t = time.time() - t
+        if response.status_code not in (200, 302):
+            raise ValueError('%s %s returned %d' % (method, path,
+                                                    response.status_code))
+        self.samples.setdefault(name, []).append((t * 1000., len(queries)))
+        if response.status_code == 302:
+            return urlparse(response['Location']).path, response
+        return None, response
+    def get(self, path):
+        return self.request('GET', path)
+    def post(self, path, data):
+        return self.request('POST', path, data)
+    def summary(self):
+        'dict of {url name:dict(n, p50, p95, queries)}'
+        d = {}
+        for name, l in self.samples.items():
+            times = sorted([t[0] for t in l])
+            d[name] = dict(n=len(l), p50=percentile(times, 50),
+                           p95=percentile(times, 95),
+                           queries=sum([t[1] for t in l]) / float(len(l)))
+        return d
+
+def instructor_flow(timer, course, unit, ul):
+    'instructor views of a course, courselet and question'
+    args = (course.pk, unit.pk)
+    timer.get(reverse('ct:course', args=(course.pk,)))
+    timer.get(reverse('ct:unit_tasks', args=args))
+    timer.get(reverse('ct:ul_teach', args=args + (ul.pk,)))
+    timer.get(reverse('ct:ul_errors', args=args + (ul.pk,)))
+    timer.get(reverse('ct:unit_concepts', args=args))
+
+def student_flow(timer, course, unit, rng, maxSteps=1000):
+    '''complete lessonseq run through a courselet: read each lesson,
+    answer each question, self-assess, and classify errors'''
+    path = reverse('ct:study_unit', args=(course.pk, unit.pk))
+    timer.get(path)
+    path, response = timer.post(path, dict(task='start'))
+    for i in range(maxSteps):
+        if path is None:
+            raise ValueError('lessonseq stopped without a redirect')
+        name = resolve(path).url_name
+        if name == 'lesson':
+            timer.get(path)
+            path, response = timer.post(path, dict(liked=''))
+        elif name == 'ul_respond':
+            timer.get(path)
+            path, response = timer.post(path, dict(text='i think so',
+                                        confidence=Response.UNSURE))
+        elif name == 'assess':
+            timer.get(path)
+            selfeval = rng.choice((Response.CORRECT, Response.CLOSE,
+                                   Response.DIFFERENT))
+            path, response = timer.post(path, dict(selfeval=selfeval,
+                                        status=NEED_REVIEW_STATUS, liked=''))
+        elif name == 'assess_errors':
+            timer.get(path)
+            ul = UnitLesson.objects.get(pk=resolve(path).kwargs['ul_id'])
+            emlist = [em.pk for em in ul.get_errors()][:1] \
+                     or [em.pk for em in unit.get_aborts()][:1]
+            path, response = timer.post(path, dict(emlist=emlist))
+        else: # END of lessonseq: courselet tasks page
+            timer.get(path)
+            return
+    raise ValueError('lessonseq did not finish in %d steps' % maxSteps)
+
+def compare(current, baseline, threshold, minMsec=10.):
+    '''list of (name, key, old, new) where median time or query count
+    is worse than baseline by more than threshold (p95 is too noisy
+    to compare at benchmark sample sizes)'''
+    l = []
+    for name, d in sorted(current.items()):
+        old = baseline.get(name)
+        if not old:
+            continue
+        if d['p50'] > old['p50'] * (1. + threshold) and \
+          d['p50'] - old['p50'] > minMsec:
+            l.append((name, 'p50', old['p50'], d['p50']))
+        if d['queries'] > old['queries'] * (1. + threshold):
+            l.append((name, 'queries', old['queries'], d['queries']))
+    return l
+
+class Command(BaseCommand):
+    help = '''Time the instructor and student (lessonseq) flows with the
+    test client, on synthetic data in a temporary test database, and
+    report p50/p95 latency and query counts per view.'''
+    option_list = BaseCommand.option_list + (
+        make_option('--seed', type='int', default=0,
+                    help='random seed for data and student choices'),
+        make_option('--students', type='int', default=100,
+                    help='synthetic students enrolled per course'),
+        make_option('--lessons', type='int', default=20,
+                    help='lessons per courselet'),
+        make_option('--rounds', type='int', default=5,
+                    help='instructor flows and student runs to time'),
+        make_option('--json', default=None,
+                    help='write results to this JSON file'),
+        make_option('--label', default='',
+                    help='label (e.g. commit id) stored with JSON results'),
+        make_option('--compare', default=None,
+                    help='JSON results file to compare against'),
+        make_option('--threshold', type='float', default=0.25,
+                    help='fractional slowdown reported as a regression'),
+    )
+    def handle(self, *args, **options):
+        baseline = None
+        if options['compare']:
+            try:
+                with open(options['compare']) as ifile:
+                    baseline = json.load(ifile)['views']
+            except (IOError, ValueError, KeyError) as e:
+                raise CommandError('cannot read %s: %s'
+                                   % (options['compare'], e))
+        oldName = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0)
+        try:
+            summary = self.run_flows(options)
+        finally:
+            connection.creation.destroy_test_db(oldName, verbosity=0)
+        self.stdout.write('%-24s %5s %9s %9s %8s' % ('view', 'n', 'p50 ms',
+                                                    'p95 ms', 'queries'))
+        for name, d in sorted(summary.items()):
+            self.stdout.write('%-24s %5d %9.1f %9.1f %8.1f'
+                              % (name, d['n'], d['p50'], d['p95'],
+                                 d['queries']))
+        if options['json']:
+            params = dict([(k, options[k]) for k in
+                           ('seed', 'students', 'lessons', 'rounds')])
+            with open(options['json'], 'w') as ofile:
+                json.dump(dict(label=options['label'], params=params,
+                               views=summary), ofile, indent=1,
+                          sort_keys=True)
+        if baseline is not None:
+            regressions = compare(summary, baseline, options['threshold'])
+            for name, key, old, new in regressions:
+                self.stdout.write('REGRESSION %s %s: %.1f -> %.1f'
+                                  % (name, key, old, new))
+            if regressions:
+                raise CommandError('%d regressions vs. %s'
+                                   % (len(regressions), options['compare']))
+    def run_flows(self, options):
+        rng = random.Random(options['seed'])
+        SyntheticDeployment(options['seed']).generate(courses=1, units=2,
+                        lessons=options['lessons'],
+                        students=options['students'])
+        from ct.fsm_plugin.lessonseq import get_specs
+        get_specs()[0].save_graph('synth_prof0')
+        course = Course.objects.get(addedBy__username='synth_prof0')
+        units = list(Unit.objects.filter(courseunit__course=course))
+        students = list(User.objects.filter(role__course=course,
+                                            role__role=Role.ENROLLED))
+        timer = FlowTimer(Client())
+        for i in range(options['rounds'] + 1): # first round is warm-up
+            unit = units[i % len(units)]
+            questions = [ul for ul in unit.get_exercises()
+                         if ul.lesson.kind == Lesson.ORCT_QUESTION]
+            timer.client = Client()
+            timer.client.login(username='synth_prof0', password='synthetic')
+            instructor_flow(timer, course, unit, rng.choice(questions))
+            timer.client = Client()
+            timer.client.login(username=students[i % len(students)].username,
+                               password='synthetic')
+            student_flow(timer, course, unit, rng)
+            if i == 0:
+                timer.samples = {}
+        return timer.summary()
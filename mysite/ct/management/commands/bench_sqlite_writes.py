@@ -0,0 +1,119 @@
+from optparse import make_option
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+from django.core.management.base import BaseCommand, CommandError
+from ct.sqlite_tuning import get_pragmas, apply_pragmas
+
+
+def setup_db(path, pragmas):
+    db = sqlite3.connect(path)
+    apply_pragmas(db.cursor(), pragmas)
+    db.execute('CREATE TABLE response (id INTEGER PRIMARY KEY, '
+               'author INTEGER, ul INTEGER, text TEXT)')
+    db.execute('CREATE TABLE status (author INTEGER, ul INTEGER, '
+               'n INTEGER, PRIMARY KEY (author, ul))')
+    db.execute('CREATE INDEX response_ul ON response (ul)')
+    db.commit()
+    db.close()
+
+def writer(path, pragmas, author, ntx, results):
+    'save ntx responses, each with its status update, like save_response'
+    db = sqlite3.connect(path)
+    apply_pragmas(db.cursor(), pragmas)
+    nerror = 0
+    t = time.time()
+    for i in range(ntx):
+        try:
+            db.execute('INSERT INTO response (author, ul, text) '
+                       'VALUES (?, ?, ?)', (author, i % 10, 'answer %d' % i))
+            db.execute('INSERT OR REPLACE INTO status (author, ul, n) '
+                       'VALUES (?, ?, ?)', (author, i % 10, i))
+            db.commit()
+        except sqlite3.OperationalError:
+            db.rollback()
+            nerror += 1
+    results.put(('w', ntx - nerror, nerror, time.time() - t))
+
+def reader(path, pragmas, stop, results):
+    'page reads (responses for a question) until told to stop'
+    db = sqlite3.connect(path)
+    apply_pragmas(db.cursor(), pragmas)
+    n = nerror = 0
+    while not stop.is_set():
+        try:
+            db.execute('SELECT count(*) FROM response WHERE ul=?',
+                       (n % 10,)).fetchall()
+            n += 1
+        except sqlite3.OperationalError:
+            nerror += 1
+    results.put(('r', n, nerror, 0.))
+
+def run_bench(path, pragmas, nwriter, nreader, ntx):
+    'dict of write / read counts, lock errors and elapsed time'
+    setup_db(path, pragmas)
+    results = multiprocessing.Queue()
+    stop = multiprocessing.Event()
+    readers = [multiprocessing.Process(target=reader,
+                                       args=(path, pragmas, stop, results))
+               for i in range(nreader)]
+    writers = [multiprocessing.Process(target=writer,
+                                       args=(path, pragmas, i, ntx, results))
+               for i in range(nwriter)]
+    t = time.time()
+    for p in readers + writers:
+        p.start()
+    for p in writers:
+        p.join()
+    elapsed = time.time() - t
+    stop.set()
+    for p in readers:
+        p.join()
+    d = dict(writes=0, writeErrors=0, reads=0, readErrors=0, elapsed=elapsed)
+    for i in range(nwriter + nreader):
+        kind, n, nerror, t = results.get()
+        if kind == 'w':
+            d['writes'] += n
+            d['writeErrors'] += nerror
+        else:
+            d['reads'] += n
+            d['readErrors'] += nerror
+    return d
+
+
+class Command(BaseCommand):
+    help = '''Benchmark concurrent SQLite write throughput (with page
+    readers running) using default settings vs. CT_SQLITE_PRAGMAS.'''
+    option_list = BaseCommand.option_list + (
+        make_option('--writers', type='int', default=8,
+                    help='number of writer processes'),
+        make_option('--readers', type='int', default=4,
+                    help='number of reader processes'),
+        make_option('--transactions', type='int', default=200,
+                    help='write transactions per writer'),
+        make_option('--dir', default=None,
+                    help='directory for the test databases (default: temp)'),
+    )
+    def handle(self, *args, **options):
+        if options['writers'] < 1:
+            raise CommandError('need at least one writer')
+        tmpDir = options['dir'] or tempfile.mkdtemp()
+        try:
+            for label, pragmas in (('default', ()), ('tuned', get_pragmas())):
+                path = os.path.join(tmpDir, 'bench_%s.db' % label)
+                for suffix in ('', '-wal', '-shm', '-journal'):
+                    if os.path.exists(path + suffix):
+                        os.remove(path + suffix)
+                d = run_bench(path, pragmas, options['writers'],
+                              options['readers'], options['transactions'])
+                self.stdout.write('%-8s %7.1f writes/sec %8.1f reads/sec '
+                                  '%5d write errors %5d read errors'
+                                  % (label, d['writes'] / d['elapsed'],
+                                     d['reads'] / d['elapsed'],
+                                     d['writeErrors'], d['readErrors']))
+        finally:
+            if not options['dir']:
+                shutil.rmtree(tmpDir)
@@ -0,0 +1,106 @@
+from optparse import make_option
+import time
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.contrib.auth.models import User
+from ct.models import *
+
+
+def build_unit(nlesson, user):
+    '''create a courselet with nlesson lessons: every other lesson is
+    a question, most questions have error models, some of which have
+    resolutions, and some lessons have new student inquiries'''
+    course = Course(title='Benchmark Course', description='timing test',
+                    addedBy=user)
+    course.save()
+    unit = course.create_unit('Benchmark Courselet', user)
+    for i in range(nlesson):
+        if i % 2:
+            kind = Lesson.ORCT_QUESTION
+        else:
+            kind = Lesson.BASE_EXPLANATION
+        lesson = Lesson(title='lesson %d' % i, text='text %d' % i,
+                        addedBy=user, kind=kind)
+        lesson.save_root()
+        ul = UnitLesson.create_from_lesson(lesson, unit, order=i)
+        if kind == Lesson.ORCT_QUESTION and i % 3:
+            concept = Concept(title='error %d' % i, addedBy=user, isError=True)
+            concept.save()
+            em = Lesson(title='error %d' % i, text='oops', addedBy=user,
+                        kind=Lesson.ERROR_MODEL, concept=concept)
+            em.save_root()
+            UnitLesson.create_from_lesson(em, unit, parent=ul)
+            if i % 5 == 0:
+                reso = Lesson(title='fix %d' % i, text='try this',
+                              addedBy=user)
+                reso.save_root(concept, ConceptLink.RESOLVES)
+                UnitLesson.create_from_lesson(reso, unit,
+                                              kind=UnitLesson.RESOLVES)
+        if i % 7 == 0:
+            Response(lesson=lesson, unitLesson=ul, course=course,
+                     author=user, text='huh?', confidence=Response.GUESS,
+                     kind=Response.STUDENT_QUESTION, needsEval=True).save()
+    return unit
+
+def old_task_table(unit):
+    'task table as unit_tasks built it before get_instructor_tasks()'
+    newInquiryULs = frozenset(unit.get_new_inquiry_uls())
+    ulDict = {}
+    for ul in newInquiryULs:
+        ulDict[ul] = ['inquiry']
+    for ul in unit.get_errorless_uls():
+        ulDict.setdefault(ul, []).append('em')
+    for ul in unit.get_resoless_uls():
+        ulDict.setdefault(ul, []).append('reso')
+    taskTable = [(ul, ulDict[ul]) for ul in newInquiryULs]
+    taskTable += [(ul, ulDict[ul]) for ul in ulDict
+                  if ul not in newInquiryULs]
+    return taskTable
+
+def new_task_table(unit):
+    return unit.get_instructor_tasks()
+
+def time_call(func, unit, repeat):
+    'return (best seconds, number of queries) for func(unit)'
+    best = None
+    for i in range(repeat):
+        with CaptureQueriesContext(connection) as queries:
+            t = time.time()
+            result = func(unit)
+            [ul.lesson.title for ul, tasks in result] # as template does
+            t = time.time() - t
+        if best is None or t < best:
+            best = t
+    return best, len(queries), result
+
+
+class Command(BaseCommand):
+    help = '''Compare unit_tasks task-table queries, old vs. new,
+    on a synthetic courselet built in a temporary test database.'''
+    option_list = BaseCommand.option_list + (
+        make_option('--lessons', type='int', default=500,
+                    help='number of lessons in the courselet'),
+        make_option('--repeat', type='int', default=5,
+                    help='number of timing runs (best time is reported)'),
+    )
+    def handle(self, *args, **options):
+        oldName = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0)
+        try:
+            user = User.objects.create_user('benchmark', 'bench@_', 'bench')
+            unit = build_unit(options['lessons'], user)
+            results = {}
+            for label, func in (('old', old_task_table),
+                                ('new', new_task_table)):
+                t, nquery, taskTable = time_call(func, unit,
+                                                 options['repeat'])
+                results[label] = set((ul.pk, tuple(tasks))
+                                     for ul, tasks in taskTable)
+                self.stdout.write('%s: %.2f ms, %d queries, %d rows'
+                                  % (label, t * 1000., nquery,
+                                     len(taskTable)))
+            if results['old'] != results['new']:
+                self.stderr.write('ERROR: task tables differ!')
+        finally:
+            connection.creation.destroy_test_db(oldName, verbosity=0)
@@ -0,0 +1,31 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+from ct.models import Unit, Course
+
+
+class Command(BaseCommand):
+    args = '<unit_id> <username>'
+    help = '''Copy a courselet and all its lessons, answers, error models
+    and resolutions, with the copy owned by the specified user.'''
+    option_list = BaseCommand.option_list + (
+        make_option('--course', type='int', default=None,
+                    help='ID of course to append the new courselet to'),
+        make_option('--title', default=None,
+                    help='title for the new courselet (default: same)'),
+    )
+    def handle(self, *args, **options):
+        if len(args) != 2:
+            raise CommandError('usage: clone_unit %s' % self.args)
+        try:
+            unit = Unit.objects.get(pk=int(args[0]))
+            user = User.objects.get(username=args[1])
+            course = options['course'] and \
+                     Course.objects.get(pk=options['course'])
+        except (Unit.DoesNotExist, User.DoesNotExist,
+                Course.DoesNotExist) as e:
+            raise CommandError(str(e))
+        newUnit = unit.clone(user, options['title'], course)
+        self.stdout.write('created unit %d (%d lessons) from unit %d'
+                          % (newUnit.pk, newUnit.unitlesson_set.count(),
+                             unit.pk))
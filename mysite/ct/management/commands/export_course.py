@@ -0,0 +1,25 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from ct.models import Course
+from ct.course_bundle import export_course
+
+
+class Command(BaseCommand):
+    args = '<course_id> <bundle_file>'
+    help = '''Export a course, its courselets, lessons (all versions) and
+    concepts to a gzipped JSON-lines course bundle, optionally with
+    anonymized student responses.'''
+    option_list = BaseCommand.option_list + (
+        make_option('--responses', action='store_true', default=False,
+                    help='include anonymized responses and student errors'),
+    )
+    def handle(self, *args, **options):
+        if len(args) != 2:
+            raise CommandError('usage: export_course %s' % self.args)
+        try:
+            course = Course.objects.get(pk=int(args[0]))
+        except (ValueError, Course.DoesNotExist):
+            raise CommandError('no such course: %s' % args[0])
+        counts = export_course(course, args[1], options['responses'])
+        for name in sorted(counts):
+            self.stdout.write('%10d %s' % (counts[name], name))
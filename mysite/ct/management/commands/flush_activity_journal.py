@@ -0,0 +1,19 @@
+from optparse import make_option
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from ct.activity_log import ActivityEventBuffer
+
+
+class Command(BaseCommand):
+    help = '''Write ActivityEvents left in journals by crashed or
+    stopped server processes (CT_ACTIVITY_BUFFER) to the database.
+    Events already written are skipped, so this is safe to re-run.'''
+    option_list = BaseCommand.option_list + (
+        make_option('--dir', default=None,
+                    help='journal directory (default CT_ACTIVITY_JOURNAL_DIR)'),
+    )
+    def handle(self, *args, **options):
+        journalDir = options['dir'] or getattr(settings,
+                        'CT_ACTIVITY_JOURNAL_DIR', 'activity_journal')
+        n = ActivityEventBuffer(journalDir).recover()
+        self.stdout.write('%d activity events recovered' % n)
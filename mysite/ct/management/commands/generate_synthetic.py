@@ -0,0 +1,53 @@
+from optparse import make_option
+import time
+from django.core.management.base import BaseCommand, CommandError
+from ct.synthetic import SyntheticDeployment
+
+
+class Command(BaseCommand):
+    help = '''Fill the database with a reproducible synthetic deployment
+    (courses, courselets, questions, error models, concept graph,
+    students and their responses) for load testing.'''
+    option_list = BaseCommand.option_list + (
+        make_option('--seed', type='int', default=0,
+                    help='random seed (same seed gives same data)'),
+        make_option('--prefix', default='synth',
+                    help='username prefix for generated users'),
+        make_option('--courses', type='int', default=2,
+                    help='number of courses'),
+        make_option('--units', type='int', default=4,
+                    help='number of courselets per course'),
+        make_option('--lessons', type='int', default=20,
+                    help='lessons per courselet (half are questions)'),
+        make_option('--concepts', type='int', default=8,
+                    help='concepts per courselet'),
+        make_option('--error-models', type='int', default=3,
+                    dest='errorModels', help='error models per question'),
+        make_option('--students', type='int', default=100,
+                    help='students enrolled per course'),
+        make_option('--response-rate', type='float', default=0.8,
+                    dest='responseRate',
+                    help='fraction of questions each student answers'),
+        make_option('--classify-rate', type='float', default=0.6,
+                    dest='classifyRate',
+                    help='fraction of wrong answers classified as errors'),
+        make_option('--batch-size', type='int', default=1000,
+                    dest='batchSize',
+                    help='responses generated per bulk write'),
+    )
+    def handle(self, *args, **options):
+        verbose = int(options['verbosity']) > 1
+        deployment = SyntheticDeployment(options['seed'], options['prefix'],
+                        options['batchSize'],
+                        log=verbose and self.stdout.write or None)
+        t = time.time()
+        try:
+            counts = deployment.generate(options['courses'], options['units'],
+                        options['lessons'], options['concepts'],
+                        options['errorModels'], options['students'],
+                        options['responseRate'], options['classifyRate'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        for name in sorted(counts):
+            self.stdout.write('%10d %s' % (counts[name], name))
+        self.stdout.write('generated in %.1f sec' % (time.time() - t))
@@ -0,0 +1,40 @@
+from optparse import make_option
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+from ct.course_bundle import import_course
+
+
+class Command(BaseCommand):
+    args = '<bundle_file>'
+    help = '''Import a course bundle written by export_course as a new
+    course, remapping all primary keys with bulk writes.'''
+    option_list = BaseCommand.option_list + (
+        make_option('--author', default=None,
+                    help='username of instructor (default: user 1)'),
+        make_option('--title', default=None,
+                    help='title for the new course (default: as exported)'),
+        make_option('--batch-size', type='int', default=500,
+                    dest='batchSize', help='rows per bulk write'),
+    )
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('usage: import_course %s' % self.args)
+        try:
+            if options['author']:
+                author = User.objects.get(username=options['author'])
+            else:
+                author = User.objects.get(pk=1) # our default admin user
+        except User.DoesNotExist as e:
+            raise CommandError(str(e))
+        t = time.time()
+        try:
+            course, counts = import_course(args[0], author,
+                                           options['batchSize'],
+                                           options['title'])
+        except (IOError, ValueError) as e:
+            raise CommandError(str(e))
+        for name in sorted(counts):
+            self.stdout.write('%10d %s' % (counts[name], name))
+        self.stdout.write('imported course %d in %.1f sec'
+                          % (course.pk, time.time() - t))
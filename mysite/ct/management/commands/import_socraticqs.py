@@ -0,0 +1,53 @@
+from optparse import make_option
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+from ct.models import Course, Role
+from ct.legacy_import import SocraticqsImporter
+
+
+class Command(BaseCommand):
+    args = '<course_csv> <legacy_db>'
+    help = '''Import a legacy socraticqs course: the courselets listed
+    in course_csv (rows of courselet CSV file, title), and the students,
+    responses and student errors for their questions from the legacy
+    sqlite database, using bulk writes.'''
+    option_list = BaseCommand.option_list + (
+        make_option('--course', type='int', default=None,
+                    help='ID of existing course to import into'),
+        make_option('--title', default='Introduction to Bioinformatics Theory',
+                    help='title of new course to create'),
+        make_option('--author', default=None,
+                    help='username of instructor (default: user 1)'),
+        make_option('--anonymize', default=None,
+                    help='CSV file of uid -> anonymous username (updated)'),
+        make_option('--batch-size', type='int', default=1000,
+                    dest='batchSize', help='legacy rows per bulk write'),
+    )
+    def handle(self, *args, **options):
+        if len(args) != 2:
+            raise CommandError('usage: import_socraticqs %s' % self.args)
+        try:
+            if options['author']:
+                author = User.objects.get(username=options['author'])
+            else:
+                author = User.objects.get(pk=1) # our default admin user
+            if options['course']:
+                course = Course.objects.get(pk=options['course'])
+            else:
+                course = Course(title=options['title'], addedBy=author)
+                course.save()
+                course.role_set.create(user=author, role=Role.INSTRUCTOR)
+        except (User.DoesNotExist, Course.DoesNotExist) as e:
+            raise CommandError(str(e))
+        verbose = int(options['verbosity']) > 0
+        importer = SocraticqsImporter(args[1], course, author,
+                                      options['batchSize'],
+                                      options['anonymize'],
+                                      log=verbose and self.stdout.write or None)
+        t = time.time()
+        counts = importer.run(args[0])
+        for name in sorted(counts):
+            self.stdout.write('%10d %s' % (counts[name], name))
+        self.stdout.write('imported into course %d in %.1f sec'
+                          % (course.pk, time.time() - t))
@@ -0,0 +1,45 @@
+from optparse import make_option
+import calendar
+import time
+from datetime import datetime
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from ct import event_log
+
+
+class Command(BaseCommand):
+    args = '[log_dir]'
+    help = '''Backfill ActivityEvent from the FSM transition event log
+    (default CT_EVENT_LOG_DIR).  Events already in the database are
+    skipped.  With --count, just scan and count transitions.'''
+    option_list = BaseCommand.option_list + (
+        make_option('--fsm', default=None,
+                    help='only load events of this FSM (e.g. randomtrial)'),
+        make_option('--since', default=None,
+                    help='only load events after this UTC date (YYYY-MM-DD)'),
+        make_option('--count', action='store_true', default=False,
+                    help='count transitions per FSM instead of loading'),
+    )
+    def handle(self, *args, **options):
+        logDir = args and args[0] or getattr(settings, 'CT_EVENT_LOG_DIR',
+                                             None)
+        if not logDir:
+            raise CommandError('no log_dir given and CT_EVENT_LOG_DIR not set')
+        since = None
+        if options['since']:
+            try:
+                since = calendar.timegm(datetime.strptime(options['since'],
+                                                '%Y-%m-%d').timetuple())
+            except ValueError as e:
+                raise CommandError(str(e))
+        t = time.time()
+        if options['count']:
+            counts = {}
+            for r in event_log.read_events(logDir, options['fsm'], since):
+                counts[r['fsm']] = counts.get(r['fsm'], 0) + 1
+            for name in sorted(counts):
+                self.stdout.write('%10d %s' % (counts[name], name))
+        else:
+            n = event_log.load_activity_events(logDir, options['fsm'], since)
+            self.stdout.write('%d activity events loaded' % n)
+        self.stdout.write('in %.1f sec' % (time.time() - t))
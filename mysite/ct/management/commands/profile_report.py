@@ -0,0 +1,62 @@
+from optparse import make_option
+import json
+from django.core.management.base import BaseCommand, CommandError
+from ct.profiling import percentile
+
+SORT_KEYS = ('ms', 'sql', 'sqlMs', 'md2html', 'md2htmlMs', 'fsmMs')
+
+
+def read_profile_log(path):
+    'generate request records from a ct.profile JSON-lines log'
+    with open(path) as ifile:
+        for line in ifile:
+            i = line.find('{') # tolerate formatter prefixes
+            if i < 0:
+                continue
+            try:
+                yield json.loads(line[i:])
+            except ValueError: # truncated last line etc.
+                continue
+
+def summarize(records, sortKey='ms'):
+    'list of per-view summary dicts, worst p95 of sortKey first'
+    d = {}
+    for r in records:
+        d.setdefault(r['view'], []).append(r)
+    out = []
+    for view, l in d.items():
+        row = dict(view=view, n=len(l))
+        for k in SORT_KEYS:
+            values = sorted([r.get(k, 0) for r in l])
+            row[k] = sum(values) / float(len(values))
+            row[k + '95'] = percentile(values, 95)
+        out.append(row)
+    out.sort(key=lambda row:row[sortKey + '95'], reverse=True)
+    return out
+
+
+class Command(BaseCommand):
+    args = '<logfile>'
+    help = '''Print the views with the worst 95th percentile cost,
+    from a log written by ct.profiling.ViewProfileMiddleware.'''
+    option_list = BaseCommand.option_list + (
+        make_option('--top', type='int', default=10,
+                    help='number of views to show'),
+        make_option('--sort', default='ms', choices=SORT_KEYS,
+                    help='cost to rank by: %s' % ', '.join(SORT_KEYS)),
+    )
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('usage: profile_report %s' % self.args)
+        try:
+            rows = summarize(read_profile_log(args[0]), options['sort'])
+        except IOError as e:
+            raise CommandError(str(e))
+        self.stdout.write('%6s %9s %9s %7s %9s %9s %9s  %s'
+                          % ('n', 'ms', 'ms95', 'sql', 'sqlMs', 'md2htmlMs',
+                             'fsmMs', 'view'))
+        for row in rows[:options['top']]:
+            self.stdout.write('%6d %9.1f %9.1f %7.1f %9.1f %9.1f %9.1f  %s'
+                              % (row['n'], row['ms'], row['ms95'], row['sql'],
+                                 row['sqlMs'], row['md2htmlMs'], row['fsmMs'],
+                                 row['view']))
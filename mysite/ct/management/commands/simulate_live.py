@@ -0,0 +1,332 @@
+from optparse import make_option
+import cookielib
+import logging
+import random
+import re
+import threading
+import time
+import urllib
+import urllib2
+from urlparse import urlparse
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import resolve, reverse
+from django.db import connection, OperationalError
+from django.test import Client
+from django.contrib.auth.models import User
+from ct.models import *
+from ct.profiling import percentile
+
+LiveIDPat = re.compile(r'name="liveID"\s+value="(\d+)"')
+
+
+class LockError(Exception):
+    'request failed because the database was locked'
+
+class ClientSession(object):
+    'one user driving the WSGI app in-process via the test Client'
+    def __init__(self, stats, username, password):
+        self.stats = stats
+        self.client = Client()
+        for i in range(10): # login writes session and last_login
+            try:
+                if not self.client.login(username=username,
+                                         password=password):
+                    raise ValueError('cannot login as %s' % username)
+                return
+            except OperationalError as e:
+                if 'locked' not in str(e):
+                    raise
+                stats.error('lock')
+        raise LockError('cannot login as %s: database locked' % username)
+    def request(self, method, path, data=None):
+        'return (redirect path or None, page content)'
+        t = time.time()
+        try:
+            if method == 'POST':
+                response = self.client.post(path, data or {},
+                                            HTTP_REFERER=path)
+            else:
+                response = self.client.get(path)
+        except OperationalError as e:
+            if 'locked' not in str(e):
+                self.stats.add(path, time.time() - t, 'error')
+                raise
+            self.stats.add(path, time.time() - t, 'lock')
+            raise LockError(str(e))
+        except Exception: # view raised an error: a 500 on a real server
+            self.stats.add(path, time.time() - t, 'error')
+            raise
+        self.stats.add(path, time.time() - t,
+                       response.status_code >= 400 and 'error' or None)
+        if response.status_code == 302:
+            return urlparse(response['Location']).path, response.content
+        return None, response.content
+    def close(self):
+        connection.close() # each thread has its own db connection
+
+class NoRedirect(urllib2.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None # report 302 as HTTPError, so we see Location
+
+class HTTPSession(object):
+    'one user driving a running server over HTTP'
+    def __init__(self, stats, username, password, baseURL):
+        self.stats = stats
+        self.baseURL = baseURL.rstrip('/')
+        self.cookies = cookielib.CookieJar()
+        self.opener = urllib2.build_opener(NoRedirect,
+                            urllib2.HTTPCookieProcessor(self.cookies))
+        self.request('GET', '/login/')
+        self.request('POST', '/login/', dict(username=username,
+                                             password=password))
+    def _csrf_token(self):
+        for cookie in self.cookies:
+            if cookie.name == 'csrftoken':
+                return cookie.value
+        return ''
+    def request(self, method, path, data=None):
+        'return (redirect path or None, page content)'
+        url = self.baseURL + path
+        body = None
+        if method == 'POST':
+            data = dict(data or {}, csrfmiddlewaretoken=self._csrf_token())
+            body = urllib.urlencode(data, True)
+        req = urllib2.Request(url, body, {'Referer':url})
+        t = time.time()
+        try:
+            response = self.opener.open(req)
+            content = response.read()
+        except urllib2.HTTPError as e:
+            if e.code in (301, 302):
+                self.stats.add(path, time.time() - t, None)
+                return urlparse(e.info()['Location']).path, ''
+            if 'locked' in e.read(): # sqlite contention, not a bug
+                self.stats.add(path, time.time() - t, 'lock')
+                raise LockError(str(e))
+            self.stats.add(path, time.time() - t, 'error')
+            raise
+        self.stats.add(path, time.time() - t, None)
+        return None, content
+    def close(self):
+        pass
+
+class LoadStats(object):
+    'thread-safe latency and error counters'
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {} # url name -> list of seconds
+        self.errors = {'lock':0, 'error':0}
+        self.answered = 0
+        self.assessed = 0
+    def add(self, path, t, error):
+        try:
+            name = resolve(path).url_name
+        except Exception:
+            name = path
+        with self.lock:
+            self.samples.setdefault(name, []).append(t)
+        if error:
+            self.error(error)
+    def error(self, kind):
+        with self.lock:
+            self.errors[kind] += 1
+    def count(self, attr):
+        with self.lock:
+            setattr(self, attr, getattr(self, attr) + 1)
+    def report(self, elapsed):
+        'list of output lines'
+        times = sorted([t for l in self.samples.values() for t in l])
+        lines = ['%d requests in %.1f sec: %.1f requests/sec'
+                 % (len(times), elapsed, len(times) / elapsed),
+                 'latency msec: p50 %.1f, p95 %.1f, p99 %.1f, max %.1f'
+                 % tuple([1000. * (percentile(times, p) or 0)
+                          for p in (50, 95, 99, 100)]),
+                 'db lock errors: %d, other errors: %d'
+                 % (self.errors['lock'], self.errors['error']),
+                 '%-22s %6s %9s %9s' % ('view', 'n', 'p50 ms', 'p99 ms')]
+        for name, l in sorted(self.samples.items()):
+            l = sorted(l)
+            lines.append('%-22s %6d %9.1f %9.1f' % (name, len(l),
+                         1000. * percentile(l, 50), 1000. * percentile(l, 99)))
+        return lines
+
+
+def run_student(session, stats, rng, think, timeout, stop=None):
+    'join the live session and follow livestudent until it ends'
+    path = reverse('ct:home')
+    deadline = time.time() + timeout
+    while path and time.time() < deadline and not (stop and stop.is_set()):
+        name = resolve(path).url_name
+        time.sleep(rng.uniform(0, think))
+        try:
+            if name == 'home': # join the live session, if still running
+                path, content = session.request('GET', path)
+                liveIDs = LiveIDPat.findall(content)
+                if not liveIDs:
+                    return
+                path, content = session.request('POST', reverse('ct:home'),
+                                                dict(liveID=liveIDs[-1]))
+            elif name == 'fsm_node': # START, or waiting for instructor
+                path, content = session.request('POST', path,
+                                                dict(fsmedge='next'))
+            elif name == 'ul_respond':
+                session.request('GET', path)
+                path, content = session.request('POST', path,
+                                dict(text='my answer %d' % rng.randrange(100),
+                                     confidence=rng.choice((Response.GUESS,
+                                        Response.UNSURE, Response.SURE))))
+                stats.count('answered')
+            elif name == 'assess':
+                session.request('GET', path)
+                path, content = session.request('POST', path,
+                                dict(selfeval=rng.choice((Response.CORRECT,
+                                        Response.CLOSE, Response.DIFFERENT)),
+                                     status=rng.choice((DONE_STATUS,
+                                        NEED_REVIEW_STATUS)), liked=''))
+                stats.count('assessed')
+            else: # END: unit tasks page
+                session.request('GET', path)
+                return
+        except LockError: # retry same step, as a student would
+            pass
+
+def wait_for(stats, attr, n, seconds, poll=0.2):
+    'wait until stats.attr reaches n, or seconds elapse'
+    deadline = time.time() + seconds
+    while getattr(stats, attr) < n and time.time() < deadline:
+        time.sleep(poll)
+
+def run_instructor(session, stats, course, unit, questions, nstudent,
+                   answerTime, assessTime):
+    'run liveteach: ask each question, then quit'
+    args = (course.pk, unit.pk)
+    path, content = session.request('POST',
+                        reverse('ct:unit_tasks', args=args), dict(task='start'))
+    path, content = session.request('POST', path, dict(fsmedge='next'))
+    for i, ul in enumerate(questions):
+        path, content = session.request('POST', path,
+                            dict(fsmtask='select_UnitLesson', selectID=ul.pk))
+        session.request('POST', path, dict(task='start')) # live_question
+        if i == 0:
+            yield # let students join
+        wait_for(stats, 'answered', nstudent * (i + 1), answerTime)
+        path, content = session.request('POST', path, dict(fsmtask='next'))
+        wait_for(stats, 'assessed', nstudent * (i + 1), assessTime)
+        path, content = session.request('POST', path, dict(fsmtask='next'))
+        edge = i + 1 < len(questions) and 'next' or 'quit'
+        path, content = session.request('POST', path, dict(fsmedge=edge))
+
+def simulate(stats, new_session, instructor, course, unit, questions,
+             students, think, answerTime, assessTime, seed=0):
+    '''run one live session, each student in its own thread, with
+    sessions from new_session(username); returns (elapsed seconds,
+    list of student error messages)'''
+    teacher = new_session(instructor.username)
+    timeout = len(questions) * (answerTime + assessTime) + 60.
+    errors = []
+    stop = threading.Event()
+    def student_thread(username, seed):
+        try:
+            session = new_session(username)
+            try:
+                run_student(session, stats, random.Random(seed), think,
+                            timeout, stop)
+            finally:
+                session.close()
+        except Exception as e:
+            errors.append('%s: %s: %s' % (username, e.__class__.__name__, e))
+    t = time.time()
+    instructorRun = run_instructor(teacher, stats, course, unit, questions,
+                                   len(students), answerTime, assessTime)
+    next(instructorRun) # session is live and first question asked
+    threads = [threading.Thread(target=student_thread,
+                                args=(user.username, seed + i))
+               for i, user in enumerate(students)]
+    try:
+        for thread in threads:
+            thread.daemon = True # never outlive a failed run
+            thread.start()
+        for step in instructorRun:
+            pass
+    except BaseException:
+        stop.set() # no more questions are coming
+        raise
+    finally:
+        for thread in threads:
+            if thread.ident is not None: # started
+                thread.join()
+    return time.time() - t, errors
+
+
+class Command(BaseCommand):
+    args = '<course_id> <unit_id>'
+    help = '''Simulate a live classroom session: one instructor runs
+    liveteach on questions in the courselet while many students, each
+    in its own thread, run livestudent.  Reports throughput, latency
+    and database lock errors.  By default drives the WSGI app
+    in-process (against the configured database); use --url to load
+    a running server.'''
+    option_list = BaseCommand.option_list + (
+        make_option('--students', type='int', default=50,
+                    help='number of concurrent students'),
+        make_option('--questions', type='int', default=3,
+                    help='number of questions to ask'),
+        make_option('--instructor', default=None,
+                    help='username of instructor (default: course owner)'),
+        make_option('--password', default='synthetic',
+                    help='password of all simulated users'),
+        make_option('--think', type='float', default=1.,
+                    help='maximum student think time between clicks (sec)'),
+        make_option('--answer-time', type='float', default=30.,
+                    dest='answerTime',
+                    help='maximum time students get to answer (sec)'),
+        make_option('--assess-time', type='float', default=30.,
+                    dest='assessTime',
+                    help='maximum time students get to self-assess (sec)'),
+        make_option('--url', default=None,
+                    help='base URL of a running server to load instead'),
+        make_option('--seed', type='int', default=0,
+                    help='random seed for student choices'),
+    )
+    def handle(self, *args, **options):
+        if len(args) != 2:
+            raise CommandError('usage: simulate_live %s' % self.args)
+        try:
+            course = Course.objects.get(pk=int(args[0]))
+            unit = course.courseunit_set.get(unit=int(args[1])).unit
+            instructor = course.addedBy
+            if options['instructor']:
+                instructor = User.objects.get(username=options['instructor'])
+        except (Course.DoesNotExist, CourseUnit.DoesNotExist,
+                User.DoesNotExist) as e:
+            raise CommandError(str(e))
+        questions = [ul for ul in unit.get_exercises()
+                     if ul.lesson.kind == Lesson.ORCT_QUESTION]
+        questions = questions[:options['questions']]
+        students = list(User.objects.filter(role__course=course,
+                        role__role=Role.ENROLLED)[:options['students']])
+        if not questions or not students:
+            raise CommandError('courselet needs questions and enrolled students')
+        for name in ('liveteach', 'livestudent'):
+            if not FSM.objects.filter(name=name).exists():
+                mod = __import__('ct.fsm_plugin.' + {'liveteach':'live'}
+                                 .get(name, name), fromlist=['get_specs'])
+                mod.get_specs()[0].save_graph(instructor.username)
+        stats = LoadStats()
+        if not options['url']: # errors are counted, don't log tracebacks
+            logging.getLogger('django.request').setLevel(logging.CRITICAL)
+        def new_session(username):
+            if options['url']:
+                return HTTPSession(stats, username, options['password'],
+                                   options['url'])
+            return ClientSession(stats, username, options['password'])
+        elapsed, errors = simulate(stats, new_session, instructor, course,
+                                   unit, questions, students,
+                                   options['think'], options['answerTime'],
+                                   options['assessTime'], options['seed'])
+        for line in stats.report(elapsed):
+            self.stdout.write(line)
+        self.stdout.write('%d students answered %d, assessed %d'
+                          % (len(students), stats.answered, stats.assessed))
+        for e in errors[:10]:
+            self.stderr.write('student error: ' + e)
@@ -0,0 +1,37 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+from ct.models import Lesson, TextBlob
+
+
+class Command(BaseCommand):
+    help = '''Report the space saved by storing Lesson texts as shared,
+    content-addressed TextBlobs (optionally purging unused blobs).'''
+    option_list = BaseCommand.option_list + (
+        make_option('--purge', action='store_true', default=False,
+                    help='delete blobs no longer used by any Lesson'),
+    )
+    def handle(self, *args, **options):
+        nlesson = Lesson.objects.filter(textBlob__isnull=False).count()
+        nblob = total = stored = unused = 0
+        for size, storedSize, n in TextBlob.objects \
+          .annotate(n=Count('lesson')).values_list('size', 'storedSize', 'n'):
+            if n:
+                nblob += 1
+                total += size * n # bytes if each lesson had its own copy
+                stored += storedSize
+            else:
+                unused += storedSize
+        saved = total - stored
+        self.stdout.write('%d lessons share %d text blobs'
+                          % (nlesson, nblob))
+        self.stdout.write('%12d bytes of lesson text' % total)
+        self.stdout.write('%12d bytes stored' % stored)
+        self.stdout.write('%12d bytes saved (%.1f%%)'
+                          % (saved, 100. * saved / (total or 1)))
+        if options['purge']:
+            n = TextBlob.purge_orphans()
+            self.stdout.write('purged %d unused blobs' % n)
+        elif unused:
+            self.stdout.write('%12d bytes in unused blobs (see --purge)'
+                              % unused)
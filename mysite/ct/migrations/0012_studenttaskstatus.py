@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.utils.timezone
+from django.conf import settings
+
+
+# values as of this migration, so replaying it never changes
+ORCT_RESPONSE = 'orct'
+DIFFERENT = 'different'
+NEED_HELP_STATUS = 'help'
+NEED_REVIEW_STATUS = 'review'
+
+def get_task_flags(responses, errorStatus):
+    '''StudentTaskStatus flags for one student on one UnitLesson
+    (a frozen copy of ct.models.get_task_flags)'''
+    d = dict(answered=False, needsSelfeval=False, needsClassify=False,
+             needsResolve=False)
+    for r in responses:
+        if r['kind'] == ORCT_RESPONSE:
+            d['answered'] = True
+            if r['selfeval'] is None:
+                d['needsSelfeval'] = True
+        seList = errorStatus.get(r['pk'], ())
+        if (r['selfeval'] == DIFFERENT or r['status'] == NEED_HELP_STATUS) \
+          and not seList:
+            d['needsClassify'] = True
+        for status in seList:
+            if status in (NEED_HELP_STATUS, NEED_REVIEW_STATUS):
+                d['needsResolve'] = True
+    return d
+
+def fill_task_status(apps, schema_editor):
+    'compute StudentTaskStatus rows from existing Response data'
+    Response = apps.get_model('ct', 'Response')
+    StudentError = apps.get_model('ct', 'StudentError')
+    UnitLesson = apps.get_model('ct', 'UnitLesson')
+    StudentTaskStatus = apps.get_model('ct', 'StudentTaskStatus')
+    errorStatus = {}
+    for se in StudentError.objects.values('response', 'status'):
+        errorStatus.setdefault(se['response'], []).append(se['status'])
+    responses = {}
+    for r in Response.objects.values('pk', 'author', 'unitLesson', 'kind',
+                                     'selfeval', 'status'):
+        responses.setdefault((r['author'], r['unitLesson']), []).append(r)
+    unitIDs = dict(UnitLesson.objects.values_list('pk', 'unit'))
+    l = []
+    for (userID, ulID), rlist in responses.items():
+        l.append(StudentTaskStatus(user_id=userID, unitLesson_id=ulID,
+                                   unit_id=unitIDs[ulID],
+                                   **get_task_flags(rlist, errorStatus)))
+    StudentTaskStatus.objects.bulk_create(l, batch_size=500)
+
+def drop_task_status(apps, schema_editor):
+    'nothing to undo: the table itself is dropped'
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('ct', '0011_auto_20150129_1209'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StudentTaskStatus',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('answered', models.BooleanField(default=False)),
+                ('needsSelfeval', models.BooleanField(default=False)),
+                ('needsClassify', models.BooleanField(default=False)),
+                ('needsResolve', models.BooleanField(default=False)),
+                ('atime', models.DateTimeField(default=django.utils.timezone.now, verbose_name=b'time updated')),
+                ('unit', models.ForeignKey(to='ct.Unit')),
+                ('unitLesson', models.ForeignKey(to='ct.UnitLesson')),
+                ('user', models.ForeignKey(to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='studenttaskstatus',
+            unique_together=set([('user', 'unitLesson')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='studenttaskstatus',
+            index_together=set([('user', 'unit')]),
+        ),
+        migrations.RunPython(fill_task_status, drop_task_status),
+    ]
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import ct.models
+
+
+def fill_term(apps, schema_editor):
+    'partition existing ActivityLogs by the term they started in'
+    from ct.models import get_term
+    ActivityLog = apps.get_model('ct', 'ActivityLog')
+    for a in ActivityLog.objects.all():
+        a.term = get_term(a.startTime)
+        a.save()
+
+def unfill_term(apps, schema_editor):
+    'nothing to undo: the term column is dropped'
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ct', '0012_studenttaskstatus'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='activitylog',
+            name='archived',
+            field=models.DateTimeField(null=True, verbose_name=b'time archived'),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='activitylog',
+            name='term',
+            field=models.CharField(default=ct.models.get_term, max_length=32),
+            preserve_default=True,
+        ),
+        migrations.AlterIndexTogether(
+            name='activitylog',
+            index_together=set([('fsmName', 'course', 'term')]),
+        ),
+        migrations.RunPython(fill_term, unfill_term),
+    ]
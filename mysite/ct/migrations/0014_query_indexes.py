@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ct', '0013_activitylog_term'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='unitlesson',
+            name='treeID',
+            field=models.IntegerField(db_index=True),
+            preserve_default=True,
+        ),
+        migrations.AlterIndexTogether(
+            name='response',
+            index_together=set([('author', 'unitLesson'), ('unitLesson', 'activity', 'kind'), ('unitLesson', 'selfeval')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='studenterror',
+            index_together=set([('response', 'errorModel')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='unitlesson',
+            index_together=set([('unit', 'kind', 'order'), ('unit', 'order')]),
+        ),
+    ]
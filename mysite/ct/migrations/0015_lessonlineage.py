@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.db.models import Q
+
+
+def fill_lineage(apps, schema_editor):
+    'index the history of existing Lesson commits'
+    from ct.models import get_lineage_rows
+    Lesson = apps.get_model('ct', 'Lesson')
+    LessonLineage = apps.get_model('ct', 'LessonLineage')
+    parents = dict([(t[0], t[1:]) for t in Lesson.objects.filter(
+        Q(parent__isnull=False) | Q(mergeParent__isnull=False))
+        .values_list('pk', 'parent', 'mergeParent')])
+    LessonLineage.objects.bulk_create([LessonLineage(ancestor_id=a,
+                                            descendant_id=pk, depth=depth)
+                                       for (a, pk), depth
+                                       in get_lineage_rows(parents).items()],
+                                      batch_size=500)
+
+def drop_lineage(apps, schema_editor):
+    'nothing to undo: the table itself is dropped'
+    pass
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ct', '0014_query_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LessonLineage',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('depth', models.IntegerField()),
+                ('ancestor', models.ForeignKey(related_name='descendantLinks', to='ct.Lesson')),
+                ('descendant', models.ForeignKey(related_name='ancestorLinks', to='ct.Lesson')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='lessonlineage',
+            unique_together=set([('ancestor', 'descendant')]),
+        ),
+        migrations.RunPython(fill_lineage, drop_lineage),
+    ]
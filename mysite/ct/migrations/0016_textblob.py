@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import hashlib
+import zlib
+from django.conf import settings
+from django.db import models, migrations
+
+
+def get_blob_fields(text):
+    '''TextBlob field values for text, compressed if at least
+    CT_TEXTBLOB_COMPRESS_MIN bytes long (a frozen copy of
+    ct.models.get_blob_fields)'''
+    raw = text.encode('utf-8')
+    d = dict(hash=hashlib.sha1(raw).hexdigest(), size=len(raw), text=text,
+             data=None, storedSize=len(raw))
+    compressMin = getattr(settings, 'CT_TEXTBLOB_COMPRESS_MIN', None)
+    if compressMin is not None and len(raw) >= compressMin:
+        data = zlib.compress(raw, 9)
+        if len(data) < len(raw):
+            d.update(text=None, data=data, storedSize=len(data))
+    return d
+
+def fill_blobs(apps, schema_editor):
+    'move Lesson.text into deduplicated TextBlobs'
+    Lesson = apps.get_model('ct', 'Lesson')
+    TextBlob = apps.get_model('ct', 'TextBlob')
+    blobs = {}
+    lessonHashes = {} # hash -> [lesson IDs]
+    for pk, text in Lesson.objects.filter(text__isnull=False) \
+                                  .values_list('pk', 'text').iterator():
+        d = get_blob_fields(text)
+        blobs.setdefault(d['hash'], d)
+        lessonHashes.setdefault(d['hash'], []).append(pk)
+    TextBlob.objects.bulk_create([TextBlob(**d) for d in blobs.values()],
+                                 batch_size=200)
+    for h, pks in lessonHashes.items():
+        for i in range(0, len(pks), 500):
+            Lesson.objects.filter(pk__in=pks[i:i + 500]).update(textBlob=h)
+
+def unfill_blobs(apps, schema_editor):
+    'copy TextBlob contents back into Lesson.text'
+    Lesson = apps.get_model('ct', 'Lesson')
+    TextBlob = apps.get_model('ct', 'TextBlob')
+    for blob in TextBlob.objects.all().iterator():
+        if blob.data is not None:
+            text = zlib.decompress(blob.data).decode('utf-8')
+        else:
+            text = blob.text
+        Lesson.objects.filter(textBlob=blob.pk).update(text=text)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ct', '0015_lessonlineage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TextBlob',
+            fields=[
+                ('hash', models.CharField(max_length=40, serialize=False, primary_key=True)),
+                ('text', models.TextField(null=True)),
+                ('data', models.BinaryField(null=True)),
+                ('size', models.IntegerField()),
+                ('storedSize', models.IntegerField()),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AddField(
+            model_name='lesson',
+            name='textBlob',
+            field=models.ForeignKey(to='ct.TextBlob', null=True),
+            preserve_default=True,
+        ),
+        migrations.RunPython(fill_blobs, unfill_blobs),
+        migrations.RemoveField(
+            model_name='lesson',
+            name='text',
+        ),
+    ]
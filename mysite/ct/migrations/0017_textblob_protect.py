@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ct', '0016_textblob'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='lesson',
+            name='textBlob',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='ct.TextBlob', null=True),
+            preserve_default=True,
+        ),
+    ]
@@ -1,12 +1,26 @@
-from django.db import models, transaction
+from django.db import models, transaction, connection, IntegrityError
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.exceptions import ObjectDoesNotExist
+from django.core.cache import cache
 from django.utils import timezone
 from django.core.urlresolvers import reverse
 from django.db.models import Q, Count, Max
+from django.db.models.signals import post_save, post_delete
+from django.db.backends.signals import connection_created
+from django.core.signals import request_finished
 import glob
+from datetime import timedelta
+import copy
+import difflib
 import json
+import zlib
+from collections import OrderedDict
 import ct_util
+from ct.sqlite_tuning import set_pragmas, retry_on_busy
+from ct import concept_graph
+
+connection_created.connect(set_pragmas) # WAL etc. for sqlite
 
 
 ########################################################
@@ -93,17 +107,22 @@ class Concept(models.Model):
                     unitlesson__kind=UnitLesson.MISUNDERSTANDS,
                     unitlesson__lesson__concept=self, **kwargs))
     def get_conceptlinks(self, unit):
-        'get list of conceptLinks deduped on (treeID, relationship)'
-        d = {}
-        for cl in ConceptLink.objects.filter(concept=self):
-            for ul in UnitLesson.objects.filter(lesson=cl.lesson):
+        '''get list of conceptLinks deduped on (treeID, relationship),
+        preferring UnitLessons in unit, ordered by relationship'''
+        ulDict = {}
+        for ul in UnitLesson.objects.filter(lesson__conceptlink__concept=self) \
+                .distinct().order_by('pk'):
+            ulDict.setdefault(ul.lesson_id, []).append(ul)
+        d = OrderedDict()
+        for cl in ConceptLink.objects.filter(concept=self) \
+                .select_related('lesson').order_by('relationship', 'pk'):
+            for ul in ulDict.get(cl.lesson_id, ()):
                 t = (ul.treeID, cl.relationship)
-                if t not in d or ul.unit == unit:
+                if t not in d or ul.unit_id == unit.pk:
+                    cl = copy.copy(cl) # one object per (treeID, relationship)
                     cl.unitLesson = ul # add attribute to keep this info
                     d[t] = cl
-        l = d.values()
-        l.sort(lambda x,y:cmp(x.relationship, y.relationship))
-        return l
+        return d.values()
     def __unicode__(self):
         return self.title
             
@@ -138,6 +157,11 @@ class ConceptGraph(models.Model):
                                    related_name='approvedConceptEdges')
     atime = models.DateTimeField('time submitted', default=timezone.now)
 
+# keep the in-memory concept graph index in step, incl. cascade deletes
+post_save.connect(concept_graph.edge_saved, sender=ConceptGraph)
+post_delete.connect(concept_graph.edge_deleted, sender=ConceptGraph)
+request_finished.connect(concept_graph.sync)
+
 ########################################################
 # version-controlled teaching material
 
@@ -153,6 +177,94 @@ ACCESS_CHOICES = (
 )
 
 
+def get_blob_fields(text):
+    '''TextBlob field values for text, compressed if at least
+    CT_TEXTBLOB_COMPRESS_MIN bytes long (None: never compress)'''
+    raw = text.encode('utf-8')
+    d = dict(hash=ct_util.text_hash(text), size=len(raw), text=text,
+             data=None, storedSize=len(raw))
+    compressMin = getattr(settings, 'CT_TEXTBLOB_COMPRESS_MIN', None)
+    if compressMin is not None and len(raw) >= compressMin:
+        data = zlib.compress(raw, 9)
+        if len(data) < len(raw):
+            d.update(text=None, data=data, storedSize=len(data))
+    return d
+
+class TextBlob(models.Model):
+    '''content-addressed Lesson text: identical texts (edits, copies,
+    sourceDB imports) share one row.  Compressed blobs (data) cannot be
+    matched by SQL text search.'''
+    hash = models.CharField(max_length=40, primary_key=True) # SHA-1 of text
+    text = models.TextField(null=True) # null if compressed
+    data = models.BinaryField(null=True) # zlib-compressed UTF-8 text
+    size = models.IntegerField() # bytes of UTF-8 text
+    storedSize = models.IntegerField() # bytes actually stored
+    def get_text(self):
+        if self.data is not None:
+            return zlib.decompress(self.data).decode('utf-8')
+        return self.text
+    @classmethod
+    def load_text(klass, textHash):
+        'text with this hash, from the cache if possible'
+        key = 'ct.textblob.' + textHash
+        text = cache.get(key)
+        if text is None:
+            text = klass.objects.get(pk=textHash).get_text()
+            cache.set(key, text, getattr(settings, 'CT_TEXTBLOB_CACHE_TIMEOUT',
+                                         24 * 3600))
+        return text
+    @classmethod
+    def store_many(klass, texts, batchSize=500):
+        'make sure a blob exists for each text (not None) in texts'
+        blobs = {}
+        for text in texts:
+            if text is not None:
+                h = ct_util.text_hash(text)
+                if h not in blobs:
+                    blobs[h] = text
+        hashes = list(blobs)
+        for i in range(0, len(hashes), batchSize): # skip stored ones
+            for h in klass.objects.filter(pk__in=hashes[i:i + batchSize]) \
+                                  .values_list('pk', flat=True):
+                del blobs[h]
+        try:
+            with transaction.atomic():
+                klass.objects.bulk_create([klass(**get_blob_fields(text))
+                                           for text in blobs.values()],
+                                          batch_size=batchSize)
+        except IntegrityError: # another process stored some: one at a time
+            for text in blobs.values():
+                klass.store(text)
+    @classmethod
+    def store(klass, text):
+        'make sure a blob exists for text'
+        d = get_blob_fields(text)
+        if not klass.objects.filter(pk=d['hash']).exists():
+            try:
+                with transaction.atomic():
+                    klass.objects.create(**d)
+            except IntegrityError: # stored meanwhile by another process
+                pass
+    @classmethod
+    def get_orphans(klass):
+        'blobs no longer used by any Lesson'
+        return klass.objects.filter(lesson__isnull=True)
+    @classmethod
+    def purge_orphans(klass):
+        '''delete blobs no longer used by any Lesson, in one statement,
+        so a Lesson saved meanwhile cannot lose its blob; returns count'''
+        qn = connection.ops.quote_name
+        lessonField = Lesson._meta.get_field('textBlob')
+        cursor = connection.cursor()
+        cursor.execute('DELETE FROM %s WHERE NOT EXISTS (SELECT 1 FROM %s '
+                       'WHERE %s.%s = %s.%s)' % (
+                           qn(klass._meta.db_table),
+                           qn(Lesson._meta.db_table), qn(Lesson._meta.db_table),
+                           qn(lessonField.column), qn(klass._meta.db_table),
+                           qn(klass._meta.pk.column)))
+        return cursor.rowcount
+
+
 class Lesson(models.Model):
     BASE_EXPLANATION = 'base' # focused on one concept, as intro for ORCT
     EXPLANATION = 'explanation' # conventional textbook or lecture explanation
@@ -208,7 +320,8 @@ class Lesson(models.Model):
     )
     _sourceDBdict = {}
     title = models.CharField(max_length=100)
-    text = models.TextField(null=True)
+    textBlob = models.ForeignKey(TextBlob, null=True, # see text property
+                                 on_delete=models.PROTECT)
     data = models.TextField(null=True) # JSON DATA
     url = models.CharField(max_length=256, null=True)
     kind = models.CharField(max_length=10, choices=KIND_CHOICES,
@@ -285,6 +398,63 @@ class Lesson(models.Model):
                 relationship = DEFAULT_RELATION_MAP[self.kind]
             self.conceptlink_set.create(concept=concept,
                         addedBy=self.addedBy, relationship=relationship)
+    def _get_text(self):
+        try:
+            return self._text
+        except AttributeError:
+            pass
+        if self.textBlob_id is None:
+            self._text = None
+        elif hasattr(self, '_textBlob_cache'): # from select_related()
+            self._text = self._textBlob_cache.get_text()
+        else:
+            self._text = TextBlob.load_text(self.textBlob_id)
+        return self._text
+    def _set_text(self, text):
+        self._text = text
+        self._textChanged = True
+        self.__dict__.pop('_textBlob_cache', None) # now stale
+        self.textBlob_id = text is not None and ct_util.text_hash(text) \
+          or None
+    text = property(_get_text, _set_text, doc='lesson body (in TextBlob)')
+    def save(self, *args, **kwargs):
+        '''save (storing text in its TextBlob), adding a new commit to
+        the LessonLineage closure table'''
+        if getattr(self, '_textChanged', False):
+            if self._text is not None:
+                TextBlob.store(self._text)
+            self._textChanged = False
+        isNew = self.pk is None
+        super(Lesson, self).save(*args, **kwargs)
+        if isNew and (self.parent_id or self.mergeParent_id):
+            LessonLineage.add_commit(self)
+    @classmethod
+    def get_latest(klass, treeIDs=None):
+        'query set of the latest commit of each tree (or of treeIDs)'
+        latest = klass.objects.values('treeID').annotate(latest=Max('pk'))
+        if treeIDs is not None:
+            latest = latest.filter(treeID__in=treeIDs)
+        return klass.objects.filter(pk__in=latest.values('latest'))
+    def get_ancestors(self):
+        'query set of all earlier commits of this lesson, newest first'
+        return Lesson.objects.filter(descendantLinks__descendant=self) \
+          .order_by('descendantLinks__depth', 'pk')
+    def get_descendants(self):
+        'query set of all later commits derived from this lesson'
+        return Lesson.objects.filter(ancestorLinks__ancestor=self) \
+          .order_by('ancestorLinks__depth', 'pk')
+    def get_diff(self, other):
+        '''(commits from self to its descendant other, oldest first,
+        unified diff lines of title + text)'''
+        commits = list(Lesson.objects.filter(ancestorLinks__ancestor=self,
+                                             descendantLinks__descendant=other)
+                       .order_by('ancestorLinks__depth', 'pk')) + [other]
+        def lines(lesson):
+            return (lesson.title + '\n' + (lesson.text or '')).splitlines()
+        diff = list(difflib.unified_diff(lines(self), lines(other),
+                                         'lesson %d' % self.pk,
+                                         'lesson %d' % other.pk, lineterm=''))
+        return commits, diff
     def __unicode__(self):
         return self.title
     ## def get_url(self):
@@ -293,6 +463,64 @@ class Lesson(models.Model):
     ##     else:
     ##         return reverse('ct:lesson', args=(self.id,))
 
+def get_lineage_rows(parents):
+    '''closure of the commit graph parents {lesson ID:(parent ID,
+    mergeParent ID)}, as {(ancestor ID, descendant ID):depth}'''
+    closure = {} # descendant -> {ancestor:depth}
+    def get_ancestors(pk):
+        try:
+            return closure[pk]
+        except KeyError:
+            pass
+        d = {}
+        for parentID in parents.get(pk, ()):
+            if parentID:
+                d[parentID] = 1
+                for a, depth in get_ancestors(parentID).items():
+                    d[a] = min(d.get(a, depth + 1), depth + 1)
+        closure[pk] = d
+        return d
+    rows = {}
+    for pk in sorted(parents): # parent commits have lower IDs
+        for a, depth in get_ancestors(pk).items():
+            rows[(a, pk)] = depth
+    return rows
+
+class LessonLineage(models.Model):
+    '''closure table of Lesson commit history: one row for every
+    (ancestor, descendant) pair, so a lesson's full history is one query'''
+    ancestor = models.ForeignKey(Lesson, related_name='descendantLinks')
+    descendant = models.ForeignKey(Lesson, related_name='ancestorLinks')
+    depth = models.IntegerField() # commits from ancestor to descendant
+    class Meta:
+        unique_together = (('ancestor', 'descendant'),)
+    @classmethod
+    def add_commit(klass, lesson):
+        'add rows linking a new commit to all its ancestors'
+        d = {}
+        parentIDs = [pk for pk in (lesson.parent_id, lesson.mergeParent_id)
+                     if pk]
+        for parentID in parentIDs:
+            d[parentID] = 1
+        for a, depth in klass.objects.filter(descendant__in=parentIDs) \
+                                     .values_list('ancestor', 'depth'):
+            d[a] = min(d.get(a, depth + 1), depth + 1)
+        klass.objects.bulk_create([klass(ancestor_id=a, descendant=lesson,
+                                         depth=depth)
+                                   for a, depth in d.items()])
+    @classmethod
+    def rebuild(klass):
+        'recompute the whole table, e.g. after bulk_create() of commits'
+        parents = dict([(t[0], t[1:]) for t in Lesson.objects.filter(
+            Q(parent__isnull=False) | Q(mergeParent__isnull=False))
+            .values_list('pk', 'parent', 'mergeParent')])
+        with transaction.atomic():
+            klass.objects.all().delete()
+            klass.objects.bulk_create([klass(ancestor_id=a, descendant_id=pk,
+                                             depth=depth) for (a, pk), depth
+                                       in get_lineage_rows(parents).items()],
+                                      batch_size=500)
+
 def distinct_subset(inlist, distinct_func=lambda x:x.treeID):
     'eliminate duplicate treeIDs from the input list'
     s = set()
@@ -404,8 +632,10 @@ class UnitLesson(models.Model):
     order = models.IntegerField(null=True)
     atime = models.DateTimeField('time added', default=timezone.now)
     addedBy = models.ForeignKey(User)
-    treeID = models.IntegerField() # VCS METADATA
+    treeID = models.IntegerField(db_index=True) # VCS METADATA
     branch = models.CharField(max_length=32, default='master')
+    class Meta:
+        index_together = (('unit', 'order'), ('unit', 'kind', 'order'))
     ## @classmethod
     ## def create_from_concept(klass, concept, unit=None, ulArgs={}, **kwargs):
     ##     'create lesson for initial concept definition'
@@ -450,7 +680,7 @@ class UnitLesson(models.Model):
             kwargs['lesson__concept__isnull'] = False
             kwargs['lesson__concept__isError'] = False
         out = klass.objects.filter((Q(lesson__title__icontains=s) |
-                                    Q(lesson__text__icontains=s)) &
+                                    Q(lesson__textBlob__text__icontains=s)) &
                                    Q(**kwargs)).distinct()
         if excludeArgs:
             out = out.exclude(**excludeArgs)
@@ -490,13 +720,9 @@ class UnitLesson(models.Model):
         'copy self and children to new unit'
         if order == 'APPEND':
             order = unit.next_order()
-        ul = self.__class__(lesson=self.lesson, addedBy=addedBy, unit=unit,
-                            kind=self.kind, treeID=self.treeID,
-                            parent=parent, order=order, **kwargs)
-        ul.save()
-        for child in self.unitlesson_set.all(): # copy children
-            child.copy(unit, addedBy, parent=ul, **kwargs)
-        return ul
+        pkMap = copy_unitlesson_trees([(self, parent and parent.pk, order)],
+                                      unit, addedBy, **kwargs)
+        return self.__class__.objects.get(pk=pkMap[self.pk])
     def get_url(self, basePath, forceDefault=False, subpath=None,
                 isTeach=True):
         'get URL path for this UL'
@@ -531,6 +757,79 @@ class UnitLesson(models.Model):
         'is this a question?'
         return self.lesson.kind == Lesson.ORCT_QUESTION
 
+def bulk_insert(klass, objs, batchSize=None, **kwargs):
+    '''bulk_create objs and return their new pks in insertion order.
+    batchSize=None lets the db backend pick a safe rows-per-INSERT.
+    bulk_create() does not set pks on sqlite, so we read back the rows
+    above the previous max pk (optionally filtered by kwargs); this
+    assumes writers are serialized, as sqlite does inside a transaction.'''
+    if not objs:
+        return []
+    if klass is Lesson: # bulk_create() bypasses Lesson.save()
+        TextBlob.store_many([o.text for o in objs])
+    with transaction.atomic():
+        lastID = klass.objects.aggregate(n=Max('pk'))['n'] or 0
+        klass.objects.bulk_create(objs, batch_size=batchSize)
+        pks = list(klass.objects.filter(pk__gt=lastID, **kwargs)
+                   .order_by('pk').values_list('pk', flat=True))
+    if len(pks) != len(objs):
+        raise ValueError('bulk_insert() could not identify new %s rows'
+                         % klass.__name__)
+    return pks
+
+def copy_unitlesson_trees(roots, unit, addedBy, childDict=None,
+                          keepChildOrder=False, **kwargs):
+    '''copy UnitLesson trees into unit with one bulk INSERT per tree level.
+    roots: list of (ul, parent pk, order) for the top of each tree.
+    childDict: dict of parent pk -> child ULs; if None, children are
+    loaded from the db with one query per tree level.
+    Returns dict mapping old pk -> new pk.'''
+    pkMap = {}
+    level = roots
+    with transaction.atomic():
+        while level:
+            newULs = [UnitLesson(lesson_id=ul.lesson_id, addedBy=addedBy,
+                                 unit=unit, kind=ul.kind, treeID=ul.treeID,
+                                 parent_id=parentID, order=order, **kwargs)
+                      for ul, parentID, order in level]
+            newIDs = bulk_insert(UnitLesson, newULs, unit=unit)
+            for t, newID in zip(level, newIDs):
+                pkMap[t[0].pk] = newID
+            parentIDs = [t[0].pk for t in level]
+            if childDict is None:
+                children = UnitLesson.objects.filter(parent__in=parentIDs) \
+                  .order_by('pk')
+            else:
+                children = [child for parentID in parentIDs
+                            for child in childDict.get(parentID, ())]
+            level = [(child, pkMap[child.parent_id],
+                      child.order if keepChildOrder else None)
+                     for child in children
+                     if child.pk not in pkMap] # guard against cycles
+    return pkMap
+
+def bulk_update_order(objs, attr='order', chunkSize=300):
+    'write attr of all objs (same model) using one UPDATE ... CASE per chunk'
+    if not objs:
+        return
+    meta = objs[0]._meta
+    qn = connection.ops.quote_name
+    column = qn(meta.get_field(attr).column)
+    pkColumn = qn(meta.pk.column)
+    with transaction.atomic():
+        cursor = connection.cursor()
+        for i in range(0, len(objs), chunkSize):
+            chunk = objs[i:i + chunkSize]
+            params = []
+            for o in chunk:
+                params += [o.pk, getattr(o, attr)]
+            params += [o.pk for o in chunk]
+            cursor.execute('UPDATE %s SET %s = CASE %s %s END WHERE %s IN (%s)'
+                           % (qn(meta.db_table), column, pkColumn,
+                              ' '.join(['WHEN %s THEN %s'] * len(chunk)),
+                              pkColumn, ', '.join(['%s'] * len(chunk))),
+                           params)
+
 def reorder_exercise(self, old=0, new=0, l=()):
     'renumber exercises to move an exercise from old -> new position'
     if not l:
@@ -540,10 +839,12 @@ def reorder_exercise(self, old=0, new=0, l=()):
     ex = l[old] # select desired exercise by old position
     l = l[:old] + l[old + 1:] # exclude this exercise
     l = l[:new] + [ex] + l[new:] # insert ex in new position
+    changed = []
     for i, ex in enumerate(l):
         if i != ex.order: # order changed, have to update
             ex.order = i
-            ex.save()
+            changed.append(ex)
+    bulk_update_order(changed)
     return l # hand back the reordered list
 
     
@@ -587,24 +888,51 @@ class Unit(models.Model):
         lesson.save()
         return lesson
     def get_main_concepts(self):
-        'get dict of concepts linked to main lesson sequence of this unit'
+        '''get dict of concepts linked to main lesson sequence of this unit,
+        using a fixed number of queries regardless of the number of concepts'''
+        ulDict = dict([(ul.pk, ul) for ul in
+                       self.unitlesson_set.filter(kind=UnitLesson.COMPONENT,
+                                                  order__isnull=False)
+                       .select_related('lesson__concept')])
         d = {}
-        for ul in self.unitlesson_set.filter(lesson__concept__isnull=False,
-                kind=UnitLesson.COMPONENT, order__isnull=False):
-            cl = ConceptLink(lesson=ul.lesson, concept=ul.lesson.concept)
-            cl.unitLesson = ul
-            d[cl.concept] = [cl]
-        for cld in ConceptLink.objects.filter(lesson__unitlesson__unit=self,
+        for ul in ulDict.values():
+            if ul.lesson.concept_id is not None:
+                cl = ConceptLink(lesson=ul.lesson, concept=ul.lesson.concept)
+                cl.unitLesson = ul
+                d[cl.concept] = [cl]
+        cldList = list(ConceptLink.objects.filter(lesson__unitlesson__unit=self,
             lesson__unitlesson__kind=UnitLesson.COMPONENT,
             lesson__unitlesson__order__isnull=False) \
-            .values('concept', 'relationship', 'lesson__unitlesson'):
-            concept = Concept.objects.get(pk=cld['concept'])
-            ul = UnitLesson.objects.get(pk=cld['lesson__unitlesson'])
-            cl = ConceptLink(concept=concept,
+            .values('concept', 'relationship', 'lesson__unitlesson'))
+        concepts = Concept.objects.in_bulk([cld['concept'] for cld in cldList])
+        for cld in cldList:
+            cl = ConceptLink(concept=concepts[cld['concept']],
                              relationship=cld['relationship'])
-            cl.unitLesson = ul
+            cl.unitLesson = ulDict[cld['lesson__unitlesson']]
             d.setdefault(cl.concept, []).append(cl)
         return d
+    def clone(self, addedBy, title=None, course=None):
+        '''copy this unit and all its UnitLessons using bulk inserts,
+        optionally appending the new unit to course'''
+        with transaction.atomic():
+            unit = self.__class__(title=title or self.title, kind=self.kind,
+                                  addedBy=addedBy)
+            unit.save()
+            uls = list(self.unitlesson_set.all().order_by('pk'))
+            ulIDs = set([ul.pk for ul in uls])
+            roots = []
+            childDict = {}
+            for ul in uls: # rebuild the parent links in memory
+                if ul.parent_id in ulIDs:
+                    childDict.setdefault(ul.parent_id, []).append(ul)
+                else:
+                    roots.append((ul, None, ul.order))
+            copy_unitlesson_trees(roots, unit, addedBy, childDict,
+                                  keepChildOrder=True)
+            if course:
+                CourseUnit(unit=unit, course=course, addedBy=addedBy,
+                           order=course.courseunit_set.count()).save()
+        return unit
     def get_exercises(self):
         'ordered list of lessons for this courselet'
         return  list(self.unitlesson_set.filter(order__isnull=False)
@@ -637,6 +965,53 @@ class Unit(models.Model):
             .filter(Q(unitlesson__kind=UnitLesson.MISUNDERSTANDS, **kwargs)
             & ~Q(unitlesson__lesson__concept__conceptlink__relationship=
                  ConceptLink.RESOLVES)))
+    def get_instructor_tasks(self):
+        '''get list of (ul, tasks) combining get_new_inquiry_uls(),
+        get_errorless_uls() and get_resoless_uls() in a single query'''
+        qn = connection.ops.quote_name
+        names = dict(ul=qn(UnitLesson._meta.db_table),
+                     lesson=qn(Lesson._meta.db_table),
+                     response=qn(Response._meta.db_table),
+                     conceptlink=qn(ConceptLink._meta.db_table))
+        for col in ('id', 'parent_id', 'lesson_id', 'concept_id', 'kind',
+                    'unitLesson_id', 'needsEval', 'relationship'):
+            names[col] = qn(col)
+        hasError = '''EXISTS (SELECT 1 FROM %(ul)s c
+            WHERE c.%(parent_id)s = %(ul)s.%(id)s AND c.%(kind)s = %%s)'''
+        flagSQL = (
+            ('inquiry', '''EXISTS (SELECT 1 FROM %(response)s r
+                WHERE r.%(unitLesson_id)s = %(ul)s.%(id)s
+                AND r.%(kind)s = %%s AND r.%(needsEval)s = %%s)''',
+             [Response.STUDENT_QUESTION, True]),
+            ('em', '''EXISTS (SELECT 1 FROM %(lesson)s l
+                WHERE l.%(id)s = %(ul)s.%(lesson_id)s AND l.%(kind)s = %%s)
+                AND NOT ''' + hasError,
+             [Lesson.ORCT_QUESTION, UnitLesson.MISUNDERSTANDS]),
+            ('reso', hasError + ''' AND NOT EXISTS (SELECT 1
+                FROM %(ul)s c INNER JOIN %(lesson)s l
+                ON c.%(lesson_id)s = l.%(id)s INNER JOIN %(conceptlink)s cl
+                ON cl.%(concept_id)s = l.%(concept_id)s
+                WHERE c.%(parent_id)s = %(ul)s.%(id)s
+                AND cl.%(relationship)s = %%s)''',
+             [UnitLesson.MISUNDERSTANDS, ConceptLink.RESOLVES]),
+        )
+        select = OrderedDict()
+        params = []
+        for name, sql, sqlParams in flagSQL:
+            select['is_' + name] = sql % names
+            params += sqlParams
+        uls = list(self.unitlesson_set.select_related('lesson')
+                   .extra(select=select, select_params=params)
+                   .order_by('pk'))
+        ulDict = OrderedDict()
+        for name, _, _ in flagSQL: # dedupe each task list separately
+            for ul in distinct_subset([ul for ul in uls
+                                       if getattr(ul, 'is_' + name)]):
+                ulDict.setdefault(ul, []).append(name)
+        taskTable = [(ul, l) for ul, l in ulDict.items() if l[0] == 'inquiry']
+        taskTable += [(ul, l) for ul, l in ulDict.items()
+                      if l[0] != 'inquiry']
+        return taskTable
     def get_unanswered_uls(self, user=None, **kwargs):
         if user:
             kwargs['response__author'] = user
@@ -665,6 +1040,25 @@ class Unit(models.Model):
         return distinct_subset(self.unitlesson_set
             .filter(response__studenterror__status__in=
                     [NEED_HELP_STATUS, NEED_REVIEW_STATUS], **kwargs))
+    def get_student_tasks(self, user):
+        'get list of (ul, task) for this student from StudentTaskStatus'
+        taskStatus = {}
+        for ts in StudentTaskStatus.objects.filter(user=user, unit=self) \
+          .select_related('unitLesson__lesson'):
+            taskStatus[ts.unitLesson_id] = ts
+        questions = self.unitlesson_set.filter(
+            lesson__kind=Lesson.ORCT_QUESTION).select_related('lesson')
+        taskTable = [(ul, 'start') for ul in distinct_subset(questions)
+                     if ul.pk not in taskStatus or
+                     not taskStatus[ul.pk].answered]
+        l = sorted(taskStatus.values(), key=lambda ts:ts.unitLesson_id)
+        for attr, task in (('needsSelfeval', 'selfeval'),
+                           ('needsClassify', 'classify'),
+                           ('needsResolve', 'resolve')):
+            taskTable += [(ul, task) for ul in
+                          distinct_subset([ts.unitLesson for ts in l
+                                           if getattr(ts, attr)])]
+        return taskTable
     def get_study_url(self, path, extension=['tasks']):
         'return URL for next study tasks on this unit'
         from ct.templatetags.ct_extras import get_base_url
@@ -759,6 +1153,10 @@ class Response(models.Model):
     needsEval = models.BooleanField(default=False)
     parent = models.ForeignKey('Response', null=True) # reply-to
     activity = models.ForeignKey('ActivityLog', null=True)
+    class Meta:
+        index_together = (('unitLesson', 'selfeval'),
+                          ('unitLesson', 'activity', 'kind'),
+                          ('author', 'unitLesson'))
     def __unicode__(self):
         return 'answer by ' + self.author.username
     @classmethod
@@ -814,6 +1212,10 @@ class Response(models.Model):
         if self.selfeval == self.DIFFERENT or self.status == NEED_HELP_STATUS:
             if self.studenterror_set.count() == 0:
                 return self.CLASSIFY_STEP, 'classify your error(s)'
+    def save(self, *args, **kwargs):
+        'save, then bring the author\'s StudentTaskStatus up to date'
+        super(Response, self).save(*args, **kwargs)
+        StudentTaskStatus.update_status(self.author, self.unitLesson)
 
         
 
@@ -826,6 +1228,8 @@ class StudentError(models.Model):
                               blank=False, null=True)
     author = models.ForeignKey(User)
     activity = models.ForeignKey('ActivityLog', null=True)
+    class Meta:
+        index_together = (('response', 'errorModel'),)
     def __unicode__(self):
         return 'eval by ' + self.author.username
     @classmethod
@@ -842,6 +1246,67 @@ class StudentError(models.Model):
     def get_ul_errors(klass, ul, **kwargs):
         'get StudentErrors for a specific question'
         return klass.objects.filter(response__unitLesson=ul, **kwargs)
+    def save(self, *args, **kwargs):
+        'save, then bring the response author\'s StudentTaskStatus up to date'
+        super(StudentError, self).save(*args, **kwargs)
+        StudentTaskStatus.update_status(self.response.author,
+                                        self.response.unitLesson)
+
+def get_task_flags(responses, errorStatus):
+    '''compute StudentTaskStatus flags for one student on one UnitLesson.
+    responses: list of dicts with pk, kind, selfeval, status keys;
+    errorStatus: dict of response pk -> list of its StudentError statuses'''
+    d = dict(answered=False, needsSelfeval=False, needsClassify=False,
+             needsResolve=False)
+    for r in responses:
+        if r['kind'] == Response.ORCT_RESPONSE:
+            d['answered'] = True
+            if r['selfeval'] is None:
+                d['needsSelfeval'] = True
+        seList = errorStatus.get(r['pk'], ())
+        if (r['selfeval'] == Response.DIFFERENT or
+            r['status'] == NEED_HELP_STATUS) and not seList:
+            d['needsClassify'] = True
+        for status in seList:
+            if status in (NEED_HELP_STATUS, NEED_REVIEW_STATUS):
+                d['needsResolve'] = True
+    return d
+
+class StudentTaskStatus(models.Model):
+    '''denormalized per-student task flags for one UnitLesson,
+    kept up to date by Response and StudentError saves'''
+    user = models.ForeignKey(User)
+    unit = models.ForeignKey(Unit)
+    unitLesson = models.ForeignKey(UnitLesson)
+    answered = models.BooleanField(default=False)
+    needsSelfeval = models.BooleanField(default=False)
+    needsClassify = models.BooleanField(default=False)
+    needsResolve = models.BooleanField(default=False)
+    atime = models.DateTimeField('time updated', default=timezone.now)
+    class Meta:
+        unique_together = (('user', 'unitLesson'),)
+        index_together = (('user', 'unit'),)
+    @classmethod
+    def update_status(klass, user, unitLesson):
+        'recompute flags for this user on this UnitLesson from their responses'
+        responses = list(Response.objects.filter(author=user,
+                unitLesson=unitLesson).values('pk', 'kind', 'selfeval',
+                                              'status'))
+        errorStatus = {}
+        for se in StudentError.objects.filter(response__author=user,
+                response__unitLesson=unitLesson).values('response', 'status'):
+            errorStatus.setdefault(se['response'], []).append(se['status'])
+        flags = get_task_flags(responses, errorStatus)
+        flags['atime'] = timezone.now()
+        if not klass.objects.filter(user=user, unitLesson=unitLesson) \
+          .update(**flags): # no row yet, so create one
+            try:
+                with transaction.atomic():
+                    klass.objects.create(user=user, unitLesson=unitLesson,
+                                         unit_id=unitLesson.unit_id, **flags)
+            except IntegrityError: # concurrent save created it first
+                klass.objects.filter(user=user, unitLesson=unitLesson) \
+                  .update(**flags)
 
 def errormodel_table(target, n, fmt='%d (%.0f%%)', includeAll=False, attr=''):
     if n == 0: # prevent div by zero error
@@ -1299,6 +1764,10 @@ class FSMState(models.Model):
     save_json_data = save_json_data
     get_data_attr = get_data_attr
     set_data_attr = set_data_attr
+    @retry_on_busy
+    def save(self, *args, **kwargs):
+        'save, retrying if the db is locked by a live-session write burst'
+        super(FSMState, self).save(*args, **kwargs)
     def get_all_state_data(self):
         'get dict of all our state data including unitLesson'
         d = self.load_json_data().copy() # copy to avoid side-effects
@@ -1332,59 +1801,85 @@ class FSMState(models.Model):
             e = self.fsmNode.outgoing.get(name=name)
         except FSMEdge.DoesNotExist:
             return None # FSM does not handle this event, return control
-        if self.activityEvent: # record exit from this node
-            self.activityEvent.log_exit_event(name)
-            self.activityEvent = None
+        from ct import activity_log
+        activity_log.log_node_exit(self, name) # record exit from this node
+        fromNode = self.fsmNode
         self.fsmNode = e.transition(fsmStack, request, **kwargs)
         self.path = self.fsmNode.get_path(self, request, **kwargs)
         self.save()
+        from ct import event_log
+        event_log.log_transition(self, fromNode, name)
         return self.path
     def log_entry(self, user):
         'record entry to this node if fsmNode.doLogging True'
-        if not self.fsmNode.doLogging:
-            return
-        if self.activityEvent and self.activityEvent.nodeName == self.fsmNode.name:
-            return
-        # NB: should probably extract unitLesson ID from request.path!!
-        if self.activity: # record to existing activity
-            self.activityEvent = ActivityEvent(activity=self.activity,
-                user=user, nodeName=fsmNode.name, unitLesson=self.unitLesson)
-            self.activityEvent.save()
-        else: # create new activity log
-            self.activityEvent = ActivityLog.log_node_entry(self.fsmNode, user,
-                                                            self.unitLesson)
-            self.activity = self.activityEvent.activity
-        self.save()
+        if self.fsmNode.doLogging:
+            from ct import activity_log
+            activity_log.log_node_entry(self, user)
     @classmethod
     def find_live_sessions(klass, user):
         'get live sessions relevant to this user'
         return klass.objects.filter(isLiveSession=True,
+                                    activity__archived__isnull=True,
                                     activity__course__role__user=user)
 
-        
+
+# (month, name) of each term's start, in calendar order
+DEFAULT_TERM_STARTS = ((1, 'spring'), (6, 'summer'), (9, 'fall'))
+
+def get_term(t=None):
+    'name of term containing time t (default: now), e.g. 2015-fall'
+    if t is None:
+        t = timezone.now()
+    if timezone.is_aware(t):
+        t = timezone.localtime(t)
+    starts = getattr(settings, 'CT_TERM_STARTS', DEFAULT_TERM_STARTS)
+    year, name = t.year - 1, starts[-1][1] # before first start of year
+    for month, termName in starts:
+        if t.month >= month:
+            year, name = t.year, termName
+    return '%d-%s' % (year, name)
+
+def get_recent_terms(n, t=None):
+    'list of names of the n terms up to and including that of time t'
+    if t is None:
+        t = timezone.now()
+    l = []
+    while len(l) < n:
+        term = get_term(t)
+        if term not in l:
+            l.append(term)
+        t = t.replace(day=1) - timedelta(days=1) # end of previous month
+    return l
+
 class ActivityLog(models.Model):
-    'a category of FSM activity to log'    
+    '''a category of FSM activity to log, partitioned by course and term.
+    Once a partition's term is over, its events can be archived to a
+    file (see ct.activity_archive), which sets archived.'''
     fsmName = models.CharField(max_length=64)
     startTime = models.DateTimeField('time created', default=timezone.now)
     endTime = models.DateTimeField('time ended', null=True)
     course = models.ForeignKey(Course, null=True)
+    term = models.CharField(max_length=32, default=get_term)
+    archived = models.DateTimeField('time archived', null=True)
+    class Meta:
+        index_together = [['fsmName', 'course', 'term']]
     @classmethod
-    def get_or_create(klass, name):
-        'get log with specified name if it exists, or create it'
-        try:
-            return klass.objects.get(fsmName=name)
-        except klass.DoesNotExist:
-            a = klass(fsmName=name)
-            a.save()
-            return a
+    def get_or_create(klass, name, course=None, term=None):
+        '''get live log with specified name, course and term (default:
+        current term) if it exists, or create it'''
+        if term is None:
+            term = get_term()
+        l = klass.objects.filter(fsmName=name, course=course, term=term,
+                                 archived__isnull=True).order_by('pk')[:1]
+        if l:
+            return l[0]
+        a = klass(fsmName=name, course=course, term=term)
+        a.save()
+        return a
     @classmethod
-    def log_node_entry(klass, fsmNode, user, unitLesson=None):
-        'record entry to this node, creating ActivityLog if needed'
-        a = klass.get_or_create(fsmNode.fsm.name)
-        ae = ActivityEvent(activity=a, user=user, nodeName=fsmNode.name,
-                           unitLesson=unitLesson)
-        ae.save()
-        return ae
+    def get_live(klass):
+        'queryset of partitions that have not been archived'
+        return klass.objects.filter(archived__isnull=True)
 
 class ActivityEvent(models.Model):
     'log FSM node entry/exit times'
@@ -0,0 +1,100 @@
+'''TF-IDF ranked n-gram index for fuzzy matching of short texts
+(question titles, error model descriptions, student responses).
+
+Each text is split into lower-case words, whose 1..nword-grams are
+hashed into nbucket feature columns and weighted by
+(1 + log tf) * idf, then L2-normalized.  The index stores the matrix
+as sparse per-column posting arrays (entry rows and weights), so a
+query is scored against every entry with one sparse dot product:
+only entries sharing at least one n-gram with the query are touched.
+Pure Python (array module), so no numpy / scipy dependency.'''
+
+from array import array
+import heapq
+import math
+import re
+import zlib
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def get_words(text):
+    return WORD_RE.findall(text.lower())
+
+def hash_ngram(gram, nbucket):
+    'stable (unlike hash()) bucket number for an n-gram tuple'
+    s = u' '.join(gram)
+    return (zlib.crc32(s.encode('utf-8')) & 0xffffffff) % nbucket
+
+
+class NgramIndex(object):
+    'immutable TF-IDF index over a list of (id, text) entries'
+    def __init__(self, entries, nword=2, nbucket=1 << 20):
+        self.nword = nword
+        self.nbucket = nbucket
+        self.ids = []
+        vectors = []
+        df = {}
+        for i, text in entries:
+            counts = self.get_counts(text)
+            self.ids.append(i)
+            vectors.append(counts)
+            for col in counts:
+                df[col] = df.get(col, 0) + 1
+        n = len(self.ids)
+        self.idf = dict([(col, math.log((1. + n) / (1. + m)) + 1.)
+                         for col, m in df.items()])
+        self.postings = {} # col -> (array of rows, array of weights)
+        for row, counts in enumerate(vectors):
+            for col, w in self.weigh(counts).items():
+                try:
+                    rows, weights = self.postings[col]
+                except KeyError:
+                    rows, weights = self.postings[col] = (array('l'),
+                                                          array('d'))
+                rows.append(row)
+                weights.append(w)
+    def __len__(self):
+        return len(self.ids)
+    def get_counts(self, text):
+        'dict of hashed n-gram column -> count for text'
+        words = get_words(text)
+        counts = {}
+        for n in range(1, self.nword + 1):
+            for j in range(len(words) - n + 1):
+                col = hash_ngram(words[j:j + n], self.nbucket)
+                counts[col] = counts.get(col, 0) + 1
+        return counts
+    def weigh(self, counts):
+        'L2-normalized TF-IDF vector (dict) from n-gram counts'
+        v = dict([(col, (1. + math.log(c)) * self.idf.get(col, 0.))
+                  for col, c in counts.items()])
+        norm = math.sqrt(sum([w * w for w in v.values()]))
+        if not norm:
+            return {}
+        return dict([(col, w / norm) for col, w in v.items() if w])
+    def scores(self, text):
+        'dict of entry row -> cosine similarity, for rows with any match'
+        d = {}
+        for col, q in self.weigh(self.get_counts(text)).items():
+            try:
+                rows, weights = self.postings[col]
+            except KeyError:
+                continue
+            for row, w in zip(rows, weights):
+                d[row] = d.get(row, 0.) + q * w
+        return d
+    def search(self, text, k=10, minScore=0.):
+        'list of up to k (score, id) best matches, best first'
+        best = heapq.nlargest(k, [(s, row) for row, s
+                                  in self.scores(text).items()
+                                  if s > minScore])
+        return [(s, self.ids[row]) for s, row in best]
+    def search_many(self, texts, k=10, minScore=0.):
+        'search() for each of a batch of texts'
+        return [self.search(text, k, minScore) for text in texts]
+    def best(self, text, minScore=0.):
+        'id of best match, or None if nothing matches'
+        l = self.search(text, 1, minScore)
+        if l:
+            return l[0][1]
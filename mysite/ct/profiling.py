@@ -0,0 +1,138 @@
+'''opt-in per-request profiling of ct views.
+
+Add ct.profiling.ViewProfileMiddleware to MIDDLEWARE_CLASSES and set
+CT_PROFILE_VIEWS = True to record, for each request, the view name,
+SQL query count and time, md2html (pandoc) calls and time, and FSM
+event time.  Each record is logged as one JSON line to the 'ct.profile'
+logger and added to an in-process rolling histogram (see
+get_histogram()).  When CT_PROFILE_VIEWS is off the middleware removes
+itself at startup, and the timed() hooks cost a single attribute lookup.'''
+
+from collections import deque
+import functools
+import json
+import logging
+import threading
+import time
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.utils import timezone
+
+logger = logging.getLogger('ct.profile')
+_local = threading.local()
+
+
+def timed(kind):
+    'decorator that adds call count and time to current request profile'
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            stats = getattr(_local, 'stats', None)
+            if stats is None or kind in _local.active: # off, or nested call
+                return func(*args, **kwargs)
+            _local.active.add(kind)
+            t = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _local.active.discard(kind)
+                stats[kind] += 1
+                stats[kind + 'Ms'] += (time.time() - t) * 1000.
+        wrapper._decorated_function = getattr(func, '_decorated_function',
+                                              func) # for template filters
+        return wrapper
+    return decorator
+
+
+class RollingHistogram(object):
+    'keep the last maxlen samples of each view, bucketed on demand'
+    BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000) # msec
+    def __init__(self, maxlen=1000):
+        self.maxlen = maxlen
+        self.samples = {}
+        self.lock = threading.Lock()
+    def add(self, view, ms, nquery):
+        with self.lock:
+            try:
+                d = self.samples[view]
+            except KeyError:
+                d = self.samples[view] = deque(maxlen=self.maxlen)
+            d.append((ms, nquery))
+    def summary(self):
+        'dict of {view:dict(n, p50, p95, max, sql, buckets)}'
+        with self.lock:
+            samples = [(view, list(d)) for view, d in self.samples.items()]
+        out = {}
+        for view, l in samples:
+            times = sorted([t[0] for t in l])
+            buckets = [0] * (len(self.BUCKETS) + 1)
+            for ms in times:
+                i = 0
+                while i < len(self.BUCKETS) and ms > self.BUCKETS[i]:
+                    i += 1
+                buckets[i] += 1
+            out[view] = dict(n=len(times), p50=percentile(times, 50),
+                             p95=percentile(times, 95), max=times[-1],
+                             sql=sum([t[1] for t in l]) / float(len(l)),
+                             buckets=buckets)
+        return out
+    def clear(self):
+        with self.lock:
+            self.samples = {}
+
+histogram = RollingHistogram()
+
+def get_histogram():
+    'summary of recent requests in this process, by view'
+    return histogram.summary()
+
+def percentile(sortedValues, p):
+    'nearest-rank percentile of an already sorted list'
+    if not sortedValues:
+        return None
+    i = int(round(p / 100. * (len(sortedValues) - 1)))
+    return sortedValues[i]
+
+
+class ViewProfileMiddleware(object):
+    'record SQL, md2html and FSM cost of each request, if CT_PROFILE_VIEWS'
+    def __init__(self):
+        if not getattr(settings, 'CT_PROFILE_VIEWS', False):
+            raise MiddlewareNotUsed
+    def process_request(self, request):
+        _local.stats = dict(md2html=0, md2htmlMs=0., fsm=0, fsmMs=0.)
+        _local.active = set()
+        _local.start = time.time()
+        _local.view = None
+        _local.queryStart = []
+        for conn in connections.all():
+            _local.queryStart.append((conn, conn.use_debug_cursor,
+                                      len(conn.queries)))
+            conn.use_debug_cursor = True # record queries even if not DEBUG
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        _local.view = '%s.%s' % (view_func.__module__,
+                                 getattr(view_func, '__name__', 'view'))
+    def process_response(self, request, response):
+        stats = getattr(_local, 'stats', None)
+        if stats is None: # process_request never ran
+            return response
+        _local.stats = None
+        ms = (time.time() - _local.start) * 1000.
+        nquery, sqlMs = 0, 0.
+        for conn, useDebugCursor, n in _local.queryStart:
+            queries = conn.queries[n:]
+            nquery += len(queries)
+            sqlMs += sum([float(q['time']) for q in queries]) * 1000.
+            conn.use_debug_cursor = useDebugCursor
+        _local.queryStart = []
+        view = _local.view or request.path
+        stats.update(view=view, method=request.method, path=request.path,
+                     status=response.status_code, ms=round(ms, 2),
+                     sql=nquery, sqlMs=round(sqlMs, 2),
+                     md2htmlMs=round(stats['md2htmlMs'], 2),
+                     fsmMs=round(stats['fsmMs'], 2),
+                     time=timezone.now().isoformat())
+        histogram.add(view, ms, nquery)
+        logger.info(json.dumps(stats))
+        return response
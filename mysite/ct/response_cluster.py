@@ -0,0 +1,162 @@
+'''Group similar student responses so instructors can triage a whole
+cluster of novel errors at once.
+
+Each response text is reduced to character 4-gram shingles of its
+normalized words, summarized by a MinHash signature, and inserted
+into locality-sensitive hash (LSH) band buckets.  Responses sharing a
+bucket whose estimated Jaccard similarity reaches the threshold are
+joined (union-find) into one cluster.  Pure Python, so no numpy.
+
+The clustering state for each question is kept in the Django cache
+and updated incrementally: only responses not seen before are
+signed and inserted, so each new response costs one signature plus a
+few bucket lookups, not a re-clustering of the whole question.  Once
+responses that have since been categorized (so are no longer passed
+in) outnumber the current ones, the clustering is rebuilt from
+scratch, so it never grows much beyond the responses it serves.'''
+
+import random
+import struct
+import zlib
+from django.conf import settings
+from django.core.cache import cache
+from ct.phrase_index import get_words
+
+CACHE_PREFIX = 'ct.response_cluster.2' # bumped when pickles change
+PRIME = (1 << 31) - 1 # Mersenne prime: products fit in 64-bit ints
+SHINGLE = 4 # characters per shingle
+STOP_WORDS = frozenset(('the', 'and', 'that', 'this', 'with', 'for', 'are',
+                        'was', 'not', 'but', 'you', 'its', 'because'))
+
+
+def get_shingles(text, k=SHINGLE):
+    'set of hashed character k-grams of the normalized text'
+    s = ' '.join(get_words(text))
+    if len(s) <= k:
+        return set([zlib.crc32(s.encode('utf-8')) & 0x7fffffff]) if s \
+          else set()
+    return set([zlib.crc32(s[i:i + k].encode('utf-8')) & 0x7fffffff
+                for i in range(len(s) - k + 1)])
+
+
+class ResponseClusterer(object):
+    'incremental MinHash / LSH clustering of one question\'s responses'
+    def __init__(self, nband=16, nrow=4, threshold=0.5, seed=42):
+        self.nband = nband
+        self.nrow = nrow
+        self.threshold = threshold
+        rng = random.Random(seed) # same permutations in every process
+        self.coeffs = [(rng.randint(1, PRIME - 1), rng.randint(0, PRIME - 1))
+                       for i in range(nband * nrow)]
+        self.sigs = {} # response pk -> MinHash signature
+        self.words = {} # response pk -> content words, for summaries
+        self.buckets = {} # (band, band signature) -> [response pk]
+        self.parent = {} # union-find forest over response pks
+    def __len__(self):
+        return len(self.sigs)
+    def sign(self, shingles):
+        'MinHash signature (tuple) of a set of shingle hashes'
+        if not shingles:
+            return None
+        return tuple([min([(a * x + b) % PRIME for x in shingles])
+                      for a, b in self.coeffs])
+    def band_hash(self, sig, band):
+        'hash of one band of a signature, the same on every platform'
+        return zlib.crc32(struct.pack('<%dI' % self.nrow,
+                    *sig[band * self.nrow:(band + 1) * self.nrow])) & 0xffffffff
+    def similarity(self, sig1, sig2):
+        'estimated Jaccard similarity of two signatures'
+        return sum([1 for x, y in zip(sig1, sig2) if x == y]) \
+          / float(len(sig1))
+    def find(self, pk):
+        root = pk
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[pk] != root: # path compression
+            self.parent[pk], pk = root, self.parent[pk]
+        return root
+    def union(self, pk1, pk2):
+        r1, r2 = self.find(pk1), self.find(pk2)
+        if r1 != r2:
+            self.parent[max(r1, r2)] = min(r1, r2) # oldest is root
+    def add(self, pk, text):
+        'sign and insert one response, joining it to similar ones'
+        if pk in self.sigs:
+            return
+        sig = self.sign(get_shingles(text))
+        self.sigs[pk] = sig
+        self.words[pk] = [w for w in get_words(text)
+                          if len(w) > 2 and w not in STOP_WORDS]
+        self.parent[pk] = pk
+        if sig is None: # empty answer: a cluster of its own
+            return
+        checked = set()
+        for band in range(self.nband):
+            key = (band, self.band_hash(sig, band))
+            members = self.buckets.setdefault(key, [])
+            for other in members:
+                if other not in checked:
+                    checked.add(other)
+                    if self.similarity(sig, self.sigs[other]) \
+                      >= self.threshold:
+                        self.union(pk, other)
+            members.append(pk)
+    def update(self, responses):
+        'add any responses not seen before; return how many were new'
+        n = len(self.sigs)
+        for r in responses:
+            self.add(r.pk, r.text)
+        return len(self.sigs) - n
+    def get_clusters(self, responses, nterm=5):
+        '''list of (representative, members, common words) for the given
+        (already added) responses, largest cluster first'''
+        groups = {}
+        for r in responses:
+            groups.setdefault(self.find(r.pk), []).append(r)
+        clusters = []
+        for members in groups.values():
+            clusters.append((self.get_representative(members), members,
+                             self.get_terms(members, nterm)))
+        clusters.sort(key=lambda t:(-len(t[1]), t[1][0].pk))
+        return clusters
+    def get_representative(self, members, maxCompare=50):
+        'member most similar on average to (a sample of) the others'
+        if len(members) <= 2:
+            return members[0]
+        sample = members[:maxCompare]
+        best, bestScore = members[0], -1.
+        for r in sample:
+            sig = self.sigs[r.pk]
+            if sig is None:
+                continue
+            score = sum([self.similarity(sig, self.sigs[o.pk])
+                         for o in sample
+                         if o is not r and self.sigs[o.pk] is not None])
+            if score > bestScore:
+                best, bestScore = r, score
+        return best
+    def get_terms(self, members, nterm):
+        'words used by the most members, for a cluster label'
+        counts = {}
+        for r in members:
+            for w in set(self.words[r.pk]):
+                counts[w] = counts.get(w, 0) + 1
+        l = sorted(counts.items(), key=lambda t:(-t[1], t[0]))
+        return [w for w, c in l[:nterm] if c > 1 or len(members) == 1]
+
+
+def cluster_responses(ul, responses):
+    '''list of (representative, members, common words) clusters of
+    responses to question ul, updating ul's cached clustering with any
+    responses it has not seen yet'''
+    responses = list(responses)
+    key = '%s.%d' % (CACHE_PREFIX, ul.pk)
+    clusterer = cache.get(key)
+    if clusterer is None or len(clusterer) > 2 * len(responses) + \
+      getattr(settings, 'CT_RESPONSE_CLUSTER_SLACK', 100): # mostly stale
+        clusterer = ResponseClusterer(
+            threshold=getattr(settings, 'CT_RESPONSE_CLUSTER_THRESHOLD', 0.5))
+    if clusterer.update(responses):
+        cache.set(key, clusterer, getattr(settings,
+                        'CT_RESPONSE_CLUSTER_TIMEOUT', 7 * 24 * 3600))
+    return clusterer.get_clusters(responses)
@@ -0,0 +1,65 @@
+'''SQLite tuning for live-session write bursts.
+
+set_pragmas() runs on every new database connection
+(connection_created signal) and applies CT_SQLITE_PRAGMAS: by default
+WAL journaling, so page readers no longer block on (or block) the one
+writer, plus synchronous=NORMAL, a larger page cache, memory-mapped
+reads and a busy_timeout.
+
+retry_on_busy wraps a function that does a complete write
+transaction, re-running it (with backoff) if SQLite still reports
+"database is locked" after busy_timeout.  It only retries when called
+outside any atomic block: inside one, the enclosing transaction is
+already broken and must fail as a whole.'''
+
+import functools
+import random
+import time
+from django.conf import settings
+from django.db import connection, OperationalError
+
+DEFAULT_PRAGMAS = (
+    ('journal_mode', 'WAL'), # readers don't block the writer, or vice versa
+    ('synchronous', 'NORMAL'), # safe with WAL; fsync only at checkpoints
+    ('cache_size', -20000), # KiB (negative), i.e. 20 MB page cache
+    ('mmap_size', 256 * 1024 * 1024),
+    ('busy_timeout', 5000), # msec to wait for a lock before failing
+)
+
+
+def get_pragmas():
+    return getattr(settings, 'CT_SQLITE_PRAGMAS', DEFAULT_PRAGMAS)
+
+def apply_pragmas(cursor, pragmas):
+    'execute PRAGMA name=value for each (name, value)'
+    for name, value in pragmas:
+        cursor.execute('PRAGMA %s=%s' % (name, value))
+
+def set_pragmas(sender, connection, **kwargs):
+    'connection_created receiver: tune each new SQLite connection'
+    if connection.vendor != 'sqlite':
+        return
+    if connection.settings_dict['NAME'] in ('', ':memory:') \
+      or 'mode=memory' in connection.settings_dict['NAME']:
+        return # in-memory (test) db: no journal to tune
+    apply_pragmas(connection.cursor(), get_pragmas())
+
+def is_busy_error(e):
+    return isinstance(e, OperationalError) and 'locked' in str(e)
+
+def retry_on_busy(func):
+    '''decorator: re-run func if it fails with "database is locked",
+    up to CT_BUSY_RETRIES times.  func must do a whole transaction.'''
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        retries = getattr(settings, 'CT_BUSY_RETRIES', 3)
+        delay = getattr(settings, 'CT_BUSY_RETRY_DELAY', 0.05)
+        for i in range(retries + 1):
+            try:
+                return func(*args, **kwargs)
+            except OperationalError as e:
+                if i == retries or not is_busy_error(e) \
+                  or connection.in_atomic_block:
+                    raise
+            time.sleep(delay * (2 ** i) * (0.5 + random.random())) # jitter
+    return wrapper
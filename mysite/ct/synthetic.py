@@ -0,0 +1,327 @@
+'''generate a reproducible synthetic deployment for load testing.
+
+SyntheticDeployment(seed).generate(...) fills the current database with
+courses, courselets, reST lessons, ORCT questions with answers, error
+models and resolutions, a concept graph, enrolled students, and their
+Responses, StudentErrors, ActivityEvents and StudentTaskStatus rows,
+all written with bulk INSERTs.  The same seed and parameters always
+produce the same content.'''
+
+from datetime import datetime, timedelta
+import random
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from ct.models import *
+
+WORDS = '''probability conditional likelihood prior posterior evidence
+sample hidden state sequence alignment model parameter estimate variance
+mean distribution random variable independent joint marginal observation
+gene protein mutation score matrix path emission transition entropy
+information hypothesis test error data inference Bayes Markov chain
+expectation maximum density function event outcome frequency count
+ratio odds log base pair genome read coverage tree branch'''.split()
+
+MATH = (r':math:`p(X|Y)`', r':math:`\sum_i x_i`', r':math:`e^{-\lambda}`',
+        r':math:`\theta`', r':math:`n \choose k`', r':math:`\log_2 p`')
+
+
+def random_title(rng, nmin=2, nmax=4):
+    return ' '.join([rng.choice(WORDS)
+                     for i in range(rng.randint(nmin, nmax))]).title()
+
+def random_sentence(rng, nmin=6, nmax=16):
+    words = [rng.choice(WORDS) for i in range(rng.randint(nmin, nmax))]
+    i = rng.randrange(len(words))
+    r = rng.random()
+    if r < 0.2:
+        words[i] = rng.choice(MATH)
+    elif r < 0.3:
+        words[i] = '*%s*' % words[i]
+    elif r < 0.35:
+        words[i] = '``%s``' % words[i]
+    return ' '.join(words).capitalize() + '.'
+
+def random_rst(rng, nmin=1, nmax=4):
+    'a few paragraphs of reST, with occasional math, markup and lists'
+    paragraphs = []
+    for i in range(rng.randint(nmin, nmax)):
+        if rng.random() < 0.15:
+            paragraphs.append('\n'.join(['* ' + random_sentence(rng, 3, 8)
+                                         for j in range(rng.randint(2, 4))]))
+        else:
+            paragraphs.append(' '.join([random_sentence(rng)
+                                        for j in range(rng.randint(1, 4))]))
+    return '\n\n'.join(paragraphs)
+
+
+class SyntheticDeployment(object):
+    'generator for one seeded synthetic dataset'
+    def __init__(self, seed=0, prefix='synth', batchSize=1000,
+                 startTime=None, password='synthetic', log=None):
+        self.rng = random.Random(seed)
+        self.prefix = prefix
+        self.batchSize = batchSize
+        if startTime is None:
+            startTime = datetime(2015, 1, 5, tzinfo=timezone.utc)
+        self.startTime = startTime
+        self.password = make_password(password) # hash once for all users
+        self.log = log
+        self.counts = {}
+    def _count(self, name, n):
+        self.counts[name] = self.counts.get(name, 0) + n
+    def _random_time(self, days=90):
+        return self.startTime + timedelta(seconds=self.rng
+                                          .randrange(days * 86400))
+    def _insert(self, klass, objs, **kwargs):
+        'bulk insert objs, returning their pks'
+        self._count(klass.__name__, len(objs))
+        return bulk_insert(klass, objs, **kwargs)
+    def _create(self, klass, objs):
+        'bulk insert objs when we do not need their pks'
+        self._count(klass.__name__, len(objs))
+        klass.objects.bulk_create(objs)
+    def generate(self, courses=2, units=4, lessons=20, concepts=8,
+                 errorModels=3, students=100, responseRate=0.8,
+                 classifyRate=0.6):
+        '''create courses, each with units courselets of lessons lessons
+        (alternating explanations and ORCT questions), and students
+        enrolled students who respond to a fraction responseRate of
+        questions.  Returns dict of row counts by model name.'''
+        if concepts < 1 or errorModels < 1: # each question needs both
+            raise ValueError('need at least one concept and error model')
+        if User.objects.filter(username__startswith=self.prefix + '_') \
+          .exists():
+            raise ValueError('users with prefix %s already exist'
+                             % self.prefix)
+        self.activity = ActivityLog.get_or_create('lessonseq')
+        for i in range(courses):
+            with transaction.atomic():
+                self.generate_course(i, units, lessons, concepts, errorModels,
+                                     students, responseRate, classifyRate)
+        from ct import concept_graph
+        concept_graph.reload() # bulk_create bypassed ConceptGraph.save()
+        return self.counts
+    def _create_users(self, names):
+        users = [User(username='%s_%s' % (self.prefix, name),
+                      password=self.password, email='%s@example.com' % name,
+                      date_joined=self.startTime) for name in names]
+        return self._insert(User, users,
+                            username__startswith=self.prefix + '_')
+    def generate_course(self, i, nunit, nlesson, nconcept, nerror, nstudent,
+                        responseRate, classifyRate):
+        rng = self.rng
+        profID, = self._create_users(['prof%d' % i])
+        courseID, = self._insert(Course, [Course(title=random_title(rng, 3, 5),
+                                        description=random_rst(rng, 1, 2),
+                                        addedBy_id=profID)])
+        unitIDs = self._insert(Unit, [Unit(title=random_title(rng),
+                                           addedBy_id=profID,
+                                           atime=self.startTime)
+                                      for j in range(nunit)])
+        self._create(CourseUnit, [CourseUnit(unit_id=unitID,
+                                             course_id=courseID, order=j,
+                                             addedBy_id=profID,
+                                             releaseTime=self.startTime)
+                                  for j, unitID in enumerate(unitIDs)])
+        questions = [] # list of (question UL pk, lesson pk, [em UL pks])
+        for unitID in unitIDs:
+            questions += self.generate_unit(unitID, profID, nlesson,
+                                            nconcept, nerror)
+        studentIDs = self._create_users(['s%d_%d' % (i, j)
+                                         for j in range(nstudent)])
+        self._create(Role, [Role(role=Role.INSTRUCTOR, course_id=courseID,
+                                 user_id=profID)] +
+                     [Role(role=Role.ENROLLED, course_id=courseID,
+                           user_id=userID) for userID in studentIDs])
+        self.generate_responses(courseID, studentIDs, questions, responseRate,
+                                classifyRate)
+        if self.log:
+            self.log('course %d: %d units, %d questions, %d students'
+                     % (courseID, len(unitIDs), len(questions),
+                        len(studentIDs)))
+    def generate_unit(self, unitID, profID, nlesson, nconcept, nerror):
+        'create lessons, concepts and concept graph for one courselet'
+        rng = self.rng
+        atime = self.startTime
+        conceptIDs = self._insert(Concept, [Concept(title=random_title(rng),
+                                                    addedBy_id=profID,
+                                                    atime=atime)
+                                            for j in range(nconcept)])
+        # component lessons: explanations define / questions test a concept
+        lessons = []
+        lessonConcepts = []
+        for j in range(nlesson):
+            conceptID = conceptIDs[(j // 2) % nconcept]
+            if j % 2:
+                kind = Lesson.ORCT_QUESTION
+                definesID = None
+            else:
+                kind = Lesson.BASE_EXPLANATION
+                definesID = conceptID if j // 2 < nconcept else None
+            lessons.append(Lesson(title=random_title(rng),
+                                  text=random_rst(rng), kind=kind,
+                                  addedBy_id=profID, atime=atime,
+                                  concept_id=definesID))
+            lessonConcepts.append(conceptID)
+        nquestion = nlesson // 2
+        # per question: one answer, nerror error models (own concepts)
+        emConceptIDs = self._insert(Concept, [Concept(title=random_title(rng),
+                                                      addedBy_id=profID,
+                                                      isError=True,
+                                                      atime=atime)
+                                    for j in range(nquestion * nerror)])
+        for j in range(nquestion):
+            lessons.append(Lesson(title='Answer', text=random_rst(rng, 1, 2),
+                                  kind=Lesson.ANSWER, addedBy_id=profID,
+                                  atime=atime))
+        for emConceptID in emConceptIDs:
+            lessons.append(Lesson(title=random_title(rng),
+                                  text=random_rst(rng, 1, 2),
+                                  kind=Lesson.ERROR_MODEL, addedBy_id=profID,
+                                  atime=atime, concept_id=emConceptID))
+        resoEMs = [emConceptID for emConceptID in emConceptIDs
+                   if rng.random() < 0.3]
+        for emConceptID in resoEMs:
+            lessons.append(Lesson(title=random_title(rng),
+                                  text=random_rst(rng), addedBy_id=profID,
+                                  atime=atime))
+        lessonIDs = self._insert(Lesson, lessons)
+        Lesson.objects.filter(pk__gte=lessonIDs[0], pk__lte=lessonIDs[-1],
+                              treeID=None).update(treeID=F('pk'))
+        mainIDs = lessonIDs[:nlesson]
+        answerIDs = lessonIDs[nlesson:nlesson + nquestion]
+        emIDs = lessonIDs[nlesson + nquestion:
+                          nlesson + nquestion + len(emConceptIDs)]
+        resoIDs = lessonIDs[nlesson + nquestion + len(emConceptIDs):]
+        # UnitLessons: main sequence, then answers / error models, then resos
+        ulIDs = self._insert(UnitLesson, [UnitLesson(unit_id=unitID,
+                                lesson_id=lessonID, treeID=lessonID,
+                                kind=UnitLesson.COMPONENT, order=j,
+                                addedBy_id=profID, atime=atime)
+                             for j, lessonID in enumerate(mainIDs)],
+                             unit=unitID)
+        questionULs = ulIDs[1::2]
+        childULs = [UnitLesson(unit_id=unitID, lesson_id=lessonID,
+                               treeID=lessonID, kind=UnitLesson.ANSWERS,
+                               parent_id=questionULs[j], addedBy_id=profID,
+                               atime=atime)
+                    for j, lessonID in enumerate(answerIDs)]
+        childULs += [UnitLesson(unit_id=unitID, lesson_id=lessonID,
+                                treeID=lessonID,
+                                kind=UnitLesson.MISUNDERSTANDS,
+                                parent_id=questionULs[j // nerror],
+                                addedBy_id=profID, atime=atime)
+                     for j, lessonID in enumerate(emIDs)]
+        childIDs = self._insert(UnitLesson, childULs, unit=unitID)
+        emULs = childIDs[nquestion:]
+        self._create(UnitLesson, [UnitLesson(unit_id=unitID,
+                                             lesson_id=lessonID,
+                                             treeID=lessonID,
+                                             kind=UnitLesson.RESOLVES,
+                                             addedBy_id=profID, atime=atime)
+                                  for lessonID in resoIDs])
+        # concept links and concept graph
+        links = [ConceptLink(lesson_id=lessonID, concept_id=conceptID,
+                             relationship=DEFAULT_RELATION_MAP[lesson.kind],
+                             addedBy_id=profID, atime=atime)
+                 for lessonID, lesson, conceptID
+                 in zip(mainIDs, lessons, lessonConcepts)]
+        links += [ConceptLink(lesson_id=lessonID, concept_id=emConceptID,
+                              relationship=ConceptLink.RESOLVES,
+                              addedBy_id=profID, atime=atime)
+                  for lessonID, emConceptID in zip(resoIDs, resoEMs)]
+        self._create(ConceptLink, links)
+        edges = []
+        for j, conceptID in enumerate(conceptIDs[1:]):
+            for k in set([rng.randrange(j + 1) for m in range(2)]):
+                edges.append(ConceptGraph(fromConcept_id=conceptID,
+                                          toConcept_id=conceptIDs[k],
+                                          relationship=ConceptGraph.DEPENDS,
+                                          addedBy_id=profID, atime=atime))
+        for j, emConceptID in enumerate(emConceptIDs):
+            edges.append(ConceptGraph(fromConcept_id=emConceptID,
+                    toConcept_id=lessonConcepts[2 * (j // nerror) + 1],
+                    relationship=ConceptGraph.MISUNDERSTANDS,
+                    addedBy_id=profID, atime=atime))
+        self._create(ConceptGraph, edges)
+        return [(questionULs[j], mainIDs[2 * j + 1],
+                 emULs[j * nerror:(j + 1) * nerror])
+                for j in range(nquestion)]
+    def generate_responses(self, courseID, studentIDs, questions,
+                           responseRate, classifyRate):
+        '''create Responses, StudentErrors, ActivityEvents and
+        StudentTaskStatus rows, flushing every batchSize responses'''
+        rng = self.rng
+        ulUnits = dict(UnitLesson.objects.filter(pk__in=[t[0] for t in
+                        questions]).values_list('pk', 'unit'))
+        pending = [] # list of (Response, [StudentError])
+        events = []
+        statuses = []
+        for userID in studentIDs:
+            for ulID, lessonID, emULs in questions:
+                if rng.random() >= responseRate:
+                    continue
+                t = self._random_time()
+                r = rng.random()
+                if r < 0.5:
+                    selfeval, status = Response.CORRECT, DONE_STATUS
+                elif r < 0.95:
+                    selfeval = rng.choice((Response.CLOSE,
+                                           Response.DIFFERENT))
+                    status = rng.choice((NEED_HELP_STATUS,
+                                         NEED_REVIEW_STATUS, DONE_STATUS))
+                else: # never finished self-assessment
+                    selfeval, status = None, None
+                response = Response(lesson_id=lessonID, unitLesson_id=ulID,
+                                    course_id=courseID, author_id=userID,
+                                    text=random_sentence(rng, 4, 30),
+                                    confidence=rng.choice((Response.GUESS,
+                                            Response.UNSURE, Response.SURE)),
+                                    atime=t, selfeval=selfeval, status=status,
+                                    activity=self.activity)
+                errors = []
+                if selfeval and selfeval != Response.CORRECT and emULs \
+                  and rng.random() < classifyRate:
+                    for emID in rng.sample(emULs,
+                                           rng.randint(1, min(2, len(emULs)))):
+                        errors.append(StudentError(errorModel_id=emID,
+                            author_id=userID, atime=t + timedelta(minutes=3),
+                            status=rng.choice((NEED_HELP_STATUS,
+                                    NEED_REVIEW_STATUS, DONE_STATUS)),
+                            activity=self.activity))
+                pending.append((response, errors))
+                flags = get_task_flags([dict(pk=0, kind=response.kind,
+                                             selfeval=selfeval,
+                                             status=status)],
+                                       {0:[se.status for se in errors]})
+                statuses.append(StudentTaskStatus(user_id=userID,
+                                unitLesson_id=ulID, unit_id=ulUnits[ulID],
+                                atime=t, **flags))
+                nodes = [('LESSON', 'next', -5), ('ASK', 'next', -2),
+                         ('ASSESS', errors and 'error' or 'next', 0)]
+                if errors:
+                    nodes.append(('ERRORS', 'next', 2))
+                for nodeName, exitEvent, minutes in nodes:
+                    start = t + timedelta(minutes=minutes)
+                    events.append(ActivityEvent(activity=self.activity,
+                        nodeName=nodeName, user_id=userID,
+                        unitLesson_id=ulID, startTime=start,
+                        endTime=start + timedelta(minutes=2),
+                        exitEvent=exitEvent))
+                if len(pending) >= self.batchSize:
+                    self._flush(pending, events, statuses)
+                    pending, events, statuses = [], [], []
+        self._flush(pending, events, statuses)
+    def _flush(self, pending, events, statuses):
+        responseIDs = self._insert(Response, [t[0] for t in pending])
+        errors = []
+        for responseID, (response, l) in zip(responseIDs, pending):
+            for se in l:
+                se.response_id = responseID
+                errors.append(se)
+        self._create(StudentError, errors)
+        self._create(ActivityEvent, events)
+        self._create(StudentTaskStatus, statuses)
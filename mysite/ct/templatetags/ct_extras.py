@@ -1,4 +1,6 @@
 from django.utils.safestring import mark_safe
+from django.conf import settings
+from django.core.cache import cache
 #from markdown import markdown
 from django import template
 import re
@@ -6,6 +8,8 @@ import pypandoc
 from django.contrib.staticfiles.templatetags import staticfiles
 from django.utils import timezone
 from datetime import timedelta
+from ct.profiling import timed
+from ct.ct_util import text_hash
 
 register = template.Library()
 
@@ -14,8 +18,21 @@ DisplayMathPat = re.compile(r'\\\[(.+?)\\\]', flags=re.DOTALL)
 StaticImagePat = re.compile(r'STATICIMAGE/([^"]+)')
 
 @register.filter(name='md2html')
+@timed('md2html')
 def md2html(txt, stripP=False):
-    'converst ReST to HTML using pandoc, w/ audio support'
+    '''converst ReST to HTML using pandoc, w/ audio support.  Cached by
+    content hash, so identical texts (e.g. shared TextBlobs) share one
+    rendering.'''
+    key = 'ct.md2html.%d.%s' % (bool(stripP), text_hash(txt))
+    html = cache.get(key)
+    if html is None:
+        html = render_md2html(txt, stripP)
+        cache.set(key, html, getattr(settings, 'CT_MD2HTML_CACHE_TIMEOUT',
+                                     7 * 24 * 3600))
+    return mark_safe(html)
+
+def render_md2html(txt, stripP=False):
+    'pandoc conversion for md2html()'
     txt, markers = add_temporary_markers(txt, find_audio)
     txt, videoMarkers = add_temporary_markers(txt, find_video, len(markers))
     txt = pypandoc.convert(txt, 'html', format='rst',
@@ -25,7 +42,7 @@ def md2html(txt, stripP=False):
     txt = StaticImagePat.sub(staticfiles.static('ct/') + r'\1', txt)
     if stripP and txt.startswith('<p>') and txt.endswith('</p>'):
         txt = txt[3:-4]
-    return mark_safe(txt)
+    return txt
 
 def nolongerused():
     'convert markdown to html, preserving latex delimiters'
@@ -6,7 +6,7 @@ Replace this with more appropriate tests for your application.
 """
 
 from django.contrib.auth.models import User
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 from django.http import HttpResponseRedirect
 from ct.models import *
 from ct import views, fsm, ct_util
@@ -99,8 +99,10 @@ class ConceptMethodTests(TestCase):
         unit3 = Unit(title='Another Courselet', addedBy=self.user)
         unit3.save()
         ul3 = UnitLesson.create_from_lesson(l3, unit3)
-        clList = concept.get_conceptlinks(self.unit) # should get l1, l2
+        with self.assertNumQueries(2): # one for ULs, one for ConceptLinks
+            clList = concept.get_conceptlinks(self.unit) # should get l1, l2
         self.assertEqual(len(clList), 2)
+        self.assertEqual([cl.unitLesson for cl in clList], [ul1, ul2])
         self.assertEqual([cl for cl in clList if cl.lesson == l1][0]
                          .relationship, ConceptLink.DEFINES)
         self.assertEqual([cl for cl in clList if cl.lesson == l2][0]
@@ -277,6 +279,151 @@ class FSMTests(TestCase):
         self.assertTrue(ae.endTime > ae.startTime)
         self.assertEqual(ae.exitEvent, 'select_Lesson')
         self.assertIsNone(fsmStack.state.activityEvent)
+    def test_log_entry(self):
+        'check node entry / exit logging to new and existing activities'
+        f = FSM.save_graph(fsmDict, nodeDict, edgeDict, 'jacob')
+        other = ActivityLog.get_or_create('other')
+        for activity in (None, other):
+            fsmStack = self.do_start(f, unitLesson=self.unitLesson)
+            if activity:
+                fsmStack.state.activity = activity
+                fsmStack.state.save()
+            fsmStack.state.log_entry(self.user)
+            ae = ActivityEvent.objects.get(pk=fsmStack.state.activityEvent_id)
+            self.assertEqual(ae.activity.fsmName, activity and 'other'
+                                                  or 'test')
+            self.assertEqual((ae.nodeName, ae.user, ae.unitLesson),
+                             ('MID', self.user, self.unitLesson))
+            state = FSMState.objects.get(pk=fsmStack.state.pk) # next request
+            state.fsmNode, state.load_json_data()
+            with self.assertNumQueries(0): # repeat render: already logged
+                state.log_entry(self.user)
+            fsmStack.state = state
+            fsmStack.event(FakeRequest(self.user), 'select_Lesson',
+                           lesson=self.lesson)
+            ae = ActivityEvent.objects.get(pk=ae.pk)
+            self.assertEqual(ae.exitEvent, 'select_Lesson')
+            self.assertTrue(ae.endTime >= ae.startTime)
+            self.assertIsNone(FSMState.objects.get(pk=state.pk).activityEvent)
+            state.log_entry(self.user) # re-entered MID
+            self.assertEqual(ActivityEvent.objects.filter(
+                activity=state.activity).count(), 2)
+        # activity of an FSM studying a course goes in that course's log
+        fsmStack = self.do_start(f, unitLesson=self.unitLesson)
+        fsmStack.state.set_data_attr('course', self.course)
+        fsmStack.state.save_json_data()
+        fsmStack.state.log_entry(self.user)
+        self.assertEqual(fsmStack.state.activity.course, self.course)
+        self.assertEqual(fsmStack.state.activity.term, get_term())
+    def test_start3_buffered(self):
+        'check write-behind logging of node entry / exit, and recovery'
+        import json, os, shutil, tempfile
+        from ct import activity_log
+        f = FSM.save_graph(fsmDict, nodeDict, edgeDict, 'jacob')
+        fsmStack = self.do_start(f, unitLesson=self.unitLesson)
+        journalDir = tempfile.mkdtemp()
+        try:
+            with self.settings(CT_ACTIVITY_BUFFER=True,
+                               CT_ACTIVITY_JOURNAL_DIR=journalDir):
+                activity_log.reset()
+                buffer = activity_log.get_buffer()
+                fsmStack.event(FakeRequest(self.user, method='GET'), None)
+                self.assertEqual(fsmStack.state.activity.fsmName, 'test')
+                self.assertIsNone(fsmStack.state.activityEvent)
+                fsmStack.event(FakeRequest(self.user), 'select_Lesson',
+                               lesson=self.lesson)
+                self.assertEqual(ActivityEvent.objects.count(), 0) # queued
+                journal = activity_log.read_journal(buffer.journalPath)
+                self.assertEqual(len(journal), 1)
+                self.assertEqual(buffer.flush(), 1)
+                self.assertEqual(activity_log.read_journal(buffer.journalPath),
+                                 [])
+                ae = ActivityEvent.objects.get()
+                self.assertEqual(ae.nodeName, 'MID')
+                self.assertEqual(ae.user, self.user)
+                self.assertEqual(ae.unitLesson, self.unitLesson)
+                self.assertEqual(ae.exitEvent, 'select_Lesson')
+                self.assertTrue(ae.endTime > ae.startTime)
+                # journal of a crashed process: one event already written
+                r = dict(journal[0], startTime=activity_log.dump_time(
+                                                            ae.endTime))
+                path = os.path.join(journalDir, 'activity-999999999.jsonl')
+                with open(path, 'w') as ofile:
+                    for record in (journal[0], r):
+                        ofile.write(json.dumps(record) + '\n')
+                    ofile.write('{"truncated') # crashed mid-write
+                self.assertEqual(buffer.recover(), 1)
+                self.assertFalse(os.path.exists(path))
+                self.assertEqual(ActivityEvent.objects.count(), 2)
+                # crashed process that had our pid: recovered on restart
+                later = activity_log.dump_time(timezone.now() +
+                                               timedelta(hours=1))
+                r = dict(journal[0], startTime=later, endTime=later)
+                path = os.path.join(journalDir,
+                                    'activity-%d.jsonl' % os.getpid())
+                with open(path, 'w') as ofile:
+                    ofile.write(json.dumps(r) + '\n')
+                activity_log.reset()
+                buffer = activity_log.get_buffer() # runs recover()
+                self.assertNotEqual(buffer.journalPath, path)
+                self.assertFalse(os.path.exists(path))
+                self.assertEqual(ActivityEvent.objects.count(), 3)
+                self.assertTrue(activity_log.pid_alive(os.getpid()))
+        finally:
+            activity_log.reset()
+            shutil.rmtree(journalDir)
+    def test_event_log(self):
+        'check transitions are appended to event log and backfilled'
+        import shutil, tempfile
+        from ct import event_log
+        logDir = tempfile.mkdtemp()
+        try:
+            with self.settings(CT_EVENT_LOG_DIR=logDir,
+                               CT_EVENT_LOG_SEGMENT_BYTES=1):
+                event_log.reset()
+                f = FSM.save_graph(fsmDict, nodeDict, edgeDict, 'jacob')
+                fsmStack = self.do_start(f, unitLesson=self.unitLesson)
+                fsmStack.state.set_data_attr('course', self.course)
+                fsmStack.state.save_json_data()
+                for i in range(4):
+                    if i == 2: # entries to MID no longer logged
+                        FSMNode.objects.filter(fsm=f, name='MID') \
+                          .update(doLogging=False)
+                    fsmStack.state.log_entry(self.user) # page render
+                    fsmStack.event(FakeRequest(self.user), 'select_Lesson',
+                                   lesson=self.lesson)
+                event_log.reset()
+            live = list(ActivityEvent.objects.order_by('pk')
+                        .values_list('pk', flat=True))
+            self.assertEqual(len(live), 3) # MID node loaded before update
+            self.assertEqual(len(event_log.list_segments(logDir)), 5)
+            events = list(event_log.read_events(logDir))
+            self.assertEqual([(r['fsm'], r['node'], r['edge'], r['to'],
+                               r['log']) for r in events],
+                             [('test', 'START', 'next', 'MID', True)] +
+                             [('test', 'MID', 'select_Lesson', 'MID', True)]
+                             * 2 +
+                             [('test', 'MID', 'select_Lesson', 'MID', False)]
+                             * 2)
+            self.assertEqual(events[1]['state'], fsmStack.state.pk)
+            self.assertEqual(events[1]['ul'], self.unitLesson.pk)
+            self.assertEqual(events[1]['course'], self.course.pk)
+            self.assertEqual(list(event_log.read_events(logDir, 'other')), [])
+            with self.assertNumQueries(3): # course, partition, existing events
+                self.assertEqual(event_log.load_activity_events(logDir), 0)
+            self.assertEqual(list(ActivityEvent.objects.order_by('pk')
+                                  .values_list('pk', flat=True)), live)
+            ActivityEvent.objects.all().delete() # e.g. logging was off
+            self.assertEqual(event_log.load_activity_events(logDir), 3)
+            self.assertEqual(event_log.load_activity_events(logDir), 0)
+            for ae in ActivityEvent.objects.all(): # exits from logged MID
+                self.assertEqual((ae.activity.fsmName, ae.activity.course,
+                                  ae.nodeName, ae.exitEvent),
+                                 ('test', self.course, 'MID', 'select_Lesson'))
+                self.assertTrue(ae.endTime >= ae.startTime)
+        finally:
+            event_log.reset()
+            shutil.rmtree(logDir)
     def do_start(self, f, **kwargs):
         'run tests of basic startup of new FSM instance'
         fsmData = dict(unit=self.unit, foo='bar')
@@ -423,3 +570,1036 @@ class PageDataTests(TestCase):
         self.assertNotEqual(s, '0:00')
         self.assertEqual(s[:3], '0:0')
     
+
+class StudentTaskStatusTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='jacob', email='jacob@_',
+                                             password='top_secret')
+        self.course = Course(title='Great Course', description='the bestest',
+                             addedBy=self.user)
+        self.course.save()
+        self.ulQ = create_question_unit(self.user)
+        self.unit = self.ulQ.unit
+    def respond(self, **kwargs):
+        r = Response(lesson=self.ulQ.lesson, unitLesson=self.ulQ,
+                     course=self.course, author=self.user, text='i dunno',
+                     confidence=Response.GUESS, **kwargs)
+        r.save()
+        return r
+    def test_task_sequence(self):
+        'check task flags track response, self-eval and error saves'
+        self.assertEqual(self.unit.get_student_tasks(self.user),
+                         [(self.ulQ, 'start')])
+        r = self.respond()
+        self.assertEqual(self.unit.get_student_tasks(self.user),
+                         [(self.ulQ, 'selfeval')])
+        self.assertEqual(self.unit.get_selfeval_uls(self.user), [self.ulQ])
+        r.selfeval = Response.DIFFERENT
+        r.status = NEED_HELP_STATUS
+        r.save()
+        self.assertEqual(self.unit.get_student_tasks(self.user),
+                         [(self.ulQ, 'classify')])
+        self.assertEqual(self.unit.get_serrorless_uls(self.user), [self.ulQ])
+        emLesson = Lesson(title='oops', text='foo', addedBy=self.user,
+                          kind=Lesson.ERROR_MODEL)
+        emLesson.save_root()
+        em = UnitLesson.create_from_lesson(emLesson, self.unit,
+                                           parent=self.ulQ)
+        se = r.studenterror_set.create(errorModel=em, author=self.user,
+                                       status=NEED_HELP_STATUS)
+        self.assertEqual(self.unit.get_student_tasks(self.user),
+                         [(self.ulQ, 'resolve')])
+        self.assertEqual(self.unit.get_unresolved_uls(self.user), [self.ulQ])
+        se.status = DONE_STATUS
+        se.save()
+        self.assertEqual(self.unit.get_student_tasks(self.user), [])
+        self.assertEqual(StudentTaskStatus.objects.count(), 1)
+    def test_other_student(self):
+        'check that task flags are kept separately for each student'
+        self.respond()
+        other = User.objects.create_user(username='john', email='john@_',
+                                         password='top_secret')
+        self.assertEqual(self.unit.get_student_tasks(other),
+                         [(self.ulQ, 'start')])
+
+class InstructorTasksTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='jacob', email='jacob@_',
+                                             password='top_secret')
+        self.course = Course(title='Great Course', description='the bestest',
+                             addedBy=self.user)
+        self.course.save()
+    def test_get_instructor_tasks(self):
+        'check single-query task table matches the separate task queries'
+        from ct.management.commands.bench_unit_tasks import build_unit
+        unit = build_unit(30, self.user)
+        taskTable = unit.get_instructor_tasks()
+        inquiries = set(unit.get_new_inquiry_uls())
+        self.assertEqual(set([ul for ul, tasks in taskTable
+                              if 'inquiry' in tasks]), inquiries)
+        self.assertEqual(set([ul for ul, tasks in taskTable if 'em' in tasks]),
+                         set(unit.get_errorless_uls()))
+        self.assertEqual(set([ul for ul, tasks in taskTable
+                              if 'reso' in tasks]),
+                         set(unit.get_resoless_uls()))
+        n = len(inquiries) # inquiry rows must be listed first
+        self.assertEqual(set([t[0] for t in taskTable[:n]]), inquiries)
+
+class ReorderTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='jacob', email='jacob@_',
+                                             password='top_secret')
+        self.unit = Unit(title='My Courselet', addedBy=self.user)
+        self.unit.save()
+    def add_lessons(self, n):
+        for i in range(n):
+            self.unit.create_lesson('lesson %d' % i, 'text')
+        return self.unit.get_exercises()
+    def test_reorder_exercise(self):
+        'check bulk renumbering moves a lesson to its new position'
+        l = self.add_lessons(5)
+        titles = [ul.lesson.title for ul in l]
+        l2 = self.unit.reorder_exercise(4, 1, l)
+        self.assertEqual([ul.lesson.title for ul in l2],
+                         titles[:1] + titles[4:] + titles[1:4])
+        self.assertEqual([ul.lesson.title for ul in self.unit.get_exercises()],
+                         [ul.lesson.title for ul in l2])
+        self.assertEqual([ul.order for ul in self.unit.get_exercises()],
+                         range(5))
+    def test_reorder_query_count(self):
+        'check that the number of writes does not grow with the move size'
+        from django.test.utils import CaptureQueriesContext
+        from django.db import connection
+        l = self.add_lessons(20)
+        with CaptureQueriesContext(connection) as small:
+            l = self.unit.reorder_exercise(1, 0, l)
+        with CaptureQueriesContext(connection) as large:
+            self.unit.reorder_exercise(19, 0, l)
+        self.assertEqual(len(small), len(large))
+
+class CloneTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='jacob', email='jacob@_',
+                                             password='top_secret')
+        self.course = Course(title='Great Course', description='the bestest',
+                             addedBy=self.user)
+        self.course.save()
+    def test_unit_clone(self):
+        'check bulk cloning of a unit preserves its UnitLesson trees'
+        from ct.management.commands.bench_unit_tasks import build_unit
+        unit = build_unit(12, self.user)
+        unit2 = unit.clone(self.user, 'Copy', self.course)
+        self.assertEqual(unit2.title, 'Copy')
+        self.assertEqual(self.course.courseunit_set.filter(unit=unit2).count(),
+                         1)
+        def tree(u):
+            return sorted((ul.lesson_id, ul.kind, ul.order, ul.treeID,
+                           ul.parent and ul.parent.lesson_id)
+                          for ul in u.unitlesson_set.all())
+        self.assertEqual(tree(unit), tree(unit2))
+        self.assertEqual(UnitLesson.objects.filter(unit=unit2,
+                         parent__unit=unit).count(), 0)
+    def test_ul_copy(self):
+        'check UnitLesson.copy() copies answer children'
+        ul = create_question_unit(self.user)
+        unit = Unit(title='Another Courselet', addedBy=self.user)
+        unit.save()
+        ul2 = ul.copy(unit, self.user, order='APPEND')
+        self.assertEqual(ul2.order, 0)
+        self.assertEqual(ul2.lesson, ul.lesson)
+        answers = list(ul2.get_answers())
+        self.assertEqual(len(answers), 1)
+        self.assertEqual(answers[0].unit, unit)
+        self.assertIsNone(answers[0].order)
+
+class ConceptGraphIndexTests(TransactionTestCase): # commits and rollbacks
+    def setUp(self):
+        self.user = User.objects.create_user('jacob', 'jacob@_',
+                                             'top_secret')
+        from ct import concept_graph
+        concept_graph.reload()
+        unit = Unit(title='My Courselet', addedBy=self.user)
+        unit.save()
+        self.concepts = [Concept.new_concept(c, c, unit, self.user)
+                         for c in ('A', 'B', 'C', 'E')]
+    def tearDown(self):
+        from ct import concept_graph
+        concept_graph.reload()
+    def add_edge(self, fromConcept, toConcept, rel=ConceptGraph.DEPENDS):
+        cg = ConceptGraph(fromConcept=fromConcept, toConcept=toConcept,
+                          relationship=rel, addedBy=self.user)
+        cg.save()
+        return cg
+    def test_closure(self):
+        'check prerequisite, dependent, error model and cycle queries'
+        from ct.concept_graph import get_concept_graph
+        a, b, c, e = self.concepts
+        self.add_edge(a, b)
+        self.add_edge(b, c)
+        self.add_edge(e, c, ConceptGraph.MISUNDERSTANDS)
+        g = get_concept_graph()
+        self.assertEqual(g.get_prerequisites(a.pk), set((b.pk, c.pk)))
+        self.assertEqual(g.get_dependents(c.pk), set((a.pk, b.pk)))
+        self.assertEqual(g.get_error_models(a.pk), set((e.pk,)))
+        self.assertEqual(g.get_error_models(a.pk, False), set())
+        self.assertIsNone(g.find_cycle())
+        # incremental updates from committed saves / deletes
+        cg = self.add_edge(c, a)
+        self.assertEqual(sorted(g.find_cycle()), sorted((a.pk, b.pk, c.pk)))
+        cg.delete() # deletes run in a transaction: reloads when it ends
+        g = get_concept_graph()
+        self.assertIsNone(g.find_cycle())
+        self.assertEqual(g.get_dependents(a.pk), set())
+    def test_transactions(self):
+        'check rolled back and cascade-deleted edges leave the index'
+        from django.db import transaction
+        from ct.concept_graph import get_concept_graph
+        a, b, c, e = self.concepts
+        self.add_edge(a, b)
+        self.add_edge(b, c)
+        get_concept_graph()
+        try:
+            with transaction.atomic():
+                self.add_edge(c, a)
+                self.assertIsNotNone(get_concept_graph().find_cycle())
+                raise ValueError('roll back')
+        except ValueError:
+            pass
+        self.assertIsNone(get_concept_graph().find_cycle())
+        with transaction.atomic():
+            self.add_edge(c, a)
+        self.assertIsNotNone(get_concept_graph().find_cycle()) # committed
+        c.delete() # cascades to its edges
+        g = get_concept_graph()
+        self.assertIsNone(g.find_cycle())
+        self.assertEqual(g.get_prerequisites(a.pk), set((b.pk,)))
+
+class MainConceptsTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('jacob', 'jacob@_',
+                                             'top_secret')
+    def build_unit(self, n):
+        'unit with n concept definitions and n questions testing them'
+        unit = Unit(title='My Courselet', addedBy=self.user)
+        unit.save()
+        for i in range(n):
+            concept = Concept(title='c%d' % i, addedBy=self.user)
+            concept.save()
+            lesson = Lesson(title='c%d' % i, text='def', addedBy=self.user,
+                            concept=concept)
+            lesson.save_root()
+            UnitLesson.create_from_lesson(lesson, unit, order='APPEND')
+            lesson = Lesson(title='q%d' % i, text='?', addedBy=self.user,
+                            kind=Lesson.ORCT_QUESTION)
+            lesson.save_root(concept)
+            UnitLesson.create_from_lesson(lesson, unit, order='APPEND')
+        return unit
+    def count_queries(self, unit):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        with CaptureQueriesContext(connection) as context:
+            d = unit.get_main_concepts()
+            for concept, cls in d.items():
+                for cl in cls:
+                    cl.unitLesson.lesson.title # must already be loaded
+        return d, len(context)
+    def test_query_count(self):
+        'check get_main_concepts() query count does not grow with concepts'
+        d2, n2 = self.count_queries(self.build_unit(2))
+        d6, n6 = self.count_queries(self.build_unit(6))
+        self.assertEqual(len(d6), 6)
+        for concept, cls in d6.items():
+            self.assertEqual(sorted([cl.unitLesson.lesson.title for cl in cls]),
+                             [concept.title, 'q' + concept.title[1:]])
+        self.assertEqual(n2, n6)
+        self.assertTrue(n6 <= 3)
+
+class ProfilingTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('jacob', 'jacob@_',
+                                             'top_secret')
+        self.course = Course(title='Great Course', description='the bestest',
+                             addedBy=self.user)
+        self.course.save()
+        Role(role=Role.INSTRUCTOR, course=self.course, user=self.user).save()
+    def test_disabled(self):
+        'check middleware removes itself unless CT_PROFILE_VIEWS'
+        from django.core.exceptions import MiddlewareNotUsed
+        from ct.profiling import ViewProfileMiddleware
+        with self.settings(CT_PROFILE_VIEWS=False):
+            self.assertRaises(MiddlewareNotUsed, ViewProfileMiddleware)
+    def test_profile_view(self):
+        'check request profile is logged and added to histogram'
+        import json, logging
+        from django.test import Client
+        from ct import profiling
+        from ct.management.commands.profile_report import summarize
+        records = []
+        class ListHandler(logging.Handler):
+            def emit(self, record):
+                records.append(json.loads(record.getMessage()))
+        logger = logging.getLogger('ct.profile')
+        oldHandlers = logger.handlers
+        logger.handlers = [ListHandler()]
+        profiling.histogram.clear()
+        try:
+            with self.settings(CT_PROFILE_VIEWS=True):
+                client = Client() # loads middleware with profiling on
+                client.login(username='jacob', password='top_secret')
+                url = '/ct/teach/courses/%d/' % self.course.pk
+                self.assertEqual(client.get(url).status_code, 200)
+        finally:
+            logger.handlers = oldHandlers
+        self.assertEqual(len(records), 1)
+        r = records[0]
+        self.assertEqual(r['view'], 'ct.views.course_view')
+        self.assertEqual(r['status'], 200)
+        self.assertTrue(r['sql'] > 0)
+        self.assertEqual(r['md2html'], 1) # course description
+        self.assertEqual(profiling.get_histogram()['ct.views.course_view']['n'],
+                         1)
+        self.assertEqual(summarize(records)[0]['sql'], r['sql'])
+
+class SyntheticTests(TestCase):
+    def generate(self, prefix):
+        from ct.synthetic import SyntheticDeployment
+        counts = SyntheticDeployment(7, prefix, batchSize=50).generate(
+            courses=1, units=2, lessons=6, concepts=2, errorModels=2,
+            students=10)
+        responses = Response.objects.filter(author__username__startswith=
+                                            prefix + '_').order_by('pk')
+        return counts, [(r.text, r.selfeval, r.status) for r in responses]
+    def test_generate(self):
+        'check synthetic data is reproducible and internally consistent'
+        counts, responses = self.generate('a')
+        self.assertEqual(self.generate('b'), (counts, responses))
+        self.assertEqual(counts['Response'], len(responses))
+        self.assertEqual(counts['StudentTaskStatus'],
+                         StudentTaskStatus.objects.count() / 2)
+        self.assertRaises(ValueError, self.generate, 'a')
+        from django.core.management import call_command, CommandError
+        for option in ('concepts', 'errorModels'):
+            self.assertRaises(CommandError, call_command, 'generate_synthetic',
+                              prefix='c', **{option:0})
+        student = User.objects.get(username='a_s0_0')
+        unit = Unit.objects.filter(courseunit__course__role__user=student)[0]
+        self.assertEqual(len(unit.get_exercises()), 6)
+        for ul in unit.get_exercises():
+            self.assertEqual(ul.lesson.treeID, ul.lesson.pk)
+        questions = [ul for ul in unit.get_exercises()
+                     if ul.lesson.kind == Lesson.ORCT_QUESTION]
+        self.assertEqual(len(questions[0].get_answers()), 1)
+        self.assertEqual(len(questions[0].get_errors()), 2)
+        unit.get_instructor_tasks()
+        unit.get_student_tasks(student)
+
+class BenchFlowsTests(TestCase):
+    def test_flows(self):
+        'check benchmark flows run a complete lessonseq and instructor pages'
+        import random
+        from ct.synthetic import SyntheticDeployment
+        from ct.fsm_plugin.lessonseq import get_specs
+        from ct.management.commands.bench_flows import FlowTimer, \
+             instructor_flow, student_flow, compare
+        SyntheticDeployment(1).generate(courses=1, units=1, lessons=4,
+                                        students=2)
+        get_specs()[0].save_graph('synth_prof0')
+        course = Course.objects.get()
+        unit = Unit.objects.get()
+        timer = FlowTimer(self.client)
+        self.client.login(username='synth_prof0', password='synthetic')
+        instructor_flow(timer, course, unit, unit.get_exercises()[1])
+        self.client.login(username='synth_s0_0', password='synthetic')
+        nresponse = Response.objects.count()
+        student_flow(timer, course, unit, random.Random(1))
+        self.assertEqual(Response.objects.count(), nresponse + 2)
+        summary = timer.summary()
+        self.assertEqual(summary['POST lesson']['n'], 2)
+        self.assertEqual(summary['GET unit_tasks_student']['n'], 1)
+        self.assertEqual(compare(summary, summary, 0.25), [])
+        worse = dict(summary)
+        worse['GET course'] = dict(summary['GET course'],
+                                   queries=summary['GET course']['queries'] * 2)
+        self.assertEqual([t[:2] for t in compare(worse, summary, 0.25)],
+                         [('GET course', 'queries')])
+
+class SimulateLiveTests(TransactionTestCase): # students commit as they go
+    def test_simulate(self):
+        'check a small in-process live session runs and is counted'
+        import threading
+        from django.db import connections
+        from ct.synthetic import SyntheticDeployment
+        from ct.fsm_plugin import live, livestudent
+        from ct.management.commands.simulate_live import LoadStats, \
+             ClientSession, simulate
+        SyntheticDeployment(1).generate(courses=1, units=1, lessons=4,
+                                        students=3)
+        for mod in (live, livestudent):
+            mod.get_specs()[0].save_graph('synth_prof0')
+        course = Course.objects.get()
+        unit = Unit.objects.get()
+        questions = [ul for ul in unit.get_exercises()
+                     if ul.lesson.kind == Lesson.ORCT_QUESTION][:1]
+        students = list(User.objects.filter(role__course=course,
+                                            role__role=Role.ENROLLED))
+        # threads share the in-memory test db, one request at a time
+        db = connections['default']
+        db.allow_thread_sharing = True
+        lock = threading.RLock()
+        class SharedSession(ClientSession):
+            def __init__(self, *args):
+                connections['default'] = db
+                with lock:
+                    ClientSession.__init__(self, *args)
+            def request(self, *args, **kwargs):
+                with lock:
+                    return ClientSession.request(self, *args, **kwargs)
+        stats = LoadStats()
+        nresponse = Response.objects.filter(unitLesson=questions[0]).count()
+        try:
+            elapsed, errors = simulate(stats,
+                lambda username: SharedSession(stats, username, 'synthetic'),
+                course.addedBy, course, unit, questions, students,
+                think=0.05, answerTime=2., assessTime=2.)
+        finally:
+            db.allow_thread_sharing = False
+        self.assertEqual(errors, [])
+        self.assertEqual((stats.answered, stats.assessed), (3, 3))
+        self.assertEqual(stats.errors, {'lock':0, 'error':0})
+        self.assertEqual(Response.objects.filter(unitLesson=questions[0])
+                         .count(), nresponse + 3)
+        self.assertTrue(len(stats.samples['ul_respond']) >= 6) # GET + POST
+        self.assertTrue(elapsed < 4.)
+
+class ActivityPartitionTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('jacob', 'jacob@_',
+                                             'top_secret')
+        self.course = Course(title='Great Course', description='the bestest',
+                             addedBy=self.user)
+        self.course.save()
+    def test_terms(self):
+        'check term names and recent term list'
+        from datetime import datetime
+        self.assertEqual(get_term(datetime(2015, 1, 1)), '2015-spring')
+        self.assertEqual(get_term(datetime(2015, 8, 31)), '2015-summer')
+        self.assertEqual(get_term(datetime(2015, 12, 31)), '2015-fall')
+        self.assertEqual(get_recent_terms(4, datetime(2015, 3, 15)),
+                         ['2015-spring', '2014-fall', '2014-summer',
+                          '2014-spring'])
+        with self.settings(CT_TERM_STARTS=((2, 'winter'), (8, 'autumn'))):
+            self.assertEqual(get_term(datetime(2015, 1, 1)), '2014-autumn')
+    def test_get_or_create(self):
+        'check logs are partitioned by name, course and term'
+        a = ActivityLog.get_or_create('rt_test_1', self.course)
+        self.assertEqual(a.term, get_term())
+        self.assertEqual(ActivityLog.get_or_create('rt_test_1', self.course), a)
+        self.assertNotEqual(ActivityLog.get_or_create('rt_test_1'), a)
+        self.assertNotEqual(ActivityLog.get_or_create('rt_test_1', self.course,
+                                                      '2001-fall'), a)
+        a.archived = timezone.now()
+        a.save()
+        self.assertNotEqual(ActivityLog.get_or_create('rt_test_1', self.course),
+                            a)
+    def test_archive(self):
+        'check closed partitions are archived to file and restored'
+        import os, shutil, tempfile
+        from ct import activity_archive
+        old = ActivityLog.get_or_create('live', self.course, '2001-fall')
+        current = ActivityLog.get_or_create('live', self.course)
+        for a in (old, current):
+            for name in ('A', 'B'):
+                ActivityEvent(activity=a, user=self.user, nodeName=name,
+                              endTime=timezone.now(), exitEvent='next').save()
+        fsmNode = load_fsm2('jacob').startNode
+        state = FSMState(user=self.user, fsmNode=fsmNode, activity=old,
+                         isLiveSession=True)
+        state.save()
+        Role(role=Role.ENROLLED, course=self.course, user=self.user).save()
+        self.assertEqual(list(FSMState.find_live_sessions(self.user)), [state])
+        self.assertEqual(list(activity_archive.get_closed_partitions()), [])
+        state.delete() # partition no longer in use
+        self.assertEqual(list(activity_archive.get_closed_partitions()), [old])
+        archiveDir = tempfile.mkdtemp()
+        try:
+            path, n = activity_archive.archive_partition(old, archiveDir)
+            self.assertEqual(n, 2)
+            self.assertEqual(os.listdir(archiveDir), [os.path.basename(path)])
+            self.assertEqual(ActivityEvent.objects.filter(activity=old)
+                             .count(), 0)
+            self.assertEqual(ActivityEvent.objects.count(), 2)
+            self.assertIsNotNone(ActivityLog.objects.get(pk=old.pk).archived)
+            self.assertEqual(list(activity_archive.get_closed_partitions()), [])
+            state = FSMState(user=self.user, fsmNode=fsmNode, activity=old,
+                             isLiveSession=True)
+            state.save()
+            self.assertEqual(list(FSMState.find_live_sessions(self.user)), [])
+            header, events = activity_archive.read_archive(path)
+            self.assertEqual(header['term'], '2001-fall')
+            self.assertEqual([e['nodeName'] for e in events], ['A', 'B'])
+            activity_archive.restore_partition(path)
+            self.assertEqual(sorted(ActivityEvent.objects.filter(activity=old)
+                                    .values_list('nodeName', flat=True)),
+                             ['A', 'B'])
+            self.assertIsNone(ActivityLog.objects.get(pk=old.pk).archived)
+            self.assertEqual(activity_archive.expire_archives(None,
+                                                              archiveDir), [])
+            self.assertEqual(activity_archive.expire_archives(-1, archiveDir),
+                             [path])
+        finally:
+            shutil.rmtree(archiveDir)
+
+class LegacyImportTests(TestCase):
+    def setUp(self):
+        import codecs, csv, os, sqlite3, tempfile
+        self.user = User.objects.create_user('jacob', 'jacob@_',
+                                             'top_secret')
+        self.course = Course(title='Great Course', description='the bestest',
+                             addedBy=self.user)
+        self.course.save()
+        self.tmpdir = tempfile.mkdtemp()
+        self.dbfile = os.path.join(self.tmpdir, 'course.db')
+        conn = sqlite3.connect(self.dbfile)
+        c = conn.cursor()
+        c.execute('create table students (uid text, fullname text, '
+                  'username text, date_added text, added_by text)')
+        c.execute('create table questions (id integer, title text)')
+        c.execute('create table error_models (id integer, question_id '
+                  'integer, belief text, explanation text)')
+        c.execute('create table responses (id integer, question_id integer, '
+                  'uid text, answer text, confidence integer, '
+                  'submit_time text, reasons text)')
+        c.execute('create table student_errors (id integer, error_id '
+                  'integer, uid text, submit_time text)')
+        c.executemany('insert into students values (?,?,?,?,?)',
+                      [('u%d' % i, 'Smith, Jo%d' % i, 'jo%d' % i, '', '')
+                       for i in range(5)] + [('u9', 'Nobody', '', '', '')])
+        c.execute("insert into questions values (1, 'What is p?')")
+        c.executemany('insert into error_models values (?,?,?,?)',
+                      [(1, 1, 'confuses p and q', 'pq'),
+                       (2, 1, 'ignores the prior', 'prior')])
+        c.executemany('insert into responses values (?,?,?,?,?,?,?)',
+                      [(i, 1, 'u%d' % i, 'answer %d' % i, i % 3,
+                        '2013-09-10 10:11:12.5', ('correct', 'different')[i % 2])
+                       for i in range(5)] +
+                      [(9, 1, 'u9', 'no username', 0, '2013-09-10 10:11:12',
+                        None)])
+        c.executemany('insert into student_errors values (?,?,?,?)',
+                      [(1, 1, 'u1', '2013-09-10 10:20:00'),
+                       (2, 2, 'u3', '2013-09-10 10:20:00')])
+        conn.commit()
+        conn.close()
+        with codecs.open(os.path.join(self.tmpdir, 'prob.csv'), 'w',
+                         encoding='utf-8') as ofile:
+            w = csv.writer(ofile)
+            w.writerow(['q1', 'Probability', 'What is p?', 'Tell me.',
+                        'It is a probability.'])
+            w.writerow(['q2', '', 'Unseen question', 'Hmm?', 'Yes.',
+                        'thinks no'])
+        with open(os.path.join(self.tmpdir, 'course.csv'), 'w') as ofile:
+            ofile.write('prob.csv,Probability Basics\n')
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+    def test_import(self):
+        'check legacy questions, error models, students and responses'
+        import os
+        from ct.legacy_import import SocraticqsImporter
+        importer = SocraticqsImporter(self.dbfile, self.course, batchSize=2)
+        counts = importer.run(os.path.join(self.tmpdir, 'course.csv'))
+        self.assertEqual(counts['Response'], 5) # u9 has no username
+        self.assertEqual(counts['StudentError'], 2)
+        unit = self.course.courseunit_set.get().unit
+        self.assertEqual(unit.title, 'Probability Basics')
+        q1, q2 = unit.get_exercises()
+        self.assertEqual(q1.lesson.kind, Lesson.ORCT_QUESTION)
+        self.assertEqual(q1.get_answers()[0].lesson.text,
+                         'It is a probability.')
+        self.assertEqual(sorted([ul.lesson.title for ul in q1.get_errors()]),
+                         ['confuses p and q', 'ignores the prior'])
+        self.assertEqual([ul.lesson.title for ul in q2.get_errors()],
+                         ['thinks no'])
+        self.assertEqual(q1.lesson.conceptlink_set.get().concept.title,
+                         'Probability')
+        jo1 = User.objects.get(username='jo1')
+        self.assertEqual((jo1.first_name, jo1.last_name), ('Jo1', 'Smith'))
+        self.assertFalse(jo1.has_usable_password())
+        self.assertEqual(Role.objects.filter(course=self.course,
+                                             role=Role.ENROLLED).count(), 5)
+        r = Response.objects.get(author=jo1)
+        self.assertEqual((r.unitLesson, r.text, r.confidence, r.selfeval),
+                         (q1, 'answer 1', Response.UNSURE, Response.DIFFERENT))
+        se = StudentError.objects.get(author=jo1)
+        self.assertEqual((se.response, se.errorModel.lesson.title),
+                         (r, 'confuses p and q'))
+        sts = StudentTaskStatus.objects.get(user=jo1)
+        self.assertEqual((sts.unitLesson, sts.answered, sts.needsClassify),
+                         (q1, True, False))
+        self.assertTrue(StudentTaskStatus.objects.get(user__username='jo3')
+                        .answered)
+        # importing again reuses existing users
+        SocraticqsImporter(self.dbfile, self.course).run(
+            os.path.join(self.tmpdir, 'course.csv'))
+        self.assertEqual(User.objects.filter(username__startswith='jo')
+                         .count(), 5)
+
+class PhraseIndexTests(TestCase):
+    entries = [(1, 'confuses conditional and joint probability'),
+               (2, 'forgets to normalize the posterior'),
+               (3, 'confuses the prior with the posterior'),
+               (4, 'thinks independent events are mutually exclusive')]
+    def test_search(self):
+        'check TF-IDF ranking, top-k, batches and empty matches'
+        from ct.phrase_index import NgramIndex
+        index = NgramIndex(self.entries)
+        self.assertEqual(len(index), 4)
+        l = index.search('I confused the prior and the posterior', k=2)
+        self.assertEqual([i for s, i in l], [3, 2])
+        self.assertTrue(1. >= l[0][0] > l[1][0] > 0.)
+        self.assertAlmostEqual(index.search(self.entries[3][1])[0][0], 1.)
+        self.assertEqual(index.search('zebra quagga'), [])
+        self.assertIsNone(index.best(''))
+        self.assertEqual([l[0][1] for l in index.search_many(
+            ['joint probability', 'mutually exclusive events'])], [1, 4])
+    def test_loader_wrapper(self):
+        'check loader.PhraseIndex compatibility and missing-match error'
+        from loader import PhraseIndex
+        index = PhraseIndex(self.entries)
+        self.assertEqual(index['normalize posterior'], 2)
+        self.assertRaises(KeyError, index.__getitem__, 'zebra quagga')
+
+
+class ErrorSuggestTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='jacob', email='jacob@_',
+                                             password='top_secret')
+        self.course = Course(title='Great Course', description='the bestest',
+                             addedBy=self.user)
+        self.course.save()
+        self.ulQ = create_question_unit(self.user)
+        self.ems = []
+        for title, text in (('Prior vs. posterior',
+                             'confuses the prior with the posterior'),
+                            ('Forgot to normalize',
+                             'forgets to divide by the total probability')):
+            emLesson = Lesson(title=title, text=text, addedBy=self.user,
+                              kind=Lesson.ERROR_MODEL)
+            emLesson.save_root()
+            self.ems.append(UnitLesson.create_from_lesson(emLesson,
+                                        self.ulQ.unit, parent=self.ulQ))
+    def respond(self, text):
+        r = Response(lesson=self.ulQ.lesson, unitLesson=self.ulQ,
+                     course=self.course, author=self.user, text=text,
+                     confidence=Response.GUESS, selfeval=Response.DIFFERENT)
+        r.save()
+        return r
+    def test_suggest(self):
+        'check ranked suggestions, classified responses, and caching'
+        from ct.error_suggest import suggest_errors
+        r = self.respond('my answer just forgot the denominator sum')
+        r.studenterror_set.create(errorModel=self.ems[1], author=self.user)
+        r1 = self.respond('I used the prior where the posterior goes')
+        r2 = self.respond('I left out the denominator sum')
+        r3 = self.respond('zebra quagga')
+        novel = list(Response.get_novel_errors(self.ulQ))
+        self.assertEqual(len(novel), 3)
+        d = suggest_errors(self.ulQ, novel)
+        self.assertEqual(d[r1.pk][0][1], self.ems[0])
+        self.assertEqual(d[r2.pk][0][1], self.ems[1]) # via classified r
+        self.assertEqual(d[r3.pk], [])
+        with self.assertNumQueries(4): # stamp + error models only
+            self.assertEqual(suggest_errors(self.ulQ, novel), d)
+        r4 = self.respond('confused prior and posterior') # new stamp
+        d = suggest_errors(self.ulQ, novel + [r4])
+        self.assertEqual(d[r4.pk][0][1], self.ems[0])
+    def test_errors_page(self):
+        'check ul_errors shows suggestions for uncategorized responses'
+        self.respond('I used the prior where the posterior goes')
+        self.client.login(username='jacob', password='top_secret')
+        url = '/ct/teach/courses/%d/units/%d/lessons/%d/errors/' \
+              % (self.course.pk, self.ulQ.unit.pk, self.ulQ.pk)
+        response = self.client.get(url)
+        self.assertContains(response, 'Likely error models')
+        self.assertContains(response, 'Prior vs. posterior', count=2)
+
+
+class ResponseClusterTests(TestCase):
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear() # pks are reused across tests
+        self.user = User.objects.create_user(username='jacob', email='jacob@_',
+                                             password='top_secret')
+        self.course = Course(title='Great Course', description='the bestest',
+                             addedBy=self.user)
+        self.course.save()
+        self.ulQ = create_question_unit(self.user)
+    def respond(self, text):
+        r = Response(lesson=self.ulQ.lesson, unitLesson=self.ulQ,
+                     course=self.course, author=self.user, text=text,
+                     confidence=Response.GUESS, selfeval=Response.DIFFERENT)
+        r.save()
+        return r
+    def test_clusters(self):
+        'check similar responses cluster, incrementally, largest first'
+        from ct.response_cluster import cluster_responses
+        texts = ('the prior is the posterior', 'The prior is the posterior!',
+                 'the prior is the posterior, right?',
+                 'you must divide by the total probability',
+                 'divide by total probability', 'zebra quagga')
+        rs = [self.respond(t) for t in texts]
+        clusters = cluster_responses(self.ulQ, rs[:5])
+        self.assertEqual([[r.pk for r in members]
+                          for rep, members, terms in clusters],
+                         [[r.pk for r in rs[:3]], [r.pk for r in rs[3:5]]])
+        self.assertIn('posterior', clusters[0][2])
+        self.assertIn(clusters[0][0], rs[:3])
+        r = self.respond('so the prior is the posterior')
+        clusters = cluster_responses(self.ulQ, rs + [r])
+        self.assertEqual(len(clusters), 3)
+        self.assertEqual(clusters[0][1], rs[:3] + [r])
+        self.assertEqual(clusters[2][1], rs[5:])
+        # mostly categorized since: rebuilt for just the current responses
+        from django.core.cache import cache
+        from ct.response_cluster import CACHE_PREFIX
+        with self.settings(CT_RESPONSE_CLUSTER_SLACK=0):
+            clusters = cluster_responses(self.ulQ, [r])
+        self.assertEqual(clusters[0][1], [r])
+        self.assertEqual(len(cache.get('%s.%d' % (CACHE_PREFIX, self.ulQ.pk))),
+                         1)
+    def test_band_hash(self):
+        'check LSH band keys do not depend on the platform\'s hash()'
+        from ct.response_cluster import ResponseClusterer
+        self.assertEqual(ResponseClusterer().band_hash(tuple(range(64)), 1),
+                         4220600828)
+    def test_errors_page(self):
+        'check ul_errors groups uncategorized responses by cluster'
+        for i in range(3):
+            self.respond('the prior is the posterior')
+        self.client.login(username='jacob', password='top_secret')
+        url = '/ct/teach/courses/%d/units/%d/lessons/%d/errors/' \
+              % (self.course.pk, self.ulQ.unit.pk, self.ulQ.pk)
+        response = self.client.get(url)
+        self.assertContains(response, '3 similar responses')
+
+
+class QueryPlanTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='jacob', email='jacob@_',
+                                             password='top_secret')
+        self.ulQ = create_question_unit(self.user)
+        self.unit = self.ulQ.unit
+    def get_plan(self, query):
+        'SQLite EXPLAIN QUERY PLAN details for a QuerySet'
+        from django.db import connection
+        sql, params = query.query.sql_with_params()
+        cursor = connection.cursor()
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        return [row[-1] for row in cursor.fetchall()]
+    def assertIndexed(self, query, model, columns, covering=False):
+        '''check query searches model\'s table with the index on exactly
+        columns (not just an index on their prefix), and sorts by
+        walking the index rather than a temp b-tree'''
+        from django.db import connection
+        if connection.vendor != 'sqlite':
+            return
+        table = model._meta.db_table
+        cursor = connection.cursor()
+        cursor.execute('PRAGMA index_list(%s)' % table)
+        names = []
+        for row in cursor.fetchall():
+            cursor.execute('PRAGMA index_info(%s)' % row[1])
+            if [r[2] for r in cursor.fetchall()] == list(columns):
+                names.append(row[1])
+        self.assertEqual(len(names), 1, 'no index on %s %s' % (table, columns))
+        name = names[0]
+        using = covering and 'USING COVERING INDEX ' or 'USING INDEX '
+        plan = self.get_plan(query)
+        self.assertTrue([detail for detail in plan
+                         if detail.startswith('SEARCH %s ' % table)
+                         and (using + name + ' ') in detail],
+                        'no search of %s %s%s: %s' % (table, using, name,
+                                                      plan))
+        self.assertFalse([detail for detail in plan
+                          if 'TEMP B-TREE' in detail], plan)
+    def test_indexes(self):
+        'check hot ct queries use the composite indexes'
+        self.assertIndexed(Response.objects.filter(unitLesson=self.ulQ,
+                                                   selfeval__isnull=False),
+                           Response, ['unitLesson_id', 'selfeval'])
+        self.assertIndexed(Response.objects.filter(unitLesson=self.ulQ,
+                                selfeval__isnull=False)
+                           .values_list('selfeval', flat=True),
+                           Response, ['unitLesson_id', 'selfeval'],
+                           covering=True)
+        self.assertIndexed(Response.get_novel_errors(self.ulQ),
+                           Response, ['unitLesson_id', 'selfeval'])
+        self.assertIndexed(Response.objects.filter(unitLesson=self.ulQ,
+                                activity=None, kind=Response.ORCT_RESPONSE),
+                           Response, ['unitLesson_id', 'activity_id', 'kind'])
+        self.assertIndexed(Response.objects.filter(author=self.user,
+                                                   unitLesson=self.ulQ),
+                           Response, ['author_id', 'unitLesson_id'])
+        self.assertIndexed(self.unit.unitlesson_set.filter(
+                                order__isnull=False).order_by('order'),
+                           UnitLesson, ['unit_id', 'order']) # no sort step
+        self.assertIndexed(self.unit.unitlesson_set.filter(
+                kind=UnitLesson.MISUNDERSTANDS, order=1),
+                           UnitLesson, ['unit_id', 'kind', 'order'])
+        self.assertIndexed(UnitLesson.objects.filter(treeID=self.ulQ.treeID),
+                           UnitLesson, ['treeID'])
+        self.assertIndexed(StudentError.objects.filter(response=1,
+                                                       errorModel=self.ulQ),
+                           StudentError, ['response_id', 'errorModel_id'])
+        self.assertIndexed(FSMState.objects.filter(user=self.user),
+                           FSMState, ['user_id'])
+
+
+class SqliteTuningTests(TransactionTestCase): # retries need no outer atomic
+    def test_pragmas(self):
+        'check CT_SQLITE_PRAGMAS turn on WAL for a file database'
+        import sqlite3, tempfile, shutil, os
+        from ct.sqlite_tuning import get_pragmas, apply_pragmas
+        tmpDir = tempfile.mkdtemp()
+        try:
+            db = sqlite3.connect(os.path.join(tmpDir, 'test.db'))
+            apply_pragmas(db.cursor(), get_pragmas())
+            self.assertEqual(db.execute('PRAGMA journal_mode').fetchone()[0],
+                             'wal')
+            self.assertEqual(db.execute('PRAGMA busy_timeout').fetchone()[0],
+                             5000)
+            db.close()
+        finally:
+            shutil.rmtree(tmpDir)
+    def test_retry(self):
+        'check retry_on_busy retries lock errors only outside atomic'
+        from django.db import OperationalError, transaction
+        from ct.sqlite_tuning import retry_on_busy
+        calls = []
+        @retry_on_busy
+        def write(nfail, msg='database is locked'):
+            calls.append(1)
+            if len(calls) <= nfail:
+                raise OperationalError(msg)
+            return len(calls)
+        with self.settings(CT_BUSY_RETRY_DELAY=0.):
+            self.assertEqual(write(2), 3)
+            del calls[:]
+            self.assertRaises(OperationalError, write, 5)
+            self.assertEqual(len(calls), 4) # CT_BUSY_RETRIES + 1
+            del calls[:]
+            self.assertRaises(OperationalError, write, 1, 'no such table')
+            self.assertEqual(len(calls), 1)
+            del calls[:]
+            with transaction.atomic():
+                self.assertRaises(OperationalError, write, 1)
+            self.assertEqual(len(calls), 1)
+
+
+class ReplicaRouterTests(TestCase):
+    def setUp(self):
+        from django.conf import settings
+        self.databases = dict(settings.DATABASES,
+                              replica=settings.DATABASES['default'])
+    def route(self, method='GET', session=None):
+        'db_for_read of UnitLesson, FSMState, then UnitLesson after a write'
+        from django.test.client import RequestFactory
+        from ct.db_router import ReplicaRouter, use_replica
+        router = ReplicaRouter()
+        @use_replica
+        def view(request):
+            l = [router.db_for_read(UnitLesson),
+                 router.db_for_read(FSMState)]
+            router.db_for_write(Response)
+            return l + [router.db_for_read(UnitLesson)]
+        request = getattr(RequestFactory(), method.lower())('/')
+        request.session = session or {}
+        return view(request) + [router.db_for_read(UnitLesson)]
+    def test_routing(self):
+        'check replica reads only for GETs from sessions with no recent write'
+        import time
+        from ct.db_router import SESSION_KEY
+        self.assertEqual(self.route(), [None] * 4) # no replica configured
+        with self.settings(DATABASES=self.databases):
+            self.assertEqual(self.route(), ['replica', None, None, None])
+            self.assertEqual(self.route('POST'), [None] * 4)
+            self.assertEqual(self.route(session={SESSION_KEY:time.time()}),
+                             [None] * 4)
+            self.assertEqual(self.route(session={SESSION_KEY:
+                                                 time.time() - 3600}),
+                             ['replica', None, None, None])
+    def test_sticky(self):
+        'check middleware marks the session after a POST or a write'
+        from django.test.client import RequestFactory
+        from ct.db_router import ReplicaRouter, ReplicaStickinessMiddleware, \
+             SESSION_KEY, is_sticky
+        middleware = ReplicaStickinessMiddleware()
+        with self.settings(DATABASES=self.databases):
+            for method, write in (('get', False), ('post', False),
+                                  ('get', True)):
+                request = getattr(RequestFactory(), method)('/')
+                request.session = {}
+                middleware.process_request(request)
+                if write:
+                    ReplicaRouter().db_for_write(Response)
+                middleware.process_response(request, None)
+                self.assertEqual(is_sticky(request),
+                                 method == 'post' or write)
+
+
+class LessonLineageTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='jacob', email='jacob@_',
+                                             password='top_secret')
+    def commit(self, parent, text, mergeParent=None):
+        lesson = Lesson(title=parent.title, text=text, addedBy=self.user,
+                        treeID=parent.treeID, parent=parent,
+                        mergeParent=mergeParent, changeLog='edit ' + text)
+        lesson.save()
+        return lesson
+    def test_history(self):
+        'check ancestors, descendants, latest and diff from closure table'
+        root = Lesson(title='Bayes', text='a', addedBy=self.user)
+        root.save_root()
+        other = Lesson(title='Other', text='x', addedBy=self.user)
+        other.save_root()
+        v2 = self.commit(root, 'a\nb')
+        branch = self.commit(root, 'c')
+        v3 = self.commit(v2, 'a\nb\nd', mergeParent=branch)
+        with self.assertNumQueries(1):
+            self.assertEqual(list(v3.get_ancestors()), [v2, branch, root])
+        self.assertEqual(list(root.get_descendants())[-1], v3)
+        self.assertEqual(LessonLineage.objects.get(ancestor=root,
+                                                   descendant=v3).depth, 2)
+        with self.assertNumQueries(1):
+            self.assertEqual(set(Lesson.get_latest()), set([v3, other]))
+        self.assertEqual(list(Lesson.get_latest([root.treeID])), [v3])
+        commits, diff = root.get_diff(v3)
+        self.assertEqual(commits, [v2, branch, v3]) # merged branch too
+        self.assertIn('+d', diff)
+        n = LessonLineage.objects.count()
+        LessonLineage.rebuild() # same rows from scratch
+        self.assertEqual(LessonLineage.objects.count(), n)
+        self.assertEqual(list(v3.get_ancestors()), [v2, branch, root])
+
+
+class TextBlobTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='jacob', email='jacob@_',
+                                             password='top_secret')
+    def test_dedupe(self):
+        'check identical lesson texts share one blob, incl. bulk inserts'
+        text = u'Bayes\u2019 theorem ' * 50
+        lesson = Lesson(title='a', text=text, addedBy=self.user)
+        lesson.save_root()
+        pks = bulk_insert(Lesson, [Lesson(title='b', text=text,
+                                          addedBy=self.user, treeID=1),
+                                   Lesson(title='c', text='other',
+                                          addedBy=self.user, treeID=1)])
+        self.assertEqual(TextBlob.objects.count(), 2)
+        copy = Lesson.objects.get(pk=pks[0])
+        self.assertEqual(copy.textBlob_id, lesson.textBlob_id)
+        self.assertEqual(copy.text, text)
+        with self.assertNumQueries(0): # loaded once, then cached
+            self.assertEqual(copy.text, text)
+        self.assertEqual(list(UnitLesson.search_text(u'theorem')), []) # no UL
+        from ct.forms import ErrorForm
+        form = ErrorForm(instance=copy)
+        self.assertEqual(form.initial['text'], text)
+        form = ErrorForm(dict(title='b', text='edited', changeLog='fix'),
+                         instance=copy)
+        self.assertTrue(form.is_valid())
+        form.save()
+        self.assertEqual(Lesson.objects.get(pk=copy.pk).text, 'edited')
+        self.assertEqual(TextBlob.get_orphans().count(), 0)
+        Lesson.objects.filter(pk=pks[1]).delete()
+        self.assertEqual(TextBlob.get_orphans().count(), 1)
+        self.assertEqual(TextBlob.purge_orphans(), 1)
+        self.assertEqual(TextBlob.objects.count(), 2) # both still in use
+        from django.db.models import ProtectedError
+        with self.assertRaises(ProtectedError): # never cascades to lessons
+            TextBlob.objects.get(pk=lesson.textBlob_id).delete()
+    def test_compress(self):
+        'check long texts are compressed if CT_TEXTBLOB_COMPRESS_MIN is set'
+        text = u'the prior is not the posterior. ' * 100
+        with self.settings(CT_TEXTBLOB_COMPRESS_MIN=1000):
+            lesson = Lesson(title='a', text=text, addedBy=self.user)
+            lesson.save_root()
+        blob = TextBlob.objects.get(pk=lesson.textBlob_id)
+        self.assertIsNone(blob.text)
+        self.assertTrue(blob.storedSize < blob.size / 10)
+        self.assertEqual(Lesson.objects.get(pk=lesson.pk).text, text)
+    def test_select_related(self):
+        'check select_related() blobs give lesson text with no queries'
+        from django.core.cache import cache
+        for i in range(10):
+            Lesson(title='l%d' % i, text='text %d' % i,
+                   addedBy=self.user).save_root()
+        cache.clear() # cold cache
+        lessons = list(Lesson.objects.select_related('textBlob')
+                       .order_by('pk'))
+        with self.assertNumQueries(0):
+            self.assertEqual([l.text for l in lessons],
+                             ['text %d' % i for i in range(10)])
+        lessons[0].text = 'edited'
+        self.assertEqual(lessons[0].text, 'edited')
+        self.assertFalse(hasattr(lessons[0], '_textBlob_cache')) # stale
+
+
+class CourseBundleTests(TestCase):
+    def test_round_trip(self):
+        'check export / import of a course with versions and responses'
+        import os, tempfile
+        from ct.synthetic import SyntheticDeployment
+        from ct.course_bundle import export_course, import_course
+        SyntheticDeployment(7, 'a', batchSize=50).generate(courses=1,
+            units=2, lessons=6, concepts=2, errorModels=2, students=10)
+        course = Course.objects.get()
+        author = course.addedBy
+        ul = course.courseunit_set.all()[0].unit.get_exercises()[0]
+        v2 = Lesson(title=ul.lesson.title, text='revised', addedBy=author,
+                    treeID=ul.lesson.treeID, parent=ul.lesson)
+        v2.save()
+        fd, path = tempfile.mkstemp(suffix='.jsonl.gz')
+        os.close(fd)
+        try:
+            counts = export_course(course, path, includeResponses=True)
+            other = User.objects.create_user(username='importer',
+                                             password='top_secret')
+            newCourse, newCounts = import_course(path, other, batchSize=7,
+                                                 title='Copy')
+            extra = import_course(path, other)[0]
+            extra.delete() # the next import can reuse its Course pk
+            again = import_course(path, other)[0]
+        finally:
+            os.remove(path)
+        self.assertEqual(User.objects.filter(role__course=again,
+                                role__role=Role.ENROLLED).count(), 10)
+        for name, n in counts.items():
+            self.assertEqual(newCounts[name], n)
+        self.assertEqual(newCourse.title, 'Copy')
+        self.assertEqual(newCourse.addedBy, author) # same username here
+        self.assertEqual(newCounts['User'], 10) # anonymous students
+        def summary(c):
+            units = [cu.unit for cu in c.courseunit_set.order_by('order')]
+            return [[(x.lesson.title, x.lesson.text, x.kind, x.order,
+                      len(x.get_errors()), x.response_set.count(),
+                      StudentError.objects.filter(
+                          response__unitLesson=x).count())
+                     for x in unit.get_exercises()] for unit in units]
+        self.assertEqual(summary(newCourse), summary(course))
+        newUL = newCourse.courseunit_set.order_by('order')[0].unit \
+          .get_exercises()[0]
+        self.assertNotEqual(newUL.pk, ul.pk)
+        self.assertEqual(newUL.treeID, newUL.lesson.treeID)
+        self.assertEqual(newUL.lesson.treeID, newUL.lesson.pk)
+        newV2 = newUL.lesson.get_descendants()[0]
+        self.assertEqual(newV2.text, 'revised')
+        self.assertEqual(newV2.treeID, newUL.lesson.pk)
+        students = User.objects.filter(role__course=newCourse,
+                                       role__role=Role.ENROLLED)
+        self.assertEqual(students.count(), 10)
+        self.assertFalse(students.filter(username__startswith='a_').exists())
+        self.assertEqual(StudentTaskStatus.objects.filter(
+            unitLesson__unit__courseunit__course=newCourse).count(),
+                         StudentTaskStatus.objects.filter(
+            unitLesson__unit__courseunit__course=course).count())
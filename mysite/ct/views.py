@@ -8,11 +8,15 @@ from django.core.urlresolvers import reverse
 from django.core.exceptions import ObjectDoesNotExist
 from django.views.decorators.csrf import ensure_csrf_cookie
 from django.db.models import Q
+from django.db import transaction
 import json
 from ct.models import *
 from ct.forms import *
 from ct.templatetags.ct_extras import md2html, get_base_url, get_object_url, is_teacher_url, display_datetime, get_path_type
 from ct.fsm import FSMStack
+from ct import error_suggest, response_cluster
+from ct.sqlite_tuning import retry_on_busy
+from ct.db_router import use_replica
 import time
 
 ###########################################################
@@ -216,7 +220,8 @@ def ul_page_data(request, unit_id, ul_id, currentTab, includeText=True,
                  **kwargs):
     'generate standard set of page data for a unitLesson'
     unit = get_object_or_404(Unit, pk=unit_id)
-    ul = get_object_or_404(UnitLesson, pk=ul_id)
+    ul = get_object_or_404(UnitLesson.objects.select_related(
+                                'lesson__textBlob'), pk=ul_id)
     if not tabFunc:
         tabFunc = auto_tabs
     pageData = PageData(request, title=ul.lesson.title, **kwargs)
@@ -240,6 +245,7 @@ def ul_page_data(request, unit_id, ul_id, currentTab, includeText=True,
 # WelcomeMat refactored instructor views
 
 @login_required
+@use_replica
 def main_page(request):
     'generic home page'
     pageData = PageData(request)
@@ -272,6 +278,7 @@ def about(request):
 # course views
 
 @login_required
+@use_replica
 def course_view(request, course_id):
     'show courselets in a course'
     course = get_object_or_404(Course, pk=course_id)
@@ -707,6 +714,7 @@ def concept_lessons(request, course_id, unit_id, ul_id):
     return r
 
 @login_required
+@use_replica
 def unit_tasks(request, course_id, unit_id):
     'suggest next steps on this courselet'
     course = get_object_or_404(Course, pk=course_id)
@@ -718,17 +726,7 @@ def unit_tasks(request, course_id, unit_id):
     if not startForm: # user clicked Start
         return pageData.fsm_push(request, 'liveteach',
                                  dict(unit=unit, course=course))
-    newInquiryULs = frozenset(unit.get_new_inquiry_uls())
-    ulDict = {}
-    for ul in newInquiryULs:
-        ulDict[ul] = ['inquiry']
-    for ul in unit.get_errorless_uls():
-        ulDict.setdefault(ul, []).append('em')
-    for ul in unit.get_resoless_uls():
-        ulDict.setdefault(ul, []).append('reso')
-    taskTable = [(ul, ulDict[ul]) for ul in newInquiryULs]
-    taskTable += [(ul, ulDict[ul]) for ul in ulDict
-                  if ul not in newInquiryULs]
+    taskTable = unit.get_instructor_tasks()
     return pageData.render(request, 'ct/unit_tasks.html',
                            dict(unit=unit, taskTable=taskTable,
                                 courseUnit=cu, startForm=startForm))
@@ -743,6 +741,7 @@ def copy_unit_lesson(ul, concept, unit, addedBy, parentUL):
     return ul.copy(unit, addedBy, order='APPEND')
 
 @login_required
+@use_replica
 def unit_lessons(request, course_id, unit_id, lessonTable=None,
                  currentTab='Lessons', showReorderForm=True):
     unit = get_object_or_404(Unit, pk=unit_id)
@@ -767,6 +766,7 @@ def unit_lessons(request, course_id, unit_id, lessonTable=None,
     return r
 
 @login_required
+@use_replica
 def unit_resources(request, course_id, unit_id):
     unit = get_object_or_404(Unit, pk=unit_id)
     lessonTable = list(unit.unitlesson_set \
@@ -776,6 +776,7 @@ def unit_resources(request, course_id, unit_id):
 
 
 @login_required
+@use_replica
 def ul_teach(request, course_id, unit_id, ul_id):
     unit, ul, _, pageData = ul_page_data(request, unit_id, ul_id, 'Home',
                                          False)
@@ -784,7 +785,7 @@ def ul_teach(request, course_id, unit_id, ul_id):
                   selfeval__isnull=False, kind=Response.ORCT_RESPONSE)
         n = pageData.fsmStack.state.linkChildren.count() # livesession students
         statusTable, evalTable, n = Response.get_counts(query, n=n)
-        answer = ul.get_answers().all()[0]
+        answer = ul.get_answers().select_related('lesson__textBlob')[0]
     else: # default: all responses w/ selfeval
         query = Q(unitLesson=ul, selfeval__isnull=False,
                   kind=Response.ORCT_RESPONSE)
@@ -831,6 +832,7 @@ def live_question(request, course_id, unit_id, ul_id):
 
 
 @login_required
+@use_replica
 def ul_tasks(request, course_id, unit_id, ul_id):
     'suggest next steps on this question'
     unit, ul, _, pageData = ul_page_data(request, unit_id, ul_id, 'Tasks')
@@ -873,8 +875,9 @@ def edit_lesson(request, course_id, unit_id, ul_id):
                     return pageData.fsm_redirect(request, 'update', defaultURL,
                                                  unitLesson=ul)
             elif request.POST.get('task') == 'delete':
-                ul.delete()
-                unit.reorder_exercise() # renumber all lessons
+                with transaction.atomic():
+                    ul.delete()
+                    unit.reorder_exercise() # renumber all lessons
                 kwargs = dict(course_id=course_id, unit_id=unit_id)
                 defaultURL = reverse('ct:unit_lessons', kwargs=kwargs)
                 return pageData.fsm_redirect(request, 'delete', defaultURL,
@@ -904,6 +907,7 @@ def copy_error_ul(ul, concept, unit, addedBy, parentUL):
 
 
 @login_required
+@use_replica
 def ul_errors(request, course_id, unit_id, ul_id, showNETable=True):
     unit, ul, _, pageData = ul_page_data(request, unit_id, ul_id, 'Errors')
     n = Response.objects.filter(unitLesson=ul,
@@ -928,9 +932,13 @@ def ul_errors(request, course_id, unit_id, ul_id, showNETable=True):
                     neArgs['confidence'] = neForm.cleaned_data['confidence']
         else:
             neForm = ResponseFilterForm(request.GET)
-        novelErrors = Response.get_novel_errors(ul, **neArgs)
+        novelErrors = list(Response.get_novel_errors(ul, **neArgs))
+        suggestions = error_suggest.suggest_errors(ul, novelErrors)
+        for r in novelErrors: # ranked likely error models for triage
+            r.suggestedErrors = suggestions[r.pk]
+        novelClusters = response_cluster.cluster_responses(ul, novelErrors)
     else:
-        novelErrors = ()
+        novelErrors = novelClusters = ()
         neForm = False
     cLinks = list(ul.get_linked_concepts())
     if cLinks:
@@ -955,7 +963,8 @@ def ul_errors(request, course_id, unit_id, ul_id, showNETable=True):
     r = _lessons(request, pageData, concept, msg, unit=unit, 
                   seTable=seTable, templateFile='ct/errors.html',
                   showNovelErrors=showNovelErrors,
-                  novelErrors=novelErrors, responseFilterForm=neForm,
+                  novelErrors=novelErrors, novelClusters=novelClusters,
+                  responseFilterForm=neForm,
                   creationInstructions=creationInstructions,
                   newLessonFormClass=NewErrorForm, parentUL=ul,
                   createULFunc=create_error_ul, selectULFunc=copy_error_ul,
@@ -1021,6 +1030,7 @@ def resolutions(request, course_id, unit_id, ul_id):
     return r
 
 @login_required
+@use_replica
 def error_resources(request, course_id, unit_id, ul_id):
     unit, ul, concept, pageData = ul_page_data(request, unit_id, ul_id,
                                                'Resources')
@@ -1037,6 +1047,7 @@ def error_resources(request, course_id, unit_id, ul_id):
 # welcome mat refactored student UI for courses
 
 @login_required
+@use_replica
 def study_unit(request, course_id, unit_id):
     course = get_object_or_404(Course, pk=course_id)
     unit = get_object_or_404(Unit, pk=unit_id)
@@ -1056,22 +1067,17 @@ def study_unit(request, course_id, unit_id):
                 dict(unitLesson=nextUL, unit=unit, startForm=startForm))
 
 @login_required
+@use_replica
 def unit_tasks_student(request, course_id, unit_id):
     'suggest next steps on this courselet'
     unit = get_object_or_404(Unit, pk=unit_id)
     pageData = PageData(request, title=unit.title,
                         navTabs=unit_tabs_student(request.path, 'Tasks'))
-    taskTable = [(ul, 'start')
-                 for ul in unit.get_unanswered_uls(request.user)]
-    taskTable += [(ul, 'selfeval')
-                  for ul in unit.get_selfeval_uls(request.user)]
-    taskTable += [(ul, 'classify')
-                  for ul in unit.get_serrorless_uls(request.user)]
-    taskTable += [(ul, 'resolve')
-                  for ul in unit.get_unresolved_uls(request.user)]
+    taskTable = unit.get_student_tasks(request.user)
     return pageData.render(request, 'ct/unit_tasks_student.html',
                            dict(unit=unit, taskTable=taskTable))
 
+@use_replica
 def unit_lessons_student(request, course_id, unit_id):
     unit = get_object_or_404(Unit, pk=unit_id)
     pageData = PageData(request, title=unit.title,
@@ -1129,6 +1135,7 @@ def lesson(request, course_id, unit_id, ul_id):
     return pageData.render(request, 'ct/lesson_student.html',
                            dict(unitLesson=ul, unit=unit))
 
+@use_replica
 def ul_tasks_student(request, course_id, unit_id, ul_id):
     'suggest next steps on this question'
     unit, ul, _, pageData = ul_page_data(request, unit_id, ul_id, 'Tasks')
@@ -1209,6 +1216,7 @@ def resolutions_student(request, course_id, unit_id, ul_id):
                        lessonTable=lessonTable, statusForm=form))
 
 @login_required
+@use_replica
 def ul_faq_student(request, course_id, unit_id, ul_id):
     'UI for student to view or write inquiry about this lesson'
     unit, ul, _, pageData = ul_page_data(request, unit_id, ul_id,
@@ -1265,6 +1273,7 @@ def ul_thread_student(request, course_id, unit_id, ul_id, resp_id):
                        faqTable=faqTable, form=form, inquiry=inquiry,
                        errorTable=errorTable, replyTable=replyTable))
 
+@retry_on_busy
 def save_response(form, ul, user, course_id, **kwargs):
     course = get_object_or_404(Course, pk=course_id)
     r = form.save(commit=False)
@@ -1274,7 +1283,8 @@ def save_response(form, ul, user, course_id, **kwargs):
     r.author = user
     for k,v in kwargs.items():
         setattr(r, k, v)
-    r.save()
+    with transaction.atomic(): # Response + StudentTaskStatus, retried as one
+        r.save()
     return r
 
 @login_required
@@ -1303,13 +1313,25 @@ def ul_respond(request, course_id, unit_id, ul_id):
 def get_answer_html(unitLesson):
     'get HTML text for answer associated with this lesson, if any'
     try:
-        answer = unitLesson.get_answers()[0]
+        answer = unitLesson.get_answers() \
+          .select_related('lesson__textBlob')[0]
     except IndexError:
         return '(author has not provided an answer)'
     else:
         return md2html(answer.lesson.text)
 
 
+@retry_on_busy
+def save_selfeval(r, data, user):
+    'save student self-assessment of response r'
+    with transaction.atomic():
+        r.selfeval = data['selfeval']
+        r.status = data['status']
+        r.save()
+        if data['liked']:
+            liked = Liked(unitLesson=r.unitLesson, addedBy=user)
+            liked.save()
+
 @login_required
 def assess(request, course_id, unit_id, ul_id, resp_id):
     'student self-assessment'
@@ -1318,13 +1340,7 @@ def assess(request, course_id, unit_id, ul_id, resp_id):
     if request.method == 'POST':
         form = SelfAssessForm(request.POST)
         if form.is_valid():
-            r.selfeval = form.cleaned_data['selfeval']
-            r.status = form.cleaned_data['status']
-            r.save()
-            if form.cleaned_data['liked']:
-                liked = Liked(unitLesson=r.unitLesson,
-                              addedBy=request.user)
-                liked.save()
+            save_selfeval(r, form.cleaned_data, request.user)
             if r.selfeval == Response.CORRECT: # just go on to next lesson
                 eventName = 'next'
                 defaultURL = lesson_next_url(request, r.unitLesson, course_id)
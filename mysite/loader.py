@@ -1,4 +1,5 @@
 import ct.models
+from ct.phrase_index import NgramIndex
 from django.utils import timezone
 from django.contrib.auth.models import User
 import sqlite3
@@ -7,44 +8,19 @@ import codecs
 import os.path
 import random
 
-class PhraseIndex(object):
+class PhraseIndex(NgramIndex):
+    '''compatibility wrapper: index[text] returns the id of the entry
+    best matching text (TF-IDF ranked, see ct.phrase_index)'''
     def __init__(self, t, nword=2):
         'construct phrase index for list of entries of the form [(id, text),]'
-        self.nword = nword
-        d = {}
-        self.sizes = {}
-        for i, text in t:
-            n, l = self.get_phrases(text)
-            self.sizes[i] = n # save numbers of phrases
-            for j in range(n): # index all phrases in this text
-                phrase = tuple(l[j:j + nword])
-                try:
-                    d[phrase].append(i)
-                except KeyError:
-                    d[phrase] = [i]
-        self.d = d
-
-    def get_phrases(self, text):
-        'split into words, handling case < nword gracefully'
-        l = text.split()
-        if len(l) > self.nword:
-            return len(l) - self.nword + 1, l
-        else: # handle short phrases gracefully to allow matching
-            return 1, l
+        NgramIndex.__init__(self, t, nword)
 
     def __getitem__(self, text):
-        'find entry with highest phrase match fraction'
-        n, l = self.get_phrases(text)
-        counts = {}
-        for j in range(n):
-            phrase = tuple(l[j:j + self.nword])
-            for i in self.d.get(phrase, ()):
-                counts[i] = counts.get(i, 0)  + 1
-        l = []
-        for i, c in counts.items(): # compute match fractions
-            l.append((c / float(self.sizes[i]), i))
-        l.sort()
-        return l[-1][1] # return id with highest match fraction
+        'find entry with highest phrase match score'
+        i = self.best(text)
+        if i is None:
+            raise KeyError('no entry matches: %s' % text)
+        return i
 
 def get_question_by_tem(c, title, errorModel):
     c.execute('select q.id, count(*) from questions q, error_models em, responses r where q.title=? and em.explanation=? and q.id=em.question_id and q.id=r.question_id group by q.id', (title, errorModel))
@@ -118,8 +118,87 @@ MIDDLEWARE_CLASSES = (
     'django.contrib.messages.middleware.MessageMiddleware',
     # Uncomment the next line for simple clickjacking protection:
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    # keeps a session off the read replica right after it writes
+    'ct.db_router.ReplicaStickinessMiddleware',
+    # only active if CT_PROFILE_VIEWS is True
+    'ct.profiling.ViewProfileMiddleware',
 )
 
+# set True to log SQL / md2html / FSM cost of each request to ct_profile.log
+# (summarize with manage.py profile_report ct_profile.log)
+CT_PROFILE_VIEWS = False
+
+# set True to queue FSM ActivityEvents and write them in batches
+# (journaled in CT_ACTIVITY_JOURNAL_DIR until written; see ct/activity_log.py)
+CT_ACTIVITY_BUFFER = False
+CT_ACTIVITY_BUFFER_SIZE = 100 # events per bulk write
+CT_ACTIVITY_BUFFER_SECONDS = 10. # maximum delay before writing
+CT_ACTIVITY_JOURNAL_DIR = os.path.join(BASE_DIR, 'activity_journal')
+CT_ACTIVITY_JOURNAL_FSYNC = False # True to survive OS crash, not just ours
+
+# set to a directory to append every FSM transition to a JSON-lines event
+# log there (see ct/event_log.py; backfill with manage.py load_event_log)
+CT_EVENT_LOG_DIR = None
+CT_EVENT_LOG_SEGMENT_BYTES = 64 * 1024 * 1024 # start a new segment file
+# backfilled / recovered events match an existing ActivityEvent (same
+# activity, user, node, UnitLesson, exit event) ending within this many sec
+CT_ACTIVITY_MATCH_SECONDS = 1.
+
+# ActivityLog partitions (FSM x course x term) outside the most recent
+# CT_ACTIVITY_KEEP_TERMS terms are moved to gzipped files by
+# manage.py archive_activity; archive files are deleted after
+# CT_ACTIVITY_ARCHIVE_DAYS (None: keep forever)
+CT_TERM_STARTS = ((1, 'spring'), (6, 'summer'), (9, 'fall')) # (month, name)
+CT_ACTIVITY_KEEP_TERMS = 2
+CT_ACTIVITY_ARCHIVE_DIR = os.path.join(BASE_DIR, 'activity_archive')
+CT_ACTIVITY_ARCHIVE_DAYS = None
+
+# ul_errors suggests up to CT_ERROR_SUGGEST_COUNT likely error models for
+# each uncategorized response (see ct/error_suggest.py), cached until the
+# question gets new responses or classifications
+CT_ERROR_SUGGEST_COUNT = 3
+CT_ERROR_SUGGEST_MIN_SCORE = 0.1 # cosine similarity cutoff
+CT_ERROR_SUGGEST_TIMEOUT = 24 * 3600 # cache lifetime (seconds)
+
+# ul_errors groups uncategorized responses into clusters of similar
+# answers (MinHash estimate of Jaccard similarity of their character
+# 4-grams >= CT_RESPONSE_CLUSTER_THRESHOLD; see ct/response_cluster.py)
+CT_RESPONSE_CLUSTER_THRESHOLD = 0.5
+CT_RESPONSE_CLUSTER_TIMEOUT = 7 * 24 * 3600 # cache lifetime (seconds)
+# rebuild once it holds this many more than twice the current responses
+CT_RESPONSE_CLUSTER_SLACK = 100
+
+# PRAGMAs applied to each new SQLite connection (see ct/sqlite_tuning.py):
+# WAL lets page readers run during live-session write bursts
+CT_SQLITE_PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('cache_size', -20000), # KiB
+    ('mmap_size', 256 * 1024 * 1024),
+    ('busy_timeout', 5000), # msec
+)
+CT_BUSY_RETRIES = 3 # re-runs of a write transaction still locked out
+CT_BUSY_RETRY_DELAY = 0.05 # seconds, doubled on each retry
+
+# GET requests to listing / analytics views read from the CT_REPLICA_DB
+# alias, if it is in DATABASES (see ct/db_router.py); a session that
+# wrote within CT_REPLICA_STICKY_SECONDS reads from default instead.  e.g.
+# DATABASES['replica'] = dict(DATABASES['default'],
+#                             NAME=os.path.join(BASE_DIR, 'replica.db'),
+#                             TEST={'MIRROR': 'default'})
+DATABASE_ROUTERS = ['ct.db_router.ReplicaRouter']
+CT_REPLICA_DB = 'replica'
+CT_REPLICA_STICKY_SECONDS = 30 # longer than the replication lag
+CT_REPLICA_PRIMARY_MODELS = ('fsmstate', 'activityevent') # never replica
+
+# Lesson text is stored once per distinct text, as a TextBlob keyed by its
+# SHA-1 hash (report savings with manage.py textblob_report); texts of at
+# least CT_TEXTBLOB_COMPRESS_MIN bytes are zlib-compressed (None: never;
+# compressed texts are not found by lesson text search)
+CT_TEXTBLOB_COMPRESS_MIN = None
+CT_TEXTBLOB_CACHE_TIMEOUT = 24 * 3600 # seconds to cache blob texts
+CT_MD2HTML_CACHE_TIMEOUT = 7 * 24 * 3600 # seconds to cache rendered HTML
+
 ROOT_URLCONF = 'mysite.urls'
 
 # Python dotted path to the WSGI application used by Django's runserver.
@@ -175,11 +254,23 @@ LOGGING = {
             '()': 'django.utils.log.RequireDebugFalse'
         }
     },
+    'formatters': {
+        'message': {
+            'format': '%(message)s'
+        }
+    },
     'handlers': {
         'mail_admins': {
             'level': 'ERROR',
             'filters': ['require_debug_false'],
             'class': 'django.utils.log.AdminEmailHandler'
+        },
+        'ct_profile': {
+            'level': 'INFO',
+            'class': 'logging.FileHandler',
+            'filename': os.path.join(BASE_DIR, 'ct_profile.log'),
+            'formatter': 'message',
+            'delay': True, # don't create file unless profiling is on
         }
     },
     'loggers': {
@@ -188,5 +279,10 @@ LOGGING = {
             'level': 'ERROR',
             'propagate': True,
         },
+        'ct.profile': {
+            'handlers': ['ct_profile'],
+            'level': 'INFO',
+            'propagate': False,
+        },
     }
 }